@@ -0,0 +1,118 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Compare the speed of bulk-loading synthetic Stack Overflow posts with INSERT statements
+and with Postgres' COPY, saving batches from the loading thread and from a writer thread.
+Rows are saved to a scratch `benchmark_post` table, which is dropped at the end of the run.
+For example:
+
+    python -m benchmarks.bulk_load --db postgres --db-config postgres-config.json
+
+With SQLite, only INSERT statements are benchmarked, in a temporary database file in WAL mode.
+'''
+
+from __future__ import unicode_literals
+import argparse
+import datetime
+import os
+import tempfile
+import time
+from peewee import SqliteDatabase
+
+from models import BatchInserter, Post, db_proxy, init_database
+
+
+class BenchmarkPost(Post):
+    ''' A copy of the Post table that the benchmark can safely fill and drop. '''
+
+    class Meta:  # pylint: disable=no-init,too-few-public-methods
+        db_table = 'benchmark_post'
+
+
+def make_rows(row_count):
+    creation_date = datetime.datetime(2018, 1, 1)
+    for index in range(row_count):
+        yield {
+            'fetch_index': 1,
+            'creation_date': creation_date + datetime.timedelta(seconds=index),
+            'post_id': index,
+            'title': "How do I follow this tutorial? (%d)" % index,
+            'body_html': None if index % 3 == 0 else '<p>See "this tutorial".</p>',
+            'body_text': "See \"this tutorial\",\nwhich explains it.",
+            'is_accepted': index % 2 == 0,
+            'score': index % 100,
+        }
+
+
+def time_load(row_count, batch_size, use_copy, asynchronous):
+    ''' Load synthetic rows into a fresh table, returning the number of seconds it took. '''
+    BenchmarkPost.drop_table(fail_silently=True)
+    BenchmarkPost.create_table()
+
+    start_time = time.time()
+    with BatchInserter(BenchmarkPost, batch_size, use_copy=use_copy,
+                       asynchronous=asynchronous) as batch_inserter:
+        for row in make_rows(row_count):
+            batch_inserter.insert(row)
+    elapsed = time.time() - start_time
+
+    assert BenchmarkPost.select().count() == row_count
+    BenchmarkPost.drop_table()
+    return elapsed
+
+
+def main(db, db_config, row_count, batch_size):
+
+    if db == 'postgres':
+        init_database(db, config_filename=db_config)
+        methods = [
+            ('INSERT', False, False),
+            ('INSERT (writer thread)', False, True),
+            ('COPY', True, False),
+            ('COPY (writer thread)', True, True),
+        ]
+    else:
+        database_file = tempfile.NamedTemporaryFile(suffix='.sqlite', delete=False)
+        database_file.close()
+        db_proxy.initialize(SqliteDatabase(database_file.name, pragmas=[('journal_mode', 'wal')]))
+        methods = [('INSERT', False, False), ('INSERT (writer thread)', False, True)]
+
+    try:
+        for method_name, use_copy, asynchronous in methods:
+            elapsed = time_load(row_count, batch_size, use_copy, asynchronous)
+            print("%-24s %d rows in %.1f s (%.0f rows/s)" % (
+                method_name, row_count, elapsed, row_count / elapsed))
+    finally:
+        if db != 'postgres':
+            db_proxy.close()
+            for filename in [database_file.name + suffix for suffix in ['', '-wal', '-shm']]:
+                if os.path.exists(filename):
+                    os.remove(filename)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark bulk loading of posts.")
+    parser.add_argument(
+        '--db',
+        default='sqlite',
+        help="which type of database to use (postgres, sqlite). Defaults to sqlite."
+    )
+    parser.add_argument(
+        '--db-config',
+        help="Name of file containing database configuration."
+    )
+    parser.add_argument(
+        '--rows',
+        type=int,
+        default=1000000,
+        help="Number of synthetic posts to load (default: %(default)s)."
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=10000,
+        help="Number of rows to save in each transaction (default: %(default)s)."
+    )
+    args = parser.parse_args()
+    main(args.db, args.db_config, args.rows, args.batch_size)
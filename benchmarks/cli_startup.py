@@ -0,0 +1,78 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Measure how long it takes for the `data.py` command line to start up.
+
+Each command is run in a fresh interpreter, so the timings include every import
+that the command pulls in.  To compare against an older version of the scripts,
+check it out somewhere else (e.g., `git worktree add ../data-before <commit>`) and
+pass its `data.py` with `--baseline-script`:
+
+    python -m benchmarks.cli_startup --baseline-script ../data-before/data.py
+'''
+
+from __future__ import unicode_literals
+import argparse
+import os.path
+import subprocess
+import sys
+import time
+
+
+DEFAULT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data.py')
+COMMANDS = [
+    ['--help'],
+    ['dump', 'stack_overflow_post_links', '--help'],
+]
+
+
+def time_command(script, arguments, repetitions):
+    ''' Return a list of wall-clock times (in seconds) for running a `data.py` command. '''
+    script = os.path.abspath(script)
+    timings = []
+    for _ in range(repetitions):
+        start_time = time.time()
+        subprocess.call(
+            [sys.executable, script] + arguments,
+            cwd=os.path.dirname(script),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        timings.append(time.time() - start_time)
+    return timings
+
+
+def report(label, timings):
+    timings = sorted(timings)
+    median = timings[len(timings) // 2]
+    print("%-50s min %7.1f ms   median %7.1f ms" % (label, timings[0] * 1000, median * 1000))
+
+
+def main(script, baseline_script, repetitions):
+    for arguments in COMMANDS:
+        label = ' '.join(arguments)
+        if baseline_script is not None:
+            report("before: " + label, time_command(baseline_script, arguments, repetitions))
+        report("after:  " + label, time_command(script, arguments, repetitions))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark start-up time of data.py.")
+    parser.add_argument(
+        '--script',
+        default=DEFAULT_SCRIPT,
+        help="Path to the data.py script to benchmark (default: this checkout's data.py)."
+    )
+    parser.add_argument(
+        '--baseline-script',
+        help="Path to a data.py script from an earlier version to compare against."
+    )
+    parser.add_argument(
+        '--repetitions',
+        type=int,
+        default=10,
+        help="Number of times to run each command (default: %(default)s)."
+    )
+    args = parser.parse_args()
+    main(args.script, args.baseline_script, args.repetitions)
@@ -0,0 +1,141 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Measure the throughput of the fetching commands, by running them against a local server
+that replays recorded API responses (see `benchmarks.replay_server`).  First record
+fixtures with real runs of the fetchers, then benchmark them:
+
+    python data.py fetch stack_overflow_posts --record-fixtures fixtures.jsonl
+    python data.py fetch stack_overflow_post_bodies --record-fixtures fixtures.jsonl
+    python data.py fetch mendeley_documents <group_id> <token> --record-fixtures fixtures.jsonl
+    python data.py fetch mendeley_annotations <token> --record-fixtures fixtures.jsonl
+    python -m benchmarks.fetchers fixtures.jsonl --group-id <group_id> --latency 0.1
+
+Fetched data is saved to a temporary SQLite database, which is deleted at the end of the run.
+'''
+
+from __future__ import unicode_literals
+import argparse
+import logging
+import os
+import tempfile
+import time
+from peewee import SqliteDatabase
+
+from benchmarks.replay_server import add_server_arguments, get_server_options, start_server
+from fetch.api import DEFAULT_CONCURRENCY, default_rate_limiter, override_hosts
+from models import MendeleyAnnotation, MendeleyDocument, Post, create_tables, db_proxy
+import fetch.mendeley_annotations
+import fetch.mendeley_documents
+import fetch.stack_overflow_post_bodies
+import fetch.stack_overflow_posts
+
+
+API_HOSTS = ['api.stackexchange.com', 'api.mendeley.com']
+FETCHERS = [
+    'stack_overflow_posts',
+    'stack_overflow_post_bodies',
+    'mendeley_documents',
+    'mendeley_annotations',
+]
+
+
+def count_rows(fetcher_name):
+    ''' Count the rows that a fetcher has saved so far. '''
+    if fetcher_name == 'stack_overflow_posts':
+        return Post.select().count()
+    elif fetcher_name == 'stack_overflow_post_bodies':
+        return Post.select().where(Post.body_html.is_null(False)).count()
+    elif fetcher_name == 'mendeley_documents':
+        return MendeleyDocument.select().count()
+    elif fetcher_name == 'mendeley_annotations':
+        return MendeleyAnnotation.select().count()
+
+
+def run_fetcher(fetcher_name, group_id, concurrency):
+    # The arguments of each fetcher's `main` are the ones its command line parser makes.
+    options = {'http_cache': None, 'record_fixtures': None, 'resume': False,
+               'incremental': False, 'reuse_bodies': False, 'refetch_changed': False}
+    token = 'replayed-token'
+    if fetcher_name == 'stack_overflow_posts':
+        fetch.stack_overflow_posts.main(concurrency=concurrency, **options)
+    elif fetcher_name == 'stack_overflow_post_bodies':
+        fetch.stack_overflow_post_bodies.main(
+            fetch_index=-1, concurrency=concurrency, **options)
+    elif fetcher_name == 'mendeley_documents':
+        fetch.mendeley_documents.main(group_id, token, **options)
+    elif fetcher_name == 'mendeley_annotations':
+        fetch.mendeley_annotations.main(
+            token, document_fetch_index=-1, concurrency=concurrency, group_id=group_id,
+            **options)
+
+
+def main(fixtures, fetcher_names, group_id, concurrency, rate_limit, server_options):
+
+    server = start_server(fixtures, **server_options)
+    override_hosts(dict((host, server.base_url) for host in API_HOSTS))
+    if not rate_limit:
+        default_rate_limiter.rates = {}
+
+    database_file = tempfile.NamedTemporaryFile(suffix='.sqlite', delete=False)
+    database_file.close()
+    db_proxy.initialize(SqliteDatabase(database_file.name))
+    create_tables()
+
+    try:
+        for fetcher_name in fetcher_names:
+
+            server.reset_counts()
+            row_count_before = count_rows(fetcher_name)
+            start_time = time.time()
+            run_fetcher(fetcher_name, group_id, concurrency)
+            elapsed = time.time() - start_time
+            row_count = count_rows(fetcher_name) - row_count_before
+
+            counts = server.counts
+            print("%-28s %6d requests (%4d errors, %4d throttled, %4d missing) in %6.1f s" % (
+                fetcher_name, counts['requests'], counts['errors'], counts['throttled'],
+                counts['missing'], elapsed))
+            print("%-28s %8.1f requests/s %10.1f rows/s (%d rows)" % (
+                '', counts['requests'] / elapsed, row_count / elapsed, row_count))
+    finally:
+        server.shutdown()
+        db_proxy.close()
+        os.remove(database_file.name)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark fetchers against replayed responses.")
+    parser.add_argument('fixtures', help="Fixture file recorded with --record-fixtures.")
+    parser.add_argument(
+        '--fetchers',
+        nargs='+',
+        choices=FETCHERS,
+        default=FETCHERS,
+        help="Fetchers to run, in order. Later fetchers read what earlier ones saved " +
+             "(default: all of them)."
+    )
+    parser.add_argument(
+        '--group-id',
+        default='',
+        help="ID of the Mendeley group that documents were recorded for."
+    )
+    parser.add_argument(
+        '--concurrency',
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help="Number of requests the concurrent fetchers make at once (default: %(default)s)."
+    )
+    parser.add_argument(
+        '--no-rate-limit',
+        action='store_true',
+        help="Don't limit the rate of requests to the replayed hosts."
+    )
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+    main(
+        args.fixtures, args.fetchers, args.group_id, args.concurrency, not args.no_rate_limit,
+        get_server_options(args))
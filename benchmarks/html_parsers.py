@@ -0,0 +1,133 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Compare the ways of parsing post bodies in `compute._html`, on bodies of posts from the
+database.  Each parser is timed parsing whole bodies, and parsing only the tags of interest
+(anchors for finding links, and `pre` and `code` for finding code).  The results of each
+are compared to the results of parsing whole bodies with `html.parser`, and posts with
+different results are reported.  For example:
+
+    python -m benchmarks.html_parsers --limit 5000 --show-differences 3
+'''
+
+from __future__ import unicode_literals
+import argparse
+import time
+from bs4 import FeatureNotFound
+
+from compute._html import HTML_PARSERS, find_links, parse_html
+from models import FetchRun, Post, init_database
+
+
+REFERENCE_PARSER = 'html.parser'
+CODE_TAGS = ['pre', 'code']
+TASKS = [
+    # Name, and how to get results from HTML, with a parser and with or without only
+    # parsing the tags of interest
+    ('links', find_links),
+    ('code', lambda html, html_parser, tags_only: [
+        node.text for node in
+        parse_html(html, html_parser, CODE_TAGS if tags_only else None).find_all(CODE_TAGS)]),
+]
+
+
+def load_bodies(fetch_index, limit):
+    ''' Load the HTML bodies of up to `limit` posts, as a list of (post ID, HTML) pairs. '''
+    if fetch_index == -1:
+        fetch_index = FetchRun.get_latest_index(Post)
+    posts = (
+        Post
+        .select(Post.id, Post.post_id, Post.body_html, Post.body_html_hash)
+        .where(
+            (Post.fetch_index == fetch_index) &
+            (Post.body_html.is_null(False) | Post.body_html_hash.is_null(False)))
+        .order_by(Post.id)
+        .limit(limit))
+    return [(post.post_id, post.html) for post in posts]
+
+
+def run_task(bodies, get_results, html_parser, tags_only):
+    ''' Parse every body, returning the time taken and the results for each body. '''
+    results = []
+    start_time = time.time()
+    for _, html in bodies:
+        results.append(get_results(html, html_parser, tags_only))
+    return time.time() - start_time, results
+
+
+def main(fetch_index, limit, show_differences):
+
+    bodies = load_bodies(fetch_index, limit)
+    if not bodies:
+        print("No post bodies to parse.")
+        return
+    print("Parsing %d post bodies (%.1f MB)." % (
+        len(bodies), sum(len(html) for _, html in bodies) / 1e6))
+
+    difference_count = 0
+    for task_name, get_results in TASKS:
+
+        reference_results = None
+        for html_parser in [REFERENCE_PARSER] + [p for p in HTML_PARSERS if p != REFERENCE_PARSER]:
+            for tags_only in [False, True]:
+
+                mode = 'only some tags' if tags_only else 'whole body'
+                try:
+                    elapsed, results = run_task(bodies, get_results, html_parser, tags_only)
+                except FeatureNotFound:
+                    print("%-6s %-12s %-16s not installed" % (task_name, html_parser, mode))
+                    break
+
+                if reference_results is None:
+                    reference_results = results
+                    comparison = "(reference)"
+                else:
+                    different_posts = [
+                        post_id for (post_id, _), result, reference_result in
+                        zip(bodies, results, reference_results)
+                        if result != reference_result]
+                    difference_count += len(different_posts)
+                    comparison = "%d posts differ" % len(different_posts)
+                    if different_posts[:show_differences]:
+                        comparison += " (e.g., posts %s)" % ', '.join(
+                            str(post_id) for post_id in different_posts[:show_differences])
+
+                print("%-6s %-12s %-16s %9.1f posts/s  %s" % (
+                    task_name, html_parser, mode, len(bodies) / elapsed, comparison))
+
+    if difference_count:
+        print("Some parsers found different results from %s." % REFERENCE_PARSER)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark ways of parsing post bodies.")
+    parser.add_argument(
+        '--db',
+        default='sqlite',
+        help="Type of database to read posts from (postgres, sqlite). Defaults to sqlite."
+    )
+    parser.add_argument('--db-config', help="Name of file containing database configuration.")
+    parser.add_argument(
+        '--fetch-index',
+        type=int,
+        default=-1,
+        help="Index of fetched posts to parse the bodies of. Defaults to latest."
+    )
+    parser.add_argument(
+        '--limit',
+        type=int,
+        default=2000,
+        help="Number of post bodies to parse (default: %(default)s)."
+    )
+    parser.add_argument(
+        '--show-differences',
+        type=int,
+        default=5,
+        help="Number of posts with different results to list for each parser " +
+             "(default: %(default)s)."
+    )
+    args = parser.parse_args()
+
+    init_database(args.db, config_filename=args.db_config)
+    main(args.fetch_index, args.limit, args.show_differences)
@@ -0,0 +1,191 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+A local stand-in for the Stack Exchange and Mendeley APIs, which replays responses that
+were recorded with a fetching command's `--record-fixtures` argument.  For example:
+
+    python data.py fetch stack_overflow_posts --record-fixtures fixtures.jsonl
+    python -m benchmarks.replay_server fixtures.jsonl --port 8000 --latency 0.1
+
+Responses are matched to requests by their method, path, and query parameters.  The
+server can be made to respond slowly, fail some requests, or throttle some requests,
+to see how the fetchers cope.  See `benchmarks.fetchers` for running fetchers against it.
+'''
+
+from __future__ import unicode_literals
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+
+
+def get_fixture_key(method, url):
+    ''' Make a key for a request that doesn't depend on its host or the order of its params. '''
+    url_parts = urlsplit(url)
+    params = sorted(parse_qsl(url_parts.query, keep_blank_values=True))
+    return (method.upper(), url_parts.path, tuple(params))
+
+
+def load_fixtures(filename):
+    ''' Load a fixture file, returning a dictionary from fixture keys to responses. '''
+    fixtures = {}
+    with open(filename) as fixture_file:
+        for line in fixture_file:
+            if not line.strip():
+                continue
+            fixture = json.loads(line)
+            # If a response was recorded more than once, the last recording wins.
+            fixtures[get_fixture_key(fixture['method'], fixture['url'])] = fixture
+    return fixtures
+
+
+class ReplayServer(ThreadingHTTPServer):
+    '''
+    Serves recorded responses.  Each response is delayed by `latency` seconds (with up to
+    `latency_jitter` seconds added at random).  A fraction `error_rate` of requests fail with
+    a 503 error, and a fraction `throttle_rate` are refused with a 429 error and a
+    Retry-After header of `retry_after` seconds.  The server counts the requests it gets.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, address, fixtures, latency=0, latency_jitter=0, error_rate=0,
+                 throttle_rate=0, retry_after=1):
+        super(ReplayServer, self).__init__(address, ReplayRequestHandler)
+        self.fixtures = fixtures
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.reset_counts()
+
+    def reset_counts(self):
+        with self.lock:
+            self.counts = {'requests': 0, 'errors': 0, 'throttled': 0, 'missing': 0}
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    @property
+    def base_url(self):
+        return 'http://%s:%d' % self.server_address[:2]
+
+
+class ReplayRequestHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        server = self.server
+        server.count('requests')
+        time.sleep(server.latency + random.uniform(0, server.latency_jitter))
+
+        chance = random.random()
+        if chance < server.error_rate:
+            server.count('errors')
+            self._send(503, {}, '')
+            return
+        if chance < server.error_rate + server.throttle_rate:
+            server.count('throttled')
+            self._send(429, {'Retry-After': str(server.retry_after)}, '')
+            return
+
+        fixture = server.fixtures.get(get_fixture_key(self.command, self.path))
+        if fixture is None:
+            server.count('missing')
+            self._send(404, {}, '')
+            return
+        self._send(fixture['status_code'], fixture['headers'], fixture['body'])
+
+    def _send(self, status_code, headers, body):
+        data = body.encode('utf-8')
+        self.send_response(status_code)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def start_server(fixtures_filename, port=0, **options):
+    '''
+    Start a replay server on a background thread, returning the server.  If `port` is 0,
+    any free port is used.  `options` are passed to `ReplayServer`.
+    '''
+    server = ReplayServer(('127.0.0.1', port), load_fixtures(fixtures_filename), **options)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def add_server_arguments(parser):
+    parser.add_argument(
+        '--latency',
+        type=float,
+        default=0,
+        help="Seconds to wait before sending each response (default: %(default)s)."
+    )
+    parser.add_argument(
+        '--latency-jitter',
+        type=float,
+        default=0,
+        help="Up to this many seconds are added to each wait at random (default: %(default)s)."
+    )
+    parser.add_argument(
+        '--error-rate',
+        type=float,
+        default=0,
+        help="Fraction of requests to fail with a 503 error (default: %(default)s)."
+    )
+    parser.add_argument(
+        '--throttle-rate',
+        type=float,
+        default=0,
+        help="Fraction of requests to refuse with a 429 error (default: %(default)s)."
+    )
+    parser.add_argument(
+        '--retry-after',
+        type=float,
+        default=1,
+        help="Seconds that throttled requests are asked to wait (default: %(default)s)."
+    )
+
+
+def get_server_options(args):
+    return {
+        'latency': args.latency,
+        'latency_jitter': args.latency_jitter,
+        'error_rate': args.error_rate,
+        'throttle_rate': args.throttle_rate,
+        'retry_after': args.retry_after,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay recorded API responses.")
+    parser.add_argument('fixtures', help="Fixture file recorded with --record-fixtures.")
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=8000,
+        help="Port to serve on (default: %(default)s)."
+    )
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    server = ReplayServer(
+        ('127.0.0.1', args.port), load_fixtures(args.fixtures), **get_server_options(args))
+    print("Replaying %d responses at %s" % (len(server.fixtures), server.base_url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,73 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Parsing of the HTML bodies of posts.  Bodies can be parsed with Python's built-in
+`html.parser`, or with `lxml` if it is installed, which is much faster.  A parse can be
+limited to the tags that will be looked at, so that the rest of the body isn't built
+into a tree.  See `benchmarks.html_parsers` for comparing the speed and the output
+of each way of parsing.
+'''
+
+from __future__ import unicode_literals
+import logging
+import re
+from bs4 import BeautifulSoup, SoupStrainer
+
+
+logger = logging.getLogger('data')
+HTML_PARSERS = ['html.parser', 'lxml']
+DEFAULT_HTML_PARSER = 'html.parser'
+TAG_PATTERN = re.compile(r'<(/?)([a-zA-Z][^\s/>]*)')
+UNPARSED_PATTERN = re.compile(
+    r'<!--.*?-->|<(script|style)\b.*?</\1\s*>', re.DOTALL | re.IGNORECASE)
+
+
+def parse_html(html, html_parser=DEFAULT_HTML_PARSER, only_tags=None):
+    '''
+    Parse HTML into a BeautifulSoup document, with one of the `HTML_PARSERS`.
+    If `only_tags` is a list of tag names, only those tags (and everything inside them)
+    are kept in the document.  If one of those tags isn't ended by its own end tag, the
+    tags around it decide where it ends, so the whole document is kept instead, to find
+    the same content in those tags as parsing the whole document would.
+    '''
+    parse_only = None
+    if only_tags is not None and _has_self_contained_tags(html, only_tags):
+        parse_only = SoupStrainer(only_tags)
+    return BeautifulSoup(html, html_parser, parse_only=parse_only)
+
+
+def _has_self_contained_tags(html, tag_names):
+    '''
+    Check whether every one of the tags named in HTML is ended by its own end tag, rather
+    than by the end of a tag around it, and whether every tag opened inside it is ended
+    inside it.  BeautifulSoup only ends tags at end tags, so for HTML like this, parsing
+    only those tags gives the same tags as parsing the whole document.  Comments, scripts,
+    and styles are skipped, as the tags in them aren't parsed as tags.
+    '''
+    html = UNPARSED_PATTERN.sub('', html)
+    if '<!--' in html:
+        return False  # Parsers differ on where a comment without an end ends
+    tag_names = set(tag_name.lower() for tag_name in tag_names)
+    open_tags = []  # The tags opened since the outermost of the named tags, if in one
+    for end_slash, tag_name in TAG_PATTERN.findall(html):
+        tag_name = tag_name.lower()
+        if not open_tags:
+            if not end_slash and tag_name in tag_names:
+                open_tags.append(tag_name)
+        elif not end_slash:
+            open_tags.append(tag_name)
+        elif tag_name in open_tags:
+            del open_tags[len(open_tags) - 1 - open_tags[::-1].index(tag_name):]
+        else:
+            return False
+    return True
+
+
+def find_links(html, html_parser=DEFAULT_HTML_PARSER, anchors_only=True):
+    '''
+    Find the links in HTML, returning a list of (URL, anchor text) pairs in the order they
+    appear.  If `anchors_only` is true, only anchor tags are built into the parse tree.
+    '''
+    document = parse_html(html, html_parser, ['a'] if anchors_only else None)
+    return [(link['href'], link.text) for link in document.find_all('a', href=True)]
@@ -2,39 +2,208 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import unicode_literals
+import functools
 import logging
+import multiprocessing
+from peewee import JOIN, fn
 from tqdm import tqdm
-from bs4 import BeautifulSoup
-from peewee import fn
-
-from models import Post, PostLink
+from compute._html import DEFAULT_HTML_PARSER, HTML_PARSERS, find_links
+from models import Post, PostLink, FetchRun, ComputedPost, db_proxy, compute_run, \
+    get_max_query_parameters, hash_content, init_database, insert_rows, iterate_batches
 
 
 logger = logging.getLogger('data')
+DEFAULT_RANGE_SIZE = 1000  # Number of posts that are read and parsed together
 
+# Increase this when a change to this module changes the links it finds, so that
+# links found by earlier versions are computed again.
+LINKS_VERSION = 1
 
-def extract_links(fetch_index):
 
-    posts = (
+def _select_post_ids(fetch_index):
+    return (
         Post
-        .select()
+        .select(Post.id)
         .where(Post.fetch_index == fetch_index)
         )
 
-    for post in tqdm(posts):
-        document = BeautifulSoup(post.body_html, 'html.parser')
-        for link in document.find_all('a', href=True):
-            PostLink.create(
-                post=post,
-                url=link['href'],
-                anchor_text=link.text
-                )
 
+def _select_posts(fetch_index, first_id, last_id, version=None):
+    '''
+    Select the posts in a range of IDs.  If `version` is given, only posts whose links
+    weren't computed by that version, from a body with the same hash, are selected, so that
+    the bodies of up-to-date posts are never read.  Posts saved with a body but without its
+    hash (see `0008_hash_post_bodies`) can't be checked, so they are always selected.
+    '''
+    posts = (
+        Post
+        .select(Post.id, Post.body_html, Post.body_html_hash)
+        .where(
+            (Post.fetch_index == fetch_index) &
+            (Post.id >= first_id) &
+            (Post.id <= last_id))
+        .order_by(Post.id)
+        )
+    if version is not None:
+        # Comparing with NULL is never true, so missing hashes are compared as empty text.
+        posts = (
+            posts
+            .join(ComputedPost, JOIN.LEFT_OUTER, on=(
+                (ComputedPost.post == Post.id) &
+                (ComputedPost.module == __name__) &
+                (ComputedPost.version == version)))
+            .where(
+                ComputedPost.id.is_null() |
+                (Post.body_html.is_null(False) & Post.body_html_hash.is_null()) |
+                (fn.COALESCE(ComputedPost.body_hash, '') !=
+                 fn.COALESCE(Post.body_html_hash, '')))
+            )
+    return posts
+
+
+def get_version(html_parser):
+    ''' Get the version of the links computed with a parser, for marking computed posts. '''
+    return '%d:%s' % (LINKS_VERSION, html_parser)
+
+
+def get_post_ranges(fetch_index, range_size=DEFAULT_RANGE_SIZE):
+    ''' Split the posts in a fetch index into ranges of `range_size` posts (first ID, last ID). '''
+    for batch in iterate_batches(_select_post_ids(fetch_index), range_size):
+        yield batch[0].id, batch[-1].id
+
+
+def extract_links_in_range(fetch_index, post_range, html_parser=DEFAULT_HTML_PARSER,
+                           force=False):
+    '''
+    Extract links from the posts in a range of IDs.  Posts whose links were already computed
+    by this version of the module, from the same body, are skipped unless `force` is true.
+    Returns a list of (post, body hash) pairs for the posts whose links were extracted, and
+    a list of (post, URL, anchor text) tuples, in order of the posts' IDs, and then of where
+    the links are in each post.
+    '''
+    # Read all of the posts before parsing them, so the database isn't kept busy by a long read.
+    version = None if force else get_version(html_parser)
+    posts = list(_select_posts(fetch_index, post_range[0], post_range[1], version))
+
+    extracted_posts = []
+    links = []
+    for post in posts:
+        body_hash = post.body_html_hash
+        if body_hash is None and post.body_html is not None:
+            body_hash = hash_content(post.body_html)
+        extracted_posts.append((post.id, body_hash))
+        html = post.html
+        if html is None:
+            continue
+        for url, anchor_text in find_links(html, html_parser):
+            links.append((post.id, url, anchor_text))
+
+    return extracted_posts, links
+
+
+def _init_worker(db_type, db_config, db_profile):
+    # Processes can't share a database connection, so each worker makes its own.
+    init_database(db_type, config_filename=db_config, profile=db_profile)
+
+
+def _delete_links(post_ids):
+    ''' Delete the links of posts, and their marks as computed.  Call this within a transaction. '''
+    posts_per_statement = get_max_query_parameters(db_proxy.obj) - 1
+    for start in range(0, len(post_ids), posts_per_statement):
+        statement_post_ids = post_ids[start:start + posts_per_statement]
+        PostLink.delete().where(PostLink.post << statement_post_ids).execute()
+        (ComputedPost
+         .delete()
+         .where(
+             (ComputedPost.module == __name__) &
+             (ComputedPost.post << statement_post_ids))
+         .execute())
 
-def main(fetch_index, *args, **kwargs):  # pylint: disable=unused-argument
+
+def _save_links(run, extracted_posts, links):
+    '''
+    Replace the links of posts with newly extracted links, and mark the posts as computed
+    by a run.  Call this within a transaction.
+    '''
+    _delete_links([post_id for post_id, _ in extracted_posts])
+    insert_rows(PostLink, [
+        {'post': post_id, 'url': url, 'anchor_text': anchor_text}
+        for post_id, url, anchor_text in links
+    ])
+    insert_rows(ComputedPost, [
+        {
+            'module': __name__,
+            'post': post_id,
+            'compute_run': run.id,
+            'version': run.version,
+            'body_hash': body_hash,
+        }
+        for post_id, body_hash in extracted_posts
+    ])
+    run.row_count += len(links)
+    run.save()
+
+
+def extract_links(fetch_index, jobs=1, database_options=None, html_parser=DEFAULT_HTML_PARSER,
+                  force=False):
+    '''
+    Extract links from the posts in a fetch index and save them.  Only posts that are new,
+    have changed bodies, or had their links computed by another version of this module are
+    parsed, unless `force` is true.  Their old links are replaced.  With more than one job,
+    ranges of posts are parsed by that many worker processes, which connect to the database
+    with `database_options` (the `db_type`, `db_config`, and `db_profile` to initialize it
+    with).  Links are saved in the same order whatever the number of jobs.  Bodies are
+    parsed with `html_parser` (see `compute._html`).
+    '''
+    post_ranges = list(get_post_ranges(fetch_index))
+    extract_range_links = functools.partial(
+        extract_links_in_range, fetch_index, html_parser=html_parser, force=force)
+
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(
+            jobs, initializer=_init_worker, initargs=(
+                database_options['db_type'],
+                database_options['db_config'],
+                database_options['db_profile'],
+            ))
+        range_links = pool.imap(extract_range_links, post_ranges)
+    else:
+        range_links = (extract_range_links(post_range) for post_range in post_ranges)
+
+    # Each range's links are saved with the marks for its posts, so that if the run
+    # stops early, the next run continues with the posts that weren't saved.
+    extracted_post_count = 0
+    try:
+        with compute_run(__name__, fetch_index, get_version(html_parser)) as run:
+            for extracted_posts, links in tqdm(range_links, total=len(post_ranges)):
+                if extracted_posts:
+                    with db_proxy.atomic():
+                        _save_links(run, extracted_posts, links)
+                    extracted_post_count += len(extracted_posts)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    logger.info(
+        "Extracted %d links from %d posts in fetch %d.",
+        run.row_count, extracted_post_count, fetch_index)
+
+
+def explain_queries():
+    ''' The main queries of this module, for checking their query plans. '''
+    return [
+        ("post IDs in a fetch index", _select_post_ids(1)),
+        ("posts in a range of IDs", _select_posts(1, 1, 1000)),
+        ("posts to compute in a range of IDs", _select_posts(1, 1, 1000, get_version('lxml'))),
+    ]
+
+
+def main(fetch_index, jobs, html_parser, force, db, db_config, db_profile, *_, **__):
     if fetch_index == -1:
-        fetch_index = Post.select(fn.Max(Post.fetch_index)).scalar()
-    extract_links(fetch_index)
+        fetch_index = FetchRun.get_latest_index(Post)
+    database_options = {'db_type': db, 'db_config': db_config, 'db_profile': db_profile}
+    extract_links(fetch_index, jobs, database_options, html_parser, force)
 
 
 def configure_parser(parser):
@@ -45,3 +214,21 @@ def configure_parser(parser):
         default=-1,
         help="Index of fetched posts for which to extract links. Defaults to latest."
         )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of processes to parse posts with (default: %(default)s)."
+        )
+    parser.add_argument(
+        "--html-parser",
+        choices=HTML_PARSERS,
+        default=DEFAULT_HTML_PARSER,
+        help="Parser for post bodies. 'lxml' is faster, though it has to be installed, and " +
+             "it can find different anchor text in broken HTML (default: %(default)s)."
+        )
+    parser.add_argument(
+        "--force",
+        action='store_true',
+        help="Extract links from all posts, even ones whose links are up to date."
+        )
@@ -1,5 +1,6 @@
 import logging
 import argparse
+import importlib
 import unittest
 import os
 import sys
@@ -16,24 +17,20 @@ data_logger.setLevel(logging.DEBUG)
 data_logger.addHandler(log_handler)
 data_logger.propagate = False
 
-from models import create_tables, init_database, Command  # pylint: disable=wrong-import-position
-from migrate import run_migration  # pylint: disable=wrong-import-position
-
-# List out the data processing modules that you've defined in the subdirectories here
-from fetch import stack_overflow_posts, tutorial_pdfs  # pylint: disable=wrong-import-position
-from fetch import stack_overflow_post_bodies  # pylint: disable=wrong-import-position
-from fetch import mendeley_annotations, mendeley_documents  # pylint: disable=wrong-import-position
-# from import_ import <module-1>, <module-2>, ...
-from compute import stack_overflow_post_links  # pylint: disable=wrong-import-position
-from dump import random_posts, stack_overflow_post_links as dump_post_links  # pylint: disable=wrong-import-position
-
-# And then list the imported module under the appropriate subcommands below:
+# List out the data processing modules that you've defined in the subdirectories here, by
+# their dotted module path.  Modules are only imported when their subcommand is invoked, so
+# that a command doesn't pay the import cost of every other module's dependencies.
 COMMANDS = {
     'fetch': {
         'description': "Fetch data from the web.",
         'module_help': "Type of data to fetch.",
-        'modules': [mendeley_annotations, mendeley_documents, stack_overflow_posts,
-                    stack_overflow_post_bodies, tutorial_pdfs],
+        'modules': [
+            'fetch.mendeley_annotations',
+            'fetch.mendeley_documents',
+            'fetch.stack_overflow_posts',
+            'fetch.stack_overflow_post_bodies',
+            'fetch.tutorial_pdfs',
+        ],
     },
     'import': {
         'description': "Import data from logs.",
@@ -43,19 +40,24 @@ COMMANDS = {
     'compute': {
         'description': "Compute derived fields from existing data.",
         'module_help': "Type of data to compute.",
-        'modules': [stack_overflow_post_links],
+        'modules': ['compute.stack_overflow_post_links'],
     },
     'migrate': {
         'description':
             "Manage database migrations. (Should only be necessary if you initialized " +
             "your database and then the model files were updated.)",
         'module_help': "Migration operation.",
-        'modules': [run_migration],
+        'modules': ['migrate.run_migration'],
     },
     'dump': {
         'description': "Dump data to a text file.",
         'module_help': "Type of data to dump.",
-        'modules': [random_posts, dump_post_links],
+        'modules': ['dump.random_posts', 'dump.stack_overflow_post_links'],
+    },
+    'explain': {
+        'description': "Check how the database runs the queries in the other modules.",
+        'module_help': "Type of check.",
+        'modules': ['explain.query_plans'],
     },
 }
 
@@ -65,10 +67,40 @@ def run_tests(*_, **__):
     unittest.TextTestRunner().run(suite)
 
 
-if __name__ == '__main__':
-
+def add_database_arguments(parser):
+    ''' Add default arguments for each module (database configuration). '''
+
+    # Models are imported here rather than at the top of this file so that `--help` and
+    # the subcommands that aren't being run don't need to load them.
+    from models import SQLITE_PROFILES
+
+    parser.add_argument(
+        '--db',
+        default='sqlite',
+        help="which type of database to use (postgres, sqlite). Defaults to sqlite."
+    )
+    parser.add_argument(
+        '--db-config',
+        help="Name of file containing database configuration."
+    )
+    parser.add_argument(
+        '--db-profile',
+        choices=sorted(SQLITE_PROFILES.keys()),
+        help="Performance profile for SQLite databases. 'bulk-load' speeds up large " +
+             "writes, and updates query statistics when the command finishes. 'safe' " +
+             "syncs every commit to disk. Defaults to SQLite's own settings."
+    )
+
+
+def make_parser(argv):
+    '''
+    Build the argument parser for the command line `argv` (excluding the program name).
+    Every module gets a subcommand, but only the module that `argv` selects is imported
+    and has its arguments configured.
+    '''
     parser = argparse.ArgumentParser(description="Manage data for software packages.")
     subparsers = parser.add_subparsers(help="Sub-commands for managing data", dest='command')
+    selected_module = tuple(argv[:2])
 
     for command in COMMANDS:
 
@@ -77,25 +109,19 @@ if __name__ == '__main__':
         command_parser = subparsers.add_parser(command, description=command_spec['description'])
         command_subparsers = command_parser.add_subparsers(help=command_spec['module_help'])
 
-        # Initialize arguments for each module of each command
-        for module in command_spec['modules']:
+        for module_path in command_spec['modules']:
 
             # Create a parser for each low-level module
-            module_basename = module.__name__.split('.')[-1]
+            module_basename = module_path.split('.')[-1]
             module_parser = command_subparsers.add_parser(module_basename)
 
-            # Add default arguments for each fetcher (database configuration)
-            module_parser.add_argument(
-                '--db',
-                default='sqlite',
-                help="which type of database to use (postgres, sqlite). Defaults to sqlite."
-            )
-            module_parser.add_argument(
-                '--db-config',
-                help="Name of file containing database configuration."
-            )
+            # Skip importing modules for all subcommands except for the one being run
+            if selected_module != (command, module_basename):
+                continue
 
             # Each module defines additional arguments
+            module = importlib.import_module(module_path)
+            add_database_arguments(module_parser)
             module.configure_parser(module_parser)
             module_parser.set_defaults(func=module.main)
 
@@ -103,17 +129,33 @@ if __name__ == '__main__':
     test_parser = subparsers.add_parser('tests', description="Run unit tests.")
     test_parser.set_defaults(func=run_tests)
 
+    return parser
+
+
+if __name__ == '__main__':
+
     # Parse arguments
+    parser = make_parser(sys.argv[1:])
     args = parser.parse_args()
 
     # Initialize database
     if args.command != 'tests':
-        init_database(args.db, config_filename=args.db_config)
+
+        from models import create_tables, init_database, optimize_database, Command, \
+            SQLITE_PROFILES
+
+        db_profile = init_database(
+            args.db, config_filename=args.db_config, profile=args.db_profile)
         create_tables()
 
         # Save a record of this command that we can refer back to later if needed
         Command.create(arguments=str(sys.argv))
 
     # Invoke the main program that was specified by the submodule
-    if args.func is not None:
+    if getattr(args, 'func', None) is not None:
         args.func(**vars(args))
+
+    # Some database profiles finish by updating the statistics used to plan queries
+    if args.command != 'tests' and db_profile is not None and \
+            SQLITE_PROFILES[db_profile]['optimize']:
+        optimize_database()
@@ -2,13 +2,32 @@ from __future__ import unicode_literals
 import logging
 
 from dump.dump import dump_csv
-from models import Post, PostTag
+from models import Post, PostTag, FetchRun
 from peewee import fn
 
 
 RANDOM_RECORD_COUNT = 200
 logger = logging.getLogger('data')
 
+
+def _select_posts(fetch_index):
+    return (
+        Post
+        .select()
+        .where(Post.fetch_index == fetch_index)
+        .order_by(fn.Random())
+        .limit(RANDOM_RECORD_COUNT)
+        )
+
+
+def _select_post_tags(post):
+    return (
+        PostTag
+        .select()
+        .where(PostTag.post == post)
+        )
+
+
 @dump_csv(__name__, column_names=[
     'Question ID', 'Creation Date', 'Title', 'Link', 'Score', 'Answer Count', 'Body Markdown',
     'Tag 1', 'Tag 2', 'Tag 3', 'Tag 4', 'Tag 5'
@@ -16,15 +35,9 @@ logger = logging.getLogger('data')
 def main(fetch_index, *_, **__):
 
     if fetch_index == -1:
-        fetch_index = Post.select(fn.Max(Post.fetch_index)).scalar()
+        fetch_index = FetchRun.get_latest_index(Post)
 
-    posts = (
-        Post
-        .select()
-        .where(Post.fetch_index == fetch_index)
-        .order_by(fn.Random())
-        .limit(RANDOM_RECORD_COUNT)
-        )
+    posts = _select_posts(fetch_index)
 
     for post in posts:
 
@@ -38,11 +51,7 @@ def main(fetch_index, *_, **__):
             post.body_markdown,
             ]
 
-        post_tags = (
-            PostTag
-            .select()
-            .where(PostTag.post == post)
-            )
+        post_tags = _select_post_tags(post)
         for post_tag in post_tags:
             record.append(post_tag.tag_name)
 
@@ -51,6 +60,14 @@ def main(fetch_index, *_, **__):
     raise StopIteration
 
 
+def explain_queries():
+    ''' The main queries of this module, for checking their query plans. '''
+    return [
+        ("random posts in a fetch index", _select_posts(1)),
+        ("tags of a post", _select_post_tags(1)),
+    ]
+
+
 def configure_parser(parser):
     parser.description = "Dump random subset of Stack Overflow posts."
     parser.add_argument(
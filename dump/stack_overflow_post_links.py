@@ -2,26 +2,47 @@ from __future__ import unicode_literals
 import logging
 
 from dump.dump import dump_csv
-from models import Post, PostTag, PostLink
+from models import Post, PostTag, PostLink, FetchRun
 from peewee import fn
 
 
 logger = logging.getLogger('data')
 
+
+def _select_posts(fetch_index):
+    return (
+        Post
+        .select()
+        .where(Post.fetch_index == fetch_index)
+        .order_by(fn.Random())
+        )
+
+
+def _select_post_tags(post):
+    return (
+        PostTag
+        .select()
+        .where(PostTag.post == post)
+        )
+
+
+def _select_post_links(post):
+    return (
+        PostLink
+        .select()
+        .where(PostLink.post == post)
+        )
+
+
 @dump_csv(__name__, column_names=[
     'Post ID', 'Link to Post', 'Title', 'Creation Date', 'Score', 'Is Accepted', 'Tags',
     'Outgoing Link', 'Outgoing Link Anchor'], delimiter="\t")
 def main(fetch_index, *_, **__):
 
     if fetch_index == -1:
-        fetch_index = Post.select(fn.Max(Post.fetch_index)).scalar()
+        fetch_index = FetchRun.get_latest_index(Post)
 
-    posts = (
-        Post
-        .select()
-        .where(Post.fetch_index == fetch_index)
-        .order_by(fn.Random())
-        )
+    posts = _select_posts(fetch_index)
 
     for post in posts:
 
@@ -35,19 +56,11 @@ def main(fetch_index, *_, **__):
             post.is_accepted,
             ]
 
-        post_tags = (
-            PostTag
-            .select()
-            .where(PostTag.post == post)
-            )
+        post_tags = _select_post_tags(post)
         tags = "".join(["<" + pt.tag_name + ">" for pt in post_tags])
         base_post_record.append(tags)
 
-        post_links = (
-            PostLink
-            .select()
-            .where(PostLink.post == post)
-            )
+        post_links = _select_post_links(post)
         for post_link in post_links:
             post_record_with_links = base_post_record + [post_link.url, post_link.anchor_text]
             post_records.append(post_record_with_links)
@@ -55,6 +68,15 @@ def main(fetch_index, *_, **__):
         yield post_records
 
 
+def explain_queries():
+    ''' The main queries of this module, for checking their query plans. '''
+    return [
+        ("posts in a fetch index", _select_posts(1)),
+        ("tags of a post", _select_post_tags(1)),
+        ("links of a post", _select_post_links(1)),
+    ]
+
+
 def configure_parser(parser):
     parser.description = "Dump all Stack Overflow posts with one line per tag."
     parser.add_argument(
@@ -5,13 +5,13 @@ from __future__ import unicode_literals
 import logging
 # WARNING: progressbar no longer in use for this repository. Replace with tqdm.
 from progressbar import ProgressBar, Percentage, Bar, ETA, Counter, RotatingMarker
-from bs4 import BeautifulSoup
 from peewee import fn
 import re
 import ast
 
 from models import Post, PostTag, Tag, PostSnippet, SnippetPattern
 from compute._scan import NodeScanner
+from compute._html import parse_html
 
 
 logger = logging.getLogger('data')
@@ -52,7 +52,8 @@ def extract_snippets(patterns, tags, compute_index, lines_of_context, show_progr
     # Note that currently there is some repeated work: each extractor will
     # try to parse all relevant nodes as Python
     for post_index, post in enumerate(posts, start=1):
-        document = BeautifulSoup(post.body, 'html.parser')
+        # Only the tags that the scanners look at are built into the document.
+        document = parse_html(post.body, only_tags=['pre', 'code'])
 
         for snippet_pattern, scanner in pattern_scanner_pairs:
             snippets = scanner.scan(document)
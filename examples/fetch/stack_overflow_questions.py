@@ -3,11 +3,10 @@
 
 from __future__ import unicode_literals
 import logging
-import time
 from peewee import fn
 import datetime
 
-from fetch.api import make_request, default_requests_session
+from fetch.api import make_request, default_requests_session, get_response_data
 from models import QuestionSnapshot, Tag, QuestionSnapshotTag
 
 
@@ -19,9 +18,8 @@ DEFAULT_PARAMS = {
     'filter': '!-NChB-j*JnX7P6Vg_m6ss21bRoVv((_0x',
     'site': 'stackoverflow',
     'key': ')8bWqMwdZLM)87SK8n)LUA((',
-    'page_size': 100,  # the maximum page size
+    'pagesize': 100,  # the maximum page size
 }
-REQUEST_DELAY = 0.1  # The Stack Exchange API requests you don't query more than 30 times / second
 tag_cache = {}  # We avoid querying for tags when we don't need to by keeping them in this cache.
 
 
@@ -88,20 +86,20 @@ def fetch_questions_for_tag(tag, fetch_index):
 
     # We intentionally choose to iterate until the results tell us there are 'no more'.
     # The Stack Exchange API documents tell us that requesting a 'total' from the API
-    # will double the request time, so we don't fetch the total.
+    # will double the request time, so we don't fetch the total.  Requests are paced by
+    # `make_request`'s rate limiter, which keeps to the API's limits.
     more_results = True
     while more_results:
 
         response = make_request(default_requests_session.get, API_URL, params=params)
 
         if response is not None:
-            response_data = response.json()
+            response_data = get_response_data(response)
             for question in response_data['items']:
                 _save_question(question, fetch_index)
 
         # Advance the page if there are more results coming
         more_results = response_data['has_more'] if response is not None else True
-        time.sleep(REQUEST_DELAY)
         params['page'] += 1
 
 
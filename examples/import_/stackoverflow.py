@@ -9,7 +9,7 @@ import os.path
 # WARNING: progressbar no longer in use for this repository. Replace with tqdm.
 from progressbar import ProgressBar, Percentage, Bar, ETA, Counter, RotatingMarker
 
-from models import BatchInserter
+from models import BatchInserter, DEFAULT_BATCH_SIZE
 from models import Post, Tag, PostHistory, PostLink, Vote, Comment, Badge, User
 
 
@@ -48,14 +48,15 @@ def camel_case_to_underscores(string):
         return translated2
 
 
-def main(data_type, data_file, batch_size, show_progress, *args, **kwargs):
+def main(data_type, data_file, batch_size, show_progress, async_writer=False, *args, **kwargs):
     '''
     Parsing procedure is based on a script by a user on the Meta Stack Exchange:
     http://meta.stackexchange.com/questions/28221/scripts-to-convert-data-dump-to-other-formats
     '''
 
     Model = DATA_TYPES[data_type]
-    batch_inserter = BatchInserter(Model, batch_size, fill_missing_fields=True)
+    batch_inserter = BatchInserter(
+        Model, batch_size, fill_missing_fields=True, asynchronous=async_writer)
 
     # Set up progress bar.
     if show_progress:
@@ -109,7 +110,7 @@ def main(data_type, data_file, batch_size, show_progress, *args, **kwargs):
             parent_element.remove(row)
 
     # Insert any remaining data that wasn't in one of the batches
-    batch_inserter.flush()
+    batch_inserter.close()
 
     if show_progress:
         progress_bar.finish()
@@ -129,11 +130,17 @@ def configure_parser(parser):
     parser.add_argument(
         '--batch-size',
         type=int,
-        default=20,
-        help="The number of records to insert at a time. Increasing this value " +
-        "should greatly increase the speed of importing data. " +
-        "The default value %(default)s was chosen to work " +
-        "for all models, for all databases."
+        default=DEFAULT_BATCH_SIZE,
+        help="The number of records to insert in each transaction (default: %(default)s). " +
+        "Records are split into INSERT statements that fit the database's limit on " +
+        "query parameters, so this doesn't need to be tuned for each model or database."
+    )
+    parser.add_argument(
+        '--async-writer',
+        action='store_true',
+        help="Save batches from a separate thread, so the file is read while batches are " +
+        "saved.  With SQLite, this needs a database file, and works best with the " +
+        "bulk-load profile (WAL mode)."
     )
     parser.add_argument(
         '--show-progress',
@@ -0,0 +1,74 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+import importlib
+import re
+from peewee import SqliteDatabase
+
+from models import db_proxy
+
+
+logger = logging.getLogger('data')
+
+# Modules that define an `explain_queries` function.  This function takes no arguments, and
+# returns a list of (description, query) pairs for the queries that the module runs most.
+QUERY_MODULES = [
+    'compute.stack_overflow_post_links',
+    'dump.random_posts',
+    'dump.stack_overflow_post_links',
+    'fetch.mendeley_annotations',
+    'fetch.mendeley_documents',
+    'fetch.stack_overflow_post_bodies',
+    'fetch.stack_overflow_posts',
+]
+
+# Lines of a query plan that show that every row of a table is read.
+# SQLite describes these as "SCAN TABLE <table>" (or "SCAN <table>" after version 3.36),
+# without an index.  Postgres describes them as "Seq Scan on <table>".
+SQLITE_FULL_SCAN_PATTERN = re.compile(r'^SCAN (TABLE )?\w+( AS \w+)?$')
+POSTGRES_FULL_SCAN_PATTERN = re.compile(r'Seq Scan on ')
+
+
+def get_query_plan(query):
+    ''' Get the lines of the plan that the database would use to run a query. '''
+    sql, params = query.sql()
+    if isinstance(db_proxy.obj, SqliteDatabase):
+        cursor = db_proxy.execute_sql('EXPLAIN QUERY PLAN ' + sql, params)
+        return [row[-1] for row in cursor.fetchall()]
+    cursor = db_proxy.execute_sql('EXPLAIN ' + sql, params)
+    return [row[0] for row in cursor.fetchall()]
+
+
+def find_full_scans(plan):
+    ''' Get the lines from a query plan that describe full table scans. '''
+    if isinstance(db_proxy.obj, SqliteDatabase):
+        pattern = SQLITE_FULL_SCAN_PATTERN
+    else:
+        pattern = POSTGRES_FULL_SCAN_PATTERN
+    return [line for line in plan if pattern.search(line.strip())]
+
+
+def main(*args, **kwargs):  # pylint: disable=unused-argument
+
+    full_scan_count = 0
+    for module_name in QUERY_MODULES:
+        module = importlib.import_module(module_name)
+        for description, query in module.explain_queries():
+
+            plan = get_query_plan(query)
+            logger.info("%s (%s):\n    %s", module_name, description, "\n    ".join(plan))
+
+            for line in find_full_scans(plan):
+                logger.warning("Full scan in %s (%s): %s", module_name, description, line)
+                full_scan_count += 1
+
+    if full_scan_count > 0:
+        raise SystemExit("Found %d full table scans in the checked queries." % full_scan_count)
+
+
+def configure_parser(parser):
+    parser.description = (
+        "Show the plans the database uses for each module's main queries, and report " +
+        "any full table scans. Exits with an error if there are full scans.")
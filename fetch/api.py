@@ -3,58 +3,705 @@
 
 from __future__ import unicode_literals
 import requests
+import asyncio
+import concurrent.futures
+import datetime
+import email.utils
+import functools
+import hashlib
+import json
 import logging
+import random
+import sqlite3
+import threading
 import time
 import re
+from urllib.parse import urlsplit, urlencode
 
 
 logger = logging.getLogger('data')
 
 
 USER_AGENT = "Andrew Head (for academic research) <andrewhead@eecs.berekeley.edu>"
-default_requests_session = requests.Session()
-default_requests_session.headers['User-Agent'] = USER_AGENT
+DEFAULT_CONCURRENCY = 8  # The default number of requests to keep in flight at once
 
 
-def make_request(method, *args, **kwargs):
+def make_requests_session(pool_size=DEFAULT_CONCURRENCY):
+    '''
+    Make a session for requests to our APIs.  The session keeps up to `pool_size`
+    connections alive to each host, so that concurrent requests can reuse them.
+    '''
+    session = requests.Session()
+    session.headers['User-Agent'] = USER_AGENT
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+default_requests_session = make_requests_session()
+
+# The maximum sustained number of requests per second we make to each API host.
+# The Stack Exchange API asks that clients make no more than 30 requests per second.
+HOST_RATES = {
+    'api.stackexchange.com': 25,
+    'api.mendeley.com': 10,
+}
+
+# Hosts whose JSON responses include the Stack Exchange API's "backoff" and "quota_remaining"
+# fields. See https://api.stackexchange.com/docs/throttle.
+STACK_EXCHANGE_HOSTS = ['api.stackexchange.com']
+
+# When a host's remaining daily quota drops below LOW_QUOTA, requests to it are slowed down in
+# proportion to the quota that is left, to no less than MIN_RATE_SCALE of the usual rate.
+LOW_QUOTA = 1000
+MIN_RATE_SCALE = 0.05
+
+
+class RateLimiter(object):
+    '''
+    Limits the rate of requests to each API host, with a token bucket for each host.
+    Call `acquire` before each request, which waits until the request may be made.  For hosts
+    that it `observes`, call `observe` with the data of each response, so the limiter can
+    honor the throttling it asks for.  A limiter can be shared by any number of threads.
+    '''
+
+    def __init__(self, rates=None, burst=1):
+        '''
+        `rates` maps API hosts to the maximum number of requests per second to make to them.
+        Requests to other hosts aren't limited.  `burst` is the number of requests that can
+        be made at once after a host has been idle.
+        '''
+        self.rates = dict(HOST_RATES if rates is None else rates)
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def _get_bucket(self, host):
+        if host not in self.buckets:
+            self.buckets[host] = {
+                'tokens': float(self.burst),
+                'updated': time.time(),
+                'blocked_until': 0,
+                'rate_scale': 1.0,
+            }
+        return self.buckets[host]
+
+    def acquire(self, url):
+        ''' Wait until a request can be made to the host of a URL. '''
+        host = urlsplit(url).netloc
+        if self.rates.get(host) is None:
+            return
+
+        while True:
+            with self.lock:
+                bucket = self._get_bucket(host)
+                rate = self.rates[host] * bucket['rate_scale']
+
+                # Refill the bucket for the time that has passed since it was last used
+                now = time.time()
+                bucket['tokens'] = min(
+                    float(self.burst), bucket['tokens'] + (now - bucket['updated']) * rate)
+                bucket['updated'] = now
+
+                if now < bucket['blocked_until']:
+                    wait_time = bucket['blocked_until'] - now
+                elif bucket['tokens'] >= 1:
+                    bucket['tokens'] -= 1
+                    return
+                else:
+                    wait_time = (1 - bucket['tokens']) / rate
+
+            time.sleep(wait_time)
+
+    def observes(self, url):
+        ''' Check whether the limiter adjusts its limit for a URL's host based on responses. '''
+        return urlsplit(url).netloc in STACK_EXCHANGE_HOSTS
+
+    def observe(self, url, response_data):
+        '''
+        Adjust the limit for a host based on the parsed JSON data of its response.  For the
+        Stack Exchange API, wait for as long as the "backoff" field says to, and slow down as
+        the quota runs out.
+        '''
+        host = urlsplit(url).netloc
+        if host not in STACK_EXCHANGE_HOSTS or not isinstance(response_data, dict):
+            return
+
+        with self.lock:
+            bucket = self._get_bucket(host)
+
+            backoff = response_data.get('backoff')
+            if backoff is not None:
+                logger.info("API asked us to back off from %s for %d seconds.", host, backoff)
+                bucket['blocked_until'] = max(bucket['blocked_until'], time.time() + backoff)
+
+            quota_remaining = response_data.get('quota_remaining')
+            if quota_remaining is not None:
+                quota_fraction = float(quota_remaining) / LOW_QUOTA
+                bucket['rate_scale'] = max(MIN_RATE_SCALE, min(1.0, quota_fraction))
+
+
+default_rate_limiter = RateLimiter()
+
+DEFAULT_CACHE_FILENAME = 'http-cache.sqlite'
+DEFAULT_CACHE_TTL = 7 * 24 * 60 * 60  # seconds
+DEFAULT_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+# The response cache that `make_request` uses by default, if there is one.
+response_cache_settings = {
+    'cache': None,
+}
+
+
+class ResponseCache(object):
+    '''
+    A cache of successful API responses, saved to an SQLite database on local disk.
+    Responses are keyed by the request method, URL, and query parameters.  Headers aren't
+    part of the key, so that authorization tokens aren't saved in the cache.
+    Responses are fresh for `ttl` seconds.  After that, they are revalidated with the
+    API using their ETag or Last-Modified headers if they have them.  When the cache
+    holds more than `max_bytes` of responses, the least recently used ones are removed.
+    A cache can be shared by any number of threads.
+    '''
+
+    def __init__(self, filename=DEFAULT_CACHE_FILENAME, ttl=DEFAULT_CACHE_TTL,
+                 max_bytes=DEFAULT_CACHE_MAX_BYTES):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS response (
+                key TEXT PRIMARY KEY,
+                url TEXT,
+                status_code INTEGER,
+                headers TEXT,
+                encoding TEXT,
+                content BLOB,
+                size INTEGER,
+                stored REAL,
+                accessed REAL
+            );
+            CREATE INDEX IF NOT EXISTS response_accessed ON response (accessed);
+        ''')
+        self.total_bytes = self.connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM response').fetchone()[0]
+
+    @staticmethod
+    def make_key(method, url, params=None):
+        ''' Make a cache key from a request method (e.g., `session.get`), URL, and params. '''
+        if isinstance(params, dict):
+            params = sorted(params.items())
+        elif params is not None and not isinstance(params, (str, bytes)):
+            params = sorted(params)
+        if params and not isinstance(params, (str, bytes)):
+            params = urlencode(params, doseq=True)
+        key = ' '.join([getattr(method, '__name__', str(method)).upper(), url, params or ''])
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        '''
+        Look up a response.  Returns a pair of the response (or None if there isn't one),
+        and whether the response is fresh enough to use without revalidating it.
+        '''
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT url, status_code, headers, encoding, content, stored ' +
+                'FROM response WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None, False
+
+            url, status_code, headers, encoding, content, stored = row
+            response = requests.Response()
+            response.url = url
+            response.status_code = status_code
+            response.headers = requests.structures.CaseInsensitiveDict(json.loads(headers))
+            response.encoding = encoding
+            response._content = content  # pylint: disable=protected-access
+
+            is_fresh = time.time() - stored < self.ttl
+            if is_fresh:
+                self.hits += 1
+                self._touch(key, refresh=False)
+            return response, is_fresh
+
+    @staticmethod
+    def get_revalidation_headers(response):
+        ''' Get headers that ask the API to only return a response if it has changed. '''
+        headers = {}
+        if 'ETag' in response.headers:
+            headers['If-None-Match'] = response.headers['ETag']
+        if 'Last-Modified' in response.headers:
+            headers['If-Modified-Since'] = response.headers['Last-Modified']
+        return headers
+
+    def revalidated(self, key, was_modified):
+        ''' Record that a stale response was checked with the API. '''
+        with self.lock:
+            if was_modified:
+                self.misses += 1
+            else:
+                self.revalidations += 1
+                self._touch(key, refresh=True)
+
+    def put(self, key, response):
+        content = response.content
+        with self.lock:
+            now = time.time()
+            old_size = self.connection.execute(
+                'SELECT size FROM response WHERE key = ?', (key,)).fetchone()
+            self.connection.execute(
+                'INSERT OR REPLACE INTO response VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+                    key,
+                    response.url,
+                    response.status_code,
+                    json.dumps(dict(response.headers)),
+                    response.encoding,
+                    sqlite3.Binary(content),
+                    len(content),
+                    now,
+                    now,
+                ))
+            self.total_bytes += len(content) - (old_size[0] if old_size else 0)
+            self._evict()
+            self.connection.commit()
+
+    def _touch(self, key, refresh):
+        now = time.time()
+        if refresh:
+            self.connection.execute(
+                'UPDATE response SET accessed = ?, stored = ? WHERE key = ?', (now, now, key))
+        else:
+            self.connection.execute('UPDATE response SET accessed = ? WHERE key = ?', (now, key))
+        self.connection.commit()
+
+    def _evict(self):
+        ''' Remove the least recently used responses until the cache is within its size. '''
+        while self.total_bytes > self.max_bytes:
+            rows = self.connection.execute(
+                'SELECT key, size FROM response ORDER BY accessed LIMIT 100').fetchall()
+            if not rows:
+                break
+            evicted_keys = []
+            for key, size in rows:
+                evicted_keys.append((key,))
+                self.total_bytes -= size
+                if self.total_bytes <= self.max_bytes:
+                    break
+            self.connection.executemany('DELETE FROM response WHERE key = ?', evicted_keys)
+
+    def report(self):
+        logger.info(
+            "HTTP cache: %d hits, %d revalidated, %d misses.",
+            self.hits, self.revalidations, self.misses)
+
+    def close(self):
+        self.connection.close()
+
+
+def use_response_cache(cache):
+    ''' Set the response cache that `make_request` uses by default (or None for no cache). '''
+    response_cache_settings['cache'] = cache
+
+
+class FetchError(Exception):
+    ''' Raised when data can't be fetched from an API, even after retrying. '''
+
+
+DEFAULT_TIMEOUT = 30  # seconds to wait to connect to a host, or for it to send data
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class RetryPolicy(object):
+    '''
+    Decides when and how long to wait before retrying a failed request.  Requests are
+    retried after connection errors, timeouts, and responses with one of
+    `retry_status_codes`.  Waits grow exponentially from `base_delay` up to `max_delay`,
+    with "full jitter" (a random wait between zero and the limit) so that concurrent
+    requests don't retry in lock-step.  If a response has a Retry-After header, the server's
+    wait is used instead, however long it is.  A request is given up on after `max_attempts`
+    attempts, or if waiting to retry it would take it past `deadline` seconds since its
+    first attempt.
+    A policy keeps statistics about the retries it has made, and can be shared by any
+    number of threads.
+    '''
+
+    def __init__(self, max_attempts=5, base_delay=1, max_delay=60, timeout=DEFAULT_TIMEOUT,
+                 deadline=300, retry_status_codes=RETRY_STATUS_CODES):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.deadline = deadline
+        self.retry_status_codes = retry_status_codes
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.lock:
+            self.retries = 0
+            self.failures = 0
+            self.wait_time = 0.0
+
+    def should_retry(self, response):
+        return response.status_code in self.retry_status_codes
+
+    def get_delay(self, attempt, response=None):
+        ''' Get the number of seconds to wait before the `attempt`th retry of a request. '''
+        retry_after = _get_retry_after(response) if response is not None else None
+        if retry_after is not None:
+            # Retrying any sooner would only be refused again, so the wait isn't capped.
+            return retry_after
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def wait(self, delay):
+        with self.lock:
+            self.retries += 1
+            self.wait_time += delay
+        time.sleep(delay)
+
+    def give_up(self):
+        with self.lock:
+            self.failures += 1
+
+    def report(self):
+        logger.info(
+            "Retried %d requests (%.1f s waiting), and gave up on %d requests.",
+            self.retries, self.wait_time, self.failures)
+
+
+default_retry_policy = RetryPolicy()
+
+
+def _get_retry_after(response):
+    ''' Get the number of seconds a response's Retry-After header asks us to wait, if any. '''
+    retry_after = response.headers.get('Retry-After')
+    if retry_after is None:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        retry_time = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_time.timestamp() - time.time())
+
+
+# Fixture files that `make_request` records responses to, and hosts whose requests
+# it sends somewhere else (e.g., to a server that replays fixtures).
+fixture_settings = {
+    'recorder': None,
+    'host_overrides': {},
+}
+
+# Response headers that aren't recorded, because they describe how the response was sent
+# rather than what it is, or because they are private.
+UNRECORDED_HEADERS = [
+    'connection', 'content-encoding', 'content-length', 'set-cookie', 'transfer-encoding',
+]
+
+
+class FixtureRecorder(object):
+    '''
+    Records API responses to a fixture file, so they can be replayed later without the API
+    (see `benchmarks.replay_server`).  Each line of the file is a JSON object with a response's
+    method, URL, status code, headers, and body.  Request headers (and so authorization
+    tokens) are never recorded.  A recorder can be shared by any number of threads.
+    '''
+
+    def __init__(self, filename):
+        self.lock = threading.Lock()
+        self.file = open(filename, 'a')
+        self.count = 0
+
+    def record(self, response):
+        fixture = {
+            'method': response.request.method if response.request is not None else 'GET',
+            'url': response.url,
+            'status_code': response.status_code,
+            'headers': dict(
+                (name, value) for name, value in response.headers.items()
+                if name.lower() not in UNRECORDED_HEADERS),
+            'body': response.text,
+        }
+        with self.lock:
+            self.file.write(json.dumps(fixture) + '\n')
+            self.count += 1
+
+    def close(self):
+        logger.info("Recorded %d responses as fixtures.", self.count)
+        self.file.close()
+
+
+def override_hosts(host_overrides):
+    '''
+    Send requests for some hosts to other servers.  `host_overrides` maps host names
+    (e.g., "api.stackexchange.com") to the base URLs to use instead (e.g., "http://localhost:8000").
+    '''
+    fixture_settings['host_overrides'] = dict(host_overrides)
+
 
-    # We read the max_attempts and retry_delay arguments from the kwargs dictionary
+def _override_host(url):
+    host_overrides = fixture_settings['host_overrides']
+    if not host_overrides:
+        return url
+    url_parts = urlsplit(url)
+    if url_parts.netloc not in host_overrides:
+        return url
+    return host_overrides[url_parts.netloc].rstrip('/') + url_parts._replace(
+        scheme='', netloc='').geturl()
+
+
+def _record_fixture(response):
+    recorder = fixture_settings['recorder']
+    if recorder is not None and response is not None and response.status_code == 200:
+        recorder.record(response)
+
+
+def add_request_arguments(parser):
+    ''' Add arguments for caching and recording API responses to a fetching module's parser. '''
+    parser.add_argument(
+        '--http-cache',
+        nargs='?',
+        const=DEFAULT_CACHE_FILENAME,
+        metavar='FILENAME',
+        help="Cache API responses on disk, and reuse them in later runs. Responses are " +
+             "saved to " + DEFAULT_CACHE_FILENAME + " unless you give another file name."
+    )
+    parser.add_argument(
+        '--http-cache-ttl',
+        type=float,
+        default=DEFAULT_CACHE_TTL,
+        help="Number of seconds before cached responses are checked for changes " +
+             "(default: %(default)s)."
+    )
+    parser.add_argument(
+        '--record-fixtures',
+        metavar='FILENAME',
+        help="Append each API response to this file, for replaying in benchmarks."
+    )
+
+
+def configure_requests(main):
+    '''
+    Decorate the `main` method of a fetching module so that, while it runs, API responses
+    are cached and recorded as the arguments from `add_request_arguments` ask.  The cache's
+    hits and misses, and the number of retried requests, are logged at the end of the run.
+    '''
+    @functools.wraps(main)
+    def main_with_requests_configured(*args, **kwargs):
+
+        cache = None
+        if kwargs.get('http_cache') is not None:
+            cache = ResponseCache(
+                kwargs['http_cache'], ttl=kwargs.get('http_cache_ttl', DEFAULT_CACHE_TTL))
+            use_response_cache(cache)
+
+        recorder = None
+        if kwargs.get('record_fixtures') is not None:
+            recorder = FixtureRecorder(kwargs['record_fixtures'])
+            fixture_settings['recorder'] = recorder
+
+        default_retry_policy.reset_stats()
+        try:
+            return main(*args, **kwargs)
+        finally:
+            default_retry_policy.report()
+            if cache is not None:
+                use_response_cache(None)
+                cache.report()
+                cache.close()
+            if recorder is not None:
+                fixture_settings['recorder'] = None
+                recorder.close()
+
+    return main_with_requests_configured
+
+
+def make_request(method, *args, **kwargs):
+    '''
+    Make a request with `method`, a bound method of a session (e.g., `session.get`).
+    Requests are rate-limited, cached, and retried as described in this module.
+    Returns the response, or None if the request failed every time it was tried.
+    '''
+    # We read the retry_policy and other options from the kwargs dictionary
     # instead of named kwargs because we want to preserve the order of the
     # "request" method's positional arguments for clients of this method.
-    max_attempts = kwargs.get('max_attempts', 2)
-    retry_delay = kwargs.get('retry_delay', 10)
+    retry_policy = kwargs.pop('retry_policy', default_retry_policy)
+    rate_limiter = kwargs.pop('rate_limiter', default_rate_limiter)
+    response_cache = kwargs.pop('response_cache', response_cache_settings['cache'])
+    url = args[0] if args else kwargs.get('url')
 
-    try_again = True
-    attempts = 0
-    res = None
+    # Use a cached response if there's a fresh one.  If there's a stale one, ask the API
+    # to only send the response again if it has changed.
+    cache_key = None
+    cached_response = None
+    if response_cache is not None and url is not None:
+        cache_key = response_cache.make_key(method, url, kwargs.get('params'))
+        cached_response, is_fresh = response_cache.get(cache_key)
+        if is_fresh:
+            _record_fixture(cached_response)
+            return cached_response
+        if cached_response is not None:
+            headers = dict(kwargs.get('headers') or {})
+            headers.update(response_cache.get_revalidation_headers(cached_response))
+            kwargs['headers'] = headers
+    ok_status_codes = [200, 304] if cached_response is not None else [200]
+    kwargs.setdefault('timeout', retry_policy.timeout)
+
+    # Requests are rate-limited and cached by their original URL, even if they are sent to
+    # another server.
+    request_args = args
+    request_kwargs = kwargs
+    if url is not None and fixture_settings['host_overrides']:
+        if args:
+            request_args = (_override_host(url),) + args[1:]
+        else:
+            request_kwargs = dict(kwargs, url=_override_host(url))
 
     def log_error(err_msg):
         logger.warning(
             "Error (%s) For API call %s, Args: %s, Kwargs: %s",
-            str(err_msg), str(method), str(args), str(kwargs)
+            str(err_msg), str(method), str(args),
+            str(dict(kwargs, headers='<hidden>') if 'headers' in kwargs else kwargs)
         )
 
-    while try_again and attempts < max_attempts:
+    start_time = time.time()
+    attempts = 0
+    res = None
+    while True:
 
+        failed_response = None
         try:
-            res = method(*args, **kwargs)
-            if hasattr(res, 'status_code') and res.status_code not in [200]:
+            if rate_limiter is not None and url is not None:
+                rate_limiter.acquire(url)
+            res = method(*request_args, **request_kwargs)
+            if rate_limiter is not None and url is not None and rate_limiter.observes(url):
+                rate_limiter.observe(url, _get_response_data_if_any(res))
+            if hasattr(res, 'status_code') and res.status_code not in ok_status_codes:
                 log_error(str(res.status_code))
+                failed_response = res
                 res = None
-            try_again = False
+                if not retry_policy.should_retry(failed_response):
+                    break
+            else:
+                break
         except requests.exceptions.ConnectionError:
             log_error("ConnectionError")
-        except requests.exceptions.ReadTimeout:
-            log_error("ReadTimeout")
+        except requests.exceptions.Timeout:
+            log_error("Timeout")
+        except requests.exceptions.ChunkedEncodingError:
+            log_error("ChunkedEncodingError")
+
+        attempts += 1
+        delay = retry_policy.get_delay(attempts, failed_response)
+        elapsed = time.time() - start_time
+        if attempts >= retry_policy.max_attempts or (
+                retry_policy.deadline is not None and elapsed + delay > retry_policy.deadline):
+            logger.warning("Giving up on API call after %d attempts.", attempts)
+            retry_policy.give_up()
+            break
 
-        if try_again:
-            logger.warning("Waiting %d seconds for before retrying.", int(retry_delay))
-            time.sleep(retry_delay)
-            attempts += 1
+        logger.warning("Waiting %.1f seconds before retrying.", delay)
+        retry_policy.wait(delay)
 
+    if cache_key is not None and res is not None:
+        if cached_response is not None:
+            response_cache.revalidated(cache_key, was_modified=res.status_code != 304)
+        if res.status_code == 304:
+            res = cached_response
+        else:
+            response_cache.put(cache_key, res)
+
+    _record_fixture(res)
     return res
 
 
+def get_response_data(response):
+    '''
+    Get the data from a JSON response.  The data is parsed only once, and kept with the
+    response, so that `make_request` and its caller don't both parse it.
+    '''
+    if getattr(response, 'parsed_data', None) is None:
+        response.parsed_data = response.json()
+    return response.parsed_data
+
+
+def _get_response_data_if_any(response):
+    if not hasattr(response, 'json'):
+        return None
+    try:
+        return get_response_data(response)
+    except ValueError:
+        return None
+
+
+class AsyncRequester(object):
+    '''
+    Makes many HTTP requests at once, from asyncio code or from synchronous code.
+    Each request is made with `make_request`, so it is retried in the same way, on one of
+    `concurrency` worker threads.  All requests share one session, which keeps a
+    connection alive for each worker.  Close the requester when you're done with it,
+    or use it as a context manager.
+    '''
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, session=None):
+        self.concurrency = concurrency
+        self.session = session if session is not None else make_requests_session(concurrency)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+        self.loop = asyncio.new_event_loop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    async def request(self, method, *args, **kwargs):
+        '''
+        Make a request with `method`, a bound method of a session (e.g., `session.get`),
+        from a worker thread.  Returns the same thing that `make_request` does.
+        '''
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(make_request, method, *args, **kwargs))
+
+    async def get(self, *args, **kwargs):
+        return await self.request(self.session.get, *args, **kwargs)
+
+    def run(self, coroutine):
+        ''' Run a coroutine from synchronous code, returning its result. '''
+        return self.loop.run_until_complete(coroutine)
+
+    def run_all(self, coroutines):
+        '''
+        Run coroutines concurrently from synchronous code.
+        Returns a list of their results, in the same order as the coroutines.
+        '''
+        async def run_all():
+            return await asyncio.gather(*coroutines)
+        return self.run(run_all())
+
+    def get_all(self, request_list):
+        '''
+        Make GET requests concurrently from synchronous code.  `request_list` is a list of
+        (url, kwargs) pairs.  Returns a list of responses in the same order as the requests.
+        '''
+        return self.run_all([self.get(url, **kwargs) for url, kwargs in request_list])
+
+    def close(self):
+        self.executor.shutdown()
+        self.loop.close()
+
+
 def _get_mendeley_item_count(response):
     '''
     Returns and integer if a count was found, otherwise returns None.
@@ -74,6 +721,15 @@ def _get_mendeley_item_count(response):
     return count_int
 
 
+def _format_mendeley_time(local_datetime):
+    '''
+    Format a datetime for the Mendeley API's `modified_since` and `deleted_since` params.
+    Our records are dated in local time, and the API expects UTC.
+    '''
+    utc_datetime = local_datetime.astimezone(datetime.timezone.utc)
+    return utc_datetime.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
 def _get_next_page_url(response):
 
     # If there is no "Link" header, then there is no next page
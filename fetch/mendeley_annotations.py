@@ -1,10 +1,12 @@
+import asyncio
+import datetime
 import logging
-import time
-from peewee import fn
 from tqdm import tqdm
 
-from fetch.api import make_request, default_requests_session, _get_next_page_url
-from models import MendeleyDocument, MendeleyAnnotation
+from fetch.api import AsyncRequester, DEFAULT_CONCURRENCY, _format_mendeley_time, \
+    _get_next_page_url, add_request_arguments, configure_requests, FetchError
+from models import MendeleyDocument, MendeleyAnnotation, FetchRun, db_proxy, insert_rows, \
+    fetch_run
 
 
 logger = logging.getLogger('data')
@@ -12,17 +14,19 @@ API_URL = "https://api.mendeley.com/annotations"
 DEFAULT_PARAMS = {
     'limit': 200,  # the maximum number of annotations that can be fetched at once
 }
-REQUEST_DELAY = 0.1
+REORDER_LIMIT = 64  # Maximum number of documents fetched ahead of the next one to save
+WRITE_BATCH_SIZE = 1000  # Number of annotations to save in each transaction
 
 
-def _save_annotation(document, annotation, fetch_index):
+def _make_annotation_row(document, annotation, fetch_index):
+    ''' Make a row for saving an annotation, or return None if it can't be saved. '''
 
     annotation_id = annotation['id']
 
     left = top = right = bottom = None
     if not annotation['positions']:
         logger.warning("Annotation %s does not have any positions. Not saving.", annotation_id)
-        return
+        return None
     if len(annotation['positions']) > 1:
         logger.warning(
             "Annotation %s has more than one position. Saving first position.", annotation_id)
@@ -34,9 +38,9 @@ def _save_annotation(document, annotation, fetch_index):
     bottom = position['bottom_right']['y']
     page = position['page']
 
-    MendeleyAnnotation.create(
+    return dict(
         fetch_index=fetch_index,
-        document=document,
+        document=document.id,
         annotation_id=annotation_id,
         type=annotation['type'],
         text=annotation.get('text', 'no text'),
@@ -48,11 +52,8 @@ def _save_annotation(document, annotation, fetch_index):
     )
 
 
-def fetch_annotations(fetch_index, token, document):
-
-    # Prepare initial API query parameters
-    params = DEFAULT_PARAMS.copy()
-    params['document_id'] = document.document_id
+async def _fetch_annotation_pages(requester, token, params, description):
+    ''' Fetch pages of annotations, yielding the annotations on each page as a list. '''
 
     # Prepare the request authorization
     headers = {'Authorization': 'Bearer ' + token}
@@ -60,41 +61,306 @@ def fetch_annotations(fetch_index, token, document):
     next_page_url = API_URL
     while next_page_url is not None:
 
-        response = make_request(
-            default_requests_session.get, next_page_url, params=params, headers=headers)
+        response = await requester.get(next_page_url, params=params, headers=headers)
+        if response is None:
+            raise FetchError("Could not fetch annotations %s." % description)
+
+        yield response.json()
+
+        # Advance to the next page of results
+        next_page_url = _get_next_page_url(response)
+
+
+async def fetch_annotations(requester, token, document):
+    ''' Fetch all of the annotations for a document, returning them as a list. '''
 
-        if response is not None:
-            annotations = response.json()
+    # Prepare initial API query parameters
+    params = DEFAULT_PARAMS.copy()
+    params['document_id'] = document.document_id
+
+    annotations = []
+    description = "for document %s" % document.document_id
+    async for page in _fetch_annotation_pages(requester, token, params, description):
+        annotations.extend(page)
+    return annotations
 
-            # Save records for each annotation
-            for annotation in annotations:
-                _save_annotation(document, annotation, fetch_index)
 
-            time.sleep(REQUEST_DELAY)
+async def fetch_all_annotations(requester, token, documents):
+    '''
+    Fetch the annotations for many documents, yielding (document, annotations) pairs in the
+    same order as the documents.  Up to `requester.concurrency` documents are fetched at
+    once, and each time one finishes, the next one is started.  Documents that finish
+    before the ones ahead of them wait to be yielded, and no more than REORDER_LIMIT
+    documents are started ahead of the next one to be yielded.
+    '''
+    concurrency = requester.concurrency
+    reorder_limit = max(REORDER_LIMIT, concurrency)
+    tasks = {}
+    results = {}
+    next_start_index = 0
+    next_yield_index = 0
 
-            # Advance to the next page of results
-            next_page_url = _get_next_page_url(response)
+    try:
+        while next_yield_index < len(documents):
 
+            # Start fetching more documents, up to the limits
+            while (next_start_index < len(documents) and
+                   len(tasks) < concurrency and
+                   next_start_index - next_yield_index < reorder_limit):
+                task = asyncio.ensure_future(
+                    fetch_annotations(requester, token, documents[next_start_index]))
+                tasks[task] = next_start_index
+                next_start_index += 1
 
-def main(token, document_fetch_index, *args, **kwargs):  # pylint: disable=unused-argument
+            done, _ = await asyncio.wait(tasks.keys(), return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                results[tasks.pop(task)] = task.result()
 
-    if document_fetch_index == -1:
-        document_fetch_index = MendeleyDocument.select(
-            fn.Max(MendeleyDocument.fetch_index)).scalar()
+            while next_yield_index in results:
+                yield documents[next_yield_index], results.pop(next_yield_index)
+                next_yield_index += 1
 
-    # Create a new fetch index.
-    last_fetch_index = MendeleyAnnotation.select(
-        fn.Max(MendeleyAnnotation.fetch_index)).scalar() or 0
-    fetch_index = last_fetch_index + 1
+    finally:
+        for task in tasks:
+            task.cancel()
 
-    documents = (
+
+def _select_documents(document_fetch_index, after_id=0):
+    return (
         MendeleyDocument
         .select()
         .where(
-            MendeleyDocument.fetch_index == document_fetch_index
-        ))
-    for document in tqdm(documents):
-        fetch_annotations(fetch_index, token, document)
+            (MendeleyDocument.fetch_index == document_fetch_index) &
+            (MendeleyDocument.id > after_id) &
+            MendeleyDocument.deletion_date.is_null()
+        )
+        .order_by(MendeleyDocument.id))
+
+
+def _select_annotations_by_id(fetch_index, annotation_ids):
+    return (
+        MendeleyAnnotation
+        .select(MendeleyAnnotation.id, MendeleyAnnotation.annotation_id)
+        .where(
+            (MendeleyAnnotation.fetch_index == fetch_index) &
+            (MendeleyAnnotation.annotation_id << annotation_ids))
+        )
+
+
+def explain_queries():
+    ''' The main queries of this module, for checking their query plans. '''
+    return [
+        ("documents in a fetch index", _select_documents(1)),
+        ("annotations in a fetch index by ID", _select_annotations_by_id(1, ['a', 'b'])),
+    ]
+
+
+async def save_all_annotations(requester, token, documents, run, document_fetch_index):
+    '''
+    Fetch and save the annotations for documents into the fetch index of a run.  Annotations
+    are saved in batches of about WRITE_BATCH_SIZE, each with a checkpoint that records
+    the last document saved, so that an interrupted fetch can be resumed from the next one.
+    '''
+    progress_bar = tqdm(total=len(documents))
+    annotation_rows = []
+    last_document = None
+
+    def save_rows():
+        with db_proxy.atomic():
+            insert_rows(MendeleyAnnotation, annotation_rows)
+            run.checkpoint({
+                'document_fetch_index': document_fetch_index,
+                'last_document_id': last_document.id,
+            }, run.row_count + len(annotation_rows))
+        del annotation_rows[:]
+
+    async for document, annotations in fetch_all_annotations(requester, token, documents):
+        for annotation in annotations:
+            row = _make_annotation_row(document, annotation, run.fetch_index)
+            if row is not None:
+                annotation_rows.append(row)
+        last_document = document
+        if len(annotation_rows) >= WRITE_BATCH_SIZE:
+            save_rows()
+        progress_bar.update()
+
+    if last_document is not None:
+        save_rows()
+    progress_bar.close()
+
+
+def _upsert_annotations(annotation_rows, fetch_index):
+    '''
+    Save annotations to a snapshot that may already have some of them.  Annotations already
+    in the snapshot are updated, and un-deleted if they were deleted.  The rest are inserted.
+    Call this within a transaction.  Returns the number of annotations inserted.
+    '''
+    if not annotation_rows:
+        return 0
+
+    existing_ids = dict(
+        (annotation.annotation_id, annotation.id) for annotation in
+        _select_annotations_by_id(fetch_index, [row['annotation_id'] for row in annotation_rows]))
+
+    new_annotation_rows = []
+    for row in annotation_rows:
+        existing_id = existing_ids.get(row['annotation_id'])
+        if existing_id is None:
+            new_annotation_rows.append(row)
+            continue
+        (MendeleyAnnotation
+         .update(deletion_date=None, **row)
+         .where(MendeleyAnnotation.id == existing_id)
+         .execute())
+
+    return len(insert_rows(MendeleyAnnotation, new_annotation_rows))
+
+
+def _mark_annotations_deleted(annotation_ids, fetch_index, deletion_date):
+    ''' Mark annotations in a snapshot as deleted.  Returns the number of annotations marked. '''
+    if not annotation_ids:
+        return 0
+    return (
+        MendeleyAnnotation
+        .update(deletion_date=deletion_date)
+        .where(
+            (MendeleyAnnotation.fetch_index == fetch_index) &
+            (MendeleyAnnotation.annotation_id << annotation_ids) &
+            MendeleyAnnotation.deletion_date.is_null())
+        .execute())
+
+
+def _get_document_fetch_index(run):
+    ''' Get the fetch index of the documents that a run fetched annotations for. '''
+    cursor = run.get_cursor()
+    if cursor is not None:
+        return cursor['document_fetch_index']
+    # Runs from before checkpoints were saved are found through their annotations.
+    document_fetch_index = (
+        MendeleyDocument
+        .select(MendeleyDocument.fetch_index)
+        .join(MendeleyAnnotation)
+        .where(MendeleyAnnotation.fetch_index == run.fetch_index)
+        .limit(1)
+        .scalar())
+    if document_fetch_index is None:
+        raise FetchError((
+            "Can't find the fetch of documents that annotation fetch %d was made from, " +
+            "as it has no annotations.  Fetch all annotations again instead.") % run.fetch_index)
+    return document_fetch_index
+
+
+async def sync_annotations(requester, token, run, group_id=None):
+    '''
+    Add the changes to annotations since a run's last sync (or since the run started, if it
+    hasn't been synced) to the run's snapshot.  Only annotations on documents in the run's
+    fetch of documents that haven't been deleted are kept.  All annotations are fetched for
+    documents that were added to that fetch since the last sync.  Changed annotations are
+    updated, and deleted ones are marked with a deletion date.  Returns the number of
+    annotations added.
+    '''
+    sync_started = datetime.datetime.now()
+    since_date = run.synced or run.started
+    logger.info("Syncing changes to annotations since %s.", since_date)
+
+    documents = list(_select_documents(_get_document_fetch_index(run)))
+    documents_by_id = dict((document.document_id, document) for document in documents)
+    added_count = 0
+
+    def save_rows(annotation_rows):
+        with db_proxy.atomic():
+            page_added_count = _upsert_annotations(annotation_rows, run.fetch_index)
+            run.row_count += page_added_count
+            run.finished = datetime.datetime.now()
+            run.save()
+        return page_added_count
+
+    # Fetch all annotations for documents that are new since the last sync, as their
+    # annotations may be older than the last sync.
+    new_documents = [document for document in documents if document.date > since_date]
+    annotation_rows = []
+    async for document, annotations in fetch_all_annotations(requester, token, new_documents):
+        for annotation in annotations:
+            row = _make_annotation_row(document, annotation, run.fetch_index)
+            if row is not None:
+                annotation_rows.append(row)
+        if len(annotation_rows) >= WRITE_BATCH_SIZE:
+            added_count += save_rows(annotation_rows)
+            annotation_rows = []
+    added_count += save_rows(annotation_rows)
+
+    params = DEFAULT_PARAMS.copy()
+    if group_id is not None:
+        params['group_id'] = group_id
+
+    # Update annotations that have changed, on documents in the fetch of documents
+    modified_params = params.copy()
+    modified_params['modified_since'] = _format_mendeley_time(since_date)
+    modified_pages = _fetch_annotation_pages(
+        requester, token, modified_params, "modified since %s" % since_date)
+    async for annotations in modified_pages:
+        annotation_rows = []
+        for annotation in annotations:
+            document = documents_by_id.get(annotation.get('document_id'))
+            if document is None:
+                continue
+            row = _make_annotation_row(document, annotation, run.fetch_index)
+            if row is not None:
+                annotation_rows.append(row)
+        added_count += save_rows(annotation_rows)
+
+    # Mark deleted annotations
+    deleted_params = params.copy()
+    deleted_params['deleted_since'] = _format_mendeley_time(since_date)
+    deleted_pages = _fetch_annotation_pages(
+        requester, token, deleted_params, "deleted since %s" % since_date)
+    deleted_count = 0
+    async for annotations in deleted_pages:
+        deleted_count += _mark_annotations_deleted(
+            [annotation['id'] for annotation in annotations], run.fetch_index, sync_started)
+
+    # Only move the sync time forward once all changes have been saved, so that a sync
+    # that stops early is repeated in full by the next one.
+    run.synced = sync_started
+    run.save()
+
+    logger.info(
+        "Added %d annotations to fetch %d, and marked %d as deleted.",
+        added_count, run.fetch_index, deleted_count)
+    return added_count
+
+
+@configure_requests
+def main(token, document_fetch_index, concurrency, resume, incremental, group_id, *_, **__):
+
+    # Add changes to the latest snapshot if syncing it incrementally.
+    if incremental:
+        latest_run = FetchRun.get_latest_run(MendeleyAnnotation)
+        if latest_run is not None:
+            with AsyncRequester(concurrency) as requester:
+                requester.run(sync_annotations(requester, token, latest_run, group_id))
+            return
+        logger.warning("No finished fetch of annotations to sync. Fetching all annotations.")
+
+    # Create a new fetch index, or continue the last one if resuming.
+    with fetch_run(MendeleyAnnotation, __name__, resume=resume) as run, \
+            AsyncRequester(concurrency) as requester:
+
+        # If this run was stopped before, continue after the last document it saved
+        # annotations for, from the same fetch of documents.
+        last_document_id = 0
+        cursor = run.get_cursor()
+        if cursor is not None:
+            document_fetch_index = cursor['document_fetch_index']
+            last_document_id = cursor['last_document_id']
+        elif document_fetch_index == -1:
+            document_fetch_index = FetchRun.get_latest_index(MendeleyDocument)
+            if document_fetch_index is None:
+                raise FetchError("No finished fetch of documents to fetch annotations for.")
+
+        documents = list(_select_documents(document_fetch_index, last_document_id))
+        requester.run(
+            save_all_annotations(requester, token, documents, run, document_fetch_index))
 
 
 def configure_parser(parser):
@@ -112,3 +378,28 @@ def configure_parser(parser):
         default=-1,
         help="Index of Mendeley documents to fetch annotations for. Defaults to most recent."
         )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help="Number of requests for annotations to make at once (default: %(default)s)."
+        )
+    mode_group = parser.add_mutually_exclusive_group()
+    mode_group.add_argument(
+        "--resume",
+        action='store_true',
+        help="Continue the last fetch from where it stopped, if it didn't finish."
+        )
+    mode_group.add_argument(
+        "--incremental",
+        action='store_true',
+        help=(
+            "Instead of fetching all annotations to a new fetch index, add annotations " +
+            "added or changed since the last fetch or sync to its fetch index, and mark " +
+            "annotations deleted since then as deleted."
+            ))
+    parser.add_argument(
+        "--group-id",
+        help="With --incremental, only ask for changes to annotations in this Mendeley group."
+        )
+    add_request_arguments(parser)
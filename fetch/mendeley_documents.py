@@ -1,11 +1,11 @@
+import datetime
 import logging
-import time
-from peewee import fn
 from tqdm import tqdm
 
 from fetch.api import make_request, default_requests_session, _get_mendeley_item_count, \
-    _get_next_page_url
-from models import MendeleyDocument
+    _get_next_page_url, _format_mendeley_time, add_request_arguments, configure_requests, \
+    FetchError
+from models import MendeleyDocument, FetchRun, db_proxy, insert_rows, fetch_run
 
 
 logger = logging.getLogger('data')
@@ -13,67 +13,194 @@ API_URL = "https://api.mendeley.com/documents"
 DEFAULT_PARAMS = {
     'limit': 500,  # the maximum number of documents
 }
-REQUEST_DELAY = 0.1
 
 
-def _save_document(document, fetch_index):
-    MendeleyDocument.create(
-        fetch_index=fetch_index,
-        title=document['title'],
-        document_id=document['id'],
-    )
+def _make_document_row(document, fetch_index):
+    return {
+        'fetch_index': fetch_index,
+        'document_id': document['id'],
+    }
 
 
-def fetch_documents(fetch_index, token, group_id):
-
-    # Prepare initial API query parameters
-    params = DEFAULT_PARAMS.copy()
-    params['group_id'] = group_id
-
+def _fetch_document_pages(token, params, next_page_url=API_URL):
+    '''
+    Fetch pages of documents, starting from `next_page_url`.  Yields the response for each
+    page, the page's documents, and the URL of the next page (None after the last page).
+    '''
     # Prepare the request authorization
     headers = {'Authorization': 'Bearer ' + token}
 
-    next_page_url = API_URL
-
-    first_iteration = True
-    progress_bar = None
     while next_page_url is not None:
 
         response = make_request(
             default_requests_session.get, next_page_url, params=params, headers=headers)
+        if response is None:
+            raise FetchError("Could not fetch documents from %s." % next_page_url)
 
-        if response is not None:
-            documents = response.json()
+        # Advance to the next page of results
+        next_page_url = _get_next_page_url(response)
 
-            # Create the progress bar if we know the total number of documents
-            item_count = _get_mendeley_item_count(response)
-            if item_count is not None and first_iteration and progress_bar is None:
-                progress_bar = tqdm(total=item_count)
+        yield response, response.json(), next_page_url
 
-            # Save records for each document
-            for document in documents:
-                _save_document(document, fetch_index)
 
-                if progress_bar is not None:
-                    progress_bar.update()
+def fetch_documents(run, token, group_id):
+    '''
+    Fetch a group's documents into the fetch index of a run, returning the number of
+    documents saved.  If the run was stopped before, fetching continues from the page
+    after the last one saved.
+    '''
 
-            time.sleep(REQUEST_DELAY)
+    # Prepare initial API query parameters
+    params = DEFAULT_PARAMS.copy()
+    params['group_id'] = group_id
+
+    next_page_url = API_URL
+    document_count = 0
+
+    cursor = run.get_cursor()
+    if cursor is not None:
+        next_page_url = cursor['next_page_url']
+        document_count = run.row_count
 
-            # Advance to the next page of results
-            next_page_url = _get_next_page_url(response)
+    first_iteration = True
+    progress_bar = None
+    pages = _fetch_document_pages(token, params, next_page_url)
+    for response, documents, next_page_url in pages:
+
+        # Create the progress bar if we know the total number of documents
+        item_count = _get_mendeley_item_count(response)
+        if item_count is not None and first_iteration and progress_bar is None:
+            progress_bar = tqdm(total=item_count, initial=document_count)
+
+        # Save records for each document, with a checkpoint so that an interrupted
+        # fetch can be resumed from the next page.
+        with db_proxy.atomic():
+            insert_rows(MendeleyDocument, [
+                _make_document_row(document, run.fetch_index) for document in documents])
+            document_count += len(documents)
+            run.checkpoint({'next_page_url': next_page_url}, document_count)
+
+        if progress_bar is not None:
+            progress_bar.update(len(documents))
 
         first_iteration = False
 
     if progress_bar is not None:
         progress_bar.close()
 
+    return document_count
+
+
+def _upsert_documents(documents, fetch_index):
+    '''
+    Save a page of documents to a snapshot that may already have some of them.  Documents
+    already in the snapshot are un-deleted if they were deleted.  The rest are inserted.
+    Call this within a transaction.  Returns the number of documents inserted.
+    '''
+    document_ids = [document['id'] for document in documents]
+    if not document_ids:
+        return 0
+
+    existing_document_ids = set(
+        document.document_id for document in _select_documents_by_id(fetch_index, document_ids))
+    if existing_document_ids:
+        (MendeleyDocument
+         .update(deletion_date=None)
+         .where(
+             (MendeleyDocument.fetch_index == fetch_index) &
+             (MendeleyDocument.document_id << list(existing_document_ids)))
+         .execute())
+
+    return len(insert_rows(MendeleyDocument, [
+        _make_document_row(document, fetch_index) for document in documents
+        if document['id'] not in existing_document_ids]))
+
+
+def _mark_documents_deleted(document_ids, fetch_index, deletion_date):
+    ''' Mark documents in a snapshot as deleted.  Returns the number of documents marked. '''
+    if not document_ids:
+        return 0
+    return (
+        MendeleyDocument
+        .update(deletion_date=deletion_date)
+        .where(
+            (MendeleyDocument.fetch_index == fetch_index) &
+            (MendeleyDocument.document_id << document_ids) &
+            MendeleyDocument.deletion_date.is_null())
+        .execute())
+
+
+def _select_documents_by_id(fetch_index, document_ids):
+    return (
+        MendeleyDocument
+        .select(MendeleyDocument.id, MendeleyDocument.document_id)
+        .where(
+            (MendeleyDocument.fetch_index == fetch_index) &
+            (MendeleyDocument.document_id << document_ids))
+        )
+
+
+def sync_documents(run, token, group_id):
+    '''
+    Add the changes to a group's documents since a run's last sync (or since the run started,
+    if it hasn't been synced) to the run's snapshot.  New documents are added, and deleted
+    documents are marked with a deletion date.  Returns the number of documents added.
+    '''
+    sync_started = datetime.datetime.now()
+    since = _format_mendeley_time(run.synced or run.started)
+    logger.info("Syncing changes to documents since %s.", run.synced or run.started)
+
+    params = DEFAULT_PARAMS.copy()
+    params['group_id'] = group_id
+
+    modified_params = params.copy()
+    modified_params['modified_since'] = since
+    added_count = 0
+    for _, documents, _ in _fetch_document_pages(token, modified_params):
+        with db_proxy.atomic():
+            page_added_count = _upsert_documents(documents, run.fetch_index)
+            added_count += page_added_count
+            run.row_count += page_added_count
+            run.finished = datetime.datetime.now()
+            run.save()
+
+    deleted_params = params.copy()
+    deleted_params['deleted_since'] = since
+    deleted_count = 0
+    for _, documents, _ in _fetch_document_pages(token, deleted_params):
+        deleted_count += _mark_documents_deleted(
+            [document['id'] for document in documents], run.fetch_index, sync_started)
 
-def main(group_id, token, *args, **kwargs):  # pylint: disable=unused-argument
+    # Only move the sync time forward once all changes have been saved, so that a sync
+    # that stops early is repeated in full by the next one.
+    run.synced = sync_started
+    run.save()
 
-    # Create a new fetch index.
-    last_fetch_index = MendeleyDocument.select(fn.Max(MendeleyDocument.fetch_index)).scalar() or 0
-    fetch_index = last_fetch_index + 1
-    fetch_documents(fetch_index, token, group_id)
+    logger.info(
+        "Added %d documents to fetch %d, and marked %d as deleted.",
+        added_count, run.fetch_index, deleted_count)
+    return added_count
+
+
+def explain_queries():
+    ''' The main queries of this module, for checking their query plans. '''
+    return [("documents in a fetch index by ID", _select_documents_by_id(1, ['a', 'b']))]
+
+
+@configure_requests
+def main(group_id, token, resume, incremental, *args, **kwargs):  # pylint: disable=unused-argument
+
+    # Add changes to the latest snapshot if syncing it incrementally.
+    if incremental:
+        latest_run = FetchRun.get_latest_run(MendeleyDocument)
+        if latest_run is not None:
+            sync_documents(latest_run, token, group_id)
+            return
+        logger.warning("No finished fetch of documents to sync. Fetching all documents.")
+
+    # Create a new fetch index, or continue the last one if resuming.
+    with fetch_run(MendeleyDocument, __name__, resume=resume) as run:
+        run.row_count = fetch_documents(run, token, group_id)
 
 
 def configure_parser(parser):
@@ -93,3 +220,18 @@ def configure_parser(parser):
             "Mendeley API token. Generate by following directions from " +
             "https://dev.mendeley.com/getting_started/hello_mendeley.html"
             ))
+    mode_group = parser.add_mutually_exclusive_group()
+    mode_group.add_argument(
+        "--resume",
+        action='store_true',
+        help="Continue the last fetch from where it stopped, if it didn't finish."
+        )
+    mode_group.add_argument(
+        "--incremental",
+        action='store_true',
+        help=(
+            "Instead of fetching all documents to a new fetch index, add documents added " +
+            "or changed since the last fetch or sync to its fetch index, and mark " +
+            "documents deleted since then as deleted."
+            ))
+    add_request_arguments(parser)
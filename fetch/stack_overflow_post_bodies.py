@@ -1,11 +1,11 @@
+import itertools
 import logging
-import math
-import time
-from peewee import fn
 from tqdm import tqdm
 
-from fetch.api import make_request, default_requests_session
-from models import Post
+from fetch.api import AsyncRequester, DEFAULT_CONCURRENCY, add_request_arguments, \
+    configure_requests, get_response_data
+from models import Post, FetchRun, db_proxy, get_batch_query, iterate_batches, \
+    make_body_fields, update_field
 
 
 logger = logging.getLogger('data')
@@ -16,53 +16,158 @@ DEFAULT_PARAMS = {
     'pagesize': '100',
     'key': ')8bWqMwdZLM)87SK8n)LUA((',
 }
-REQUEST_DELAY = 0.05  # The Stack Exchange API requests you don't query more than 30 times / second
 BATCH_SIZE = 100  # Maximum number of posts that can be requested at a time
 
 
-def fetch_post_bodies(fetch_index):
-
+def _select_posts(fetch_index, missing_bodies_only=False):
+    posts = (
+        Post
+        .select(Post.id, Post.post_id)
+        .where(Post.fetch_index == fetch_index)
+        )
+    if missing_bodies_only:
+        posts = posts.where(Post.body_html.is_null() & Post.body_html_hash.is_null())
+    return posts
+
+
+def copy_previous_bodies(fetch_index, match_activity=False):
+    '''
+    Copy HTML bodies to the posts in a fetch index that don't have them yet, from the
+    newest earlier fetch index where the same post has a body.  This is done with one
+    UPDATE statement.  If `match_activity` is true, bodies are only copied if the post's
+    last activity date hasn't changed since the earlier fetch, so that edited posts are
+    fetched again.  If either fetch has no last activity date for the post (for instance,
+    it was fetched before these dates were saved), the post is treated as unchanged.
+    Returns the number of posts that bodies were copied to.
+    '''
+    database = db_proxy.obj
+    quote_char = database.quote_char
+    parameter = database.interpolation
+
+    def quote(name):
+        return quote_char + name + quote_char
+
+    table = quote(Post._meta.db_table)
+    previous_post_condition = (
+        'previous.{post_id} = {table}.{post_id} AND previous.{fetch_index} < {parameter} AND ' +
+        '(previous.{body_html} IS NOT NULL OR previous.{body_html_hash} IS NOT NULL)')
+    if match_activity:
+        # Comparing with NULL is never true, so missing dates are checked for separately.
+        previous_post_condition += (
+            ' AND (previous.{last_activity_date} IS NULL OR ' +
+            '{table}.{last_activity_date} IS NULL OR ' +
+            'previous.{last_activity_date} = {table}.{last_activity_date})')
+
+    def select_previous(column):
+        return (
+            '(SELECT previous.{column} FROM {table} AS previous WHERE ' +
+            previous_post_condition + ' ORDER BY previous.{fetch_index} DESC LIMIT 1)'
+        ).replace('{column}', '{' + column + '}')
+
+    sql_template = (
+        'UPDATE {table} SET {body_html} = ' + select_previous('body_html') + ', ' +
+        '{body_html_hash} = ' + select_previous('body_html_hash') + ' ' +
+        'WHERE {table}.{fetch_index} = {parameter} AND ' +
+        '{table}.{body_html} IS NULL AND {table}.{body_html_hash} IS NULL AND ' +
+        'EXISTS (SELECT 1 FROM {table} AS previous WHERE ' + previous_post_condition + ')'
+    )
+    # Every parameter is the fetch index.  They are counted in the template, where they can't
+    # be confused with text in the names that are filled in.
+    params = [fetch_index] * sql_template.count('{parameter}')
+    sql = sql_template.format(
+        table=table,
+        parameter=parameter,
+        **dict((field.name, quote(field.db_column)) for field in Post._meta.sorted_fields)
+    )
+    with db_proxy.atomic():
+        cursor = db_proxy.execute_sql(sql, params)
+    return cursor.rowcount
+
+
+def _save_post_bodies(post_batch, response, progress_bar):
+    '''
+    Save the bodies from a response for a batch of posts, with one UPDATE for the batch.
+    Only the HTML body and its hash are updated.
+    '''
+    response_data = get_response_data(response)
+    post_body_dict = dict((p['post_id'], p['body']) for p in response_data['items'])
+
+    values_by_field = {}
+    for post in post_batch:
+        if post.post_id in post_body_dict:
+            body_fields = make_body_fields(body_html=post_body_dict[post.post_id])
+            for field_name, value in body_fields.items():
+                values_by_field.setdefault(field_name, {})[post.id] = value
+
+    for field_name, values_by_id in values_by_field.items():
+        update_field(Post, getattr(Post, field_name), values_by_id)
+    progress_bar.update(len(post_batch))
+
+
+def fetch_post_bodies(fetch_index, concurrency=DEFAULT_CONCURRENCY, missing_bodies_only=False):
+    '''
+    Fetch HTML bodies for the posts in a fetch index from the API.  If `missing_bodies_only`
+    is true, only posts that don't have bodies yet are fetched.
+    '''
     # Prepare initial API query parameters
     params = DEFAULT_PARAMS.copy()
 
-    total_posts = Post.select(Post.fetch_index == fetch_index).count()
-    batches = math.ceil(float(total_posts) / BATCH_SIZE)
+    posts = _select_posts(fetch_index, missing_bodies_only)
+    progress_bar = tqdm(total=posts.count())
+    failed_post_count = 0
+
+    # Request the bodies for `concurrency` batches of posts at a time
+    post_batch_iterator = iterate_batches(posts, BATCH_SIZE)
+    with AsyncRequester(concurrency) as requester:
+        while True:
 
-    progress_bar = tqdm(total=total_posts)
+            post_batches = list(itertools.islice(post_batch_iterator, concurrency))
+            if not post_batches:
+                break
 
-    for batch_index in range(1, batches + 1):
+            # To request multiple posts, join their IDs with a semi-colon.
+            responses = requester.get_all([
+                (API_BASE_URL + ";".join([str(p.post_id) for p in post_batch]), {'params': params})
+                for post_batch in post_batches
+            ])
 
-        post_batch = (
-            Post
-            .select()
-            .where(Post.fetch_index == fetch_index)
-            .paginate(batch_index, BATCH_SIZE)
-            )
-        post_ids = [str(p.post_id) for p in post_batch]
+            with db_proxy.atomic():
+                for post_batch, response in zip(post_batches, responses):
+                    if response is not None:
+                        _save_post_bodies(post_batch, response, progress_bar)
+                    else:
+                        failed_post_count += len(post_batch)
 
-        # To request multiple posts, join their IDs with a semi-colon.
-        url = API_BASE_URL + ";".join(post_ids)
-        response = make_request(default_requests_session.get, url, params=params)
+    progress_bar.close()
 
-        if response is not None:
-            response_data = response.json()
-            post_body_dict = dict((p['post_id'], p['body']) for p in response_data['items'])
+    if failed_post_count > 0:
+        logger.warning(
+            "Could not fetch bodies for %d posts. Run this command again to retry them.",
+            failed_post_count)
 
-            for post in post_batch:
-                if post.post_id in post_body_dict:
-                    post.body_html = post_body_dict[post.post_id]
-                    post.save()
-                    progress_bar.update()
 
-            time.sleep(REQUEST_DELAY)
+def explain_queries():
+    ''' The main queries of this module, for checking their query plans. '''
+    return [
+        ("batch of posts in a fetch index", get_batch_query(_select_posts(1), BATCH_SIZE, 1)),
+        ("batch of posts without bodies",
+         get_batch_query(_select_posts(1, missing_bodies_only=True), BATCH_SIZE, 1)),
+    ]
 
-    progress_bar.close()
 
+@configure_requests
+def main(fetch_index, concurrency, reuse_bodies, refetch_changed,
+         *args, **kwargs):  # pylint: disable=unused-argument
 
-def main(fetch_index, *args, **kwargs):  # pylint: disable=unused-argument
     if fetch_index == -1:
-        fetch_index = Post.select(fn.Max(Post.fetch_index)).scalar()
-    fetch_post_bodies(fetch_index)
+        fetch_index = FetchRun.get_latest_index(Post)
+
+    # Copy the bodies we already have from earlier fetches, and only fetch the rest.
+    if reuse_bodies:
+        copied_count = copy_previous_bodies(fetch_index, match_activity=refetch_changed)
+        logger.info("Copied bodies for %d posts from earlier fetches.", copied_count)
+
+    fetch_post_bodies(fetch_index, concurrency, missing_bodies_only=reuse_bodies)
 
 
 def configure_parser(parser):
@@ -73,3 +178,26 @@ def configure_parser(parser):
         default=-1,
         help="Index of fetched posts for which to fetch bodies. Defaults to latest."
         )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help="Number of requests for post bodies to make at once (default: %(default)s)."
+        )
+    parser.add_argument(
+        "--reuse-bodies",
+        action='store_true',
+        help=(
+            "Copy bodies for posts that were fetched before from the latest earlier fetch " +
+            "that has them, and only request bodies for the rest."
+            ))
+    parser.add_argument(
+        "--refetch-changed",
+        action='store_true',
+        help=(
+            "With --reuse-bodies, request bodies again for posts whose last activity date " +
+            "has changed since the earlier fetch.  Posts without a last activity date in " +
+            "either fetch (such as posts fetched before these dates were saved) are treated " +
+            "as unchanged."
+            ))
+    add_request_arguments(parser)
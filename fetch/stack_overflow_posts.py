@@ -1,11 +1,13 @@
 import logging
-import time
 import datetime
-from peewee import fn
+import math
+import time
 from tqdm import tqdm
 
-from fetch.api import make_request, default_requests_session
-from models import Post, PostTag
+from fetch.api import AsyncRequester, DEFAULT_CONCURRENCY, add_request_arguments, \
+    configure_requests, get_response_data, FetchError
+from models import Post, PostTag, FetchRun, db_proxy, fetch_run, hash_content, insert_rows, \
+    make_body_fields, sync_run, update_field
 
 
 logger = logging.getLogger('data')
@@ -18,12 +20,17 @@ DEFAULT_PARAMS = {
     'body': '"this tutorial"',
     'filter': '!S_Vkl7.BKMaT7fJaJ)',
     'key': ')8bWqMwdZLM)87SK8n)LUA((',
-    'page_size': 100,  # the maximum page size
+    'pagesize': 100,  # the maximum page size
 }
-REQUEST_DELAY = 0.05  # The Stack Exchange API requests you don't query more than 30 times / second
+# Fields of a post that are updated when it is fetched again.  Its fetch index and ID don't
+# change, and its HTML body is fetched separately.
+UPDATED_FIELD_NAMES = [
+    'creation_date', 'last_activity_date', 'title', 'score', 'is_accepted', 'body_text',
+    'body_text_hash',
+]
 
 
-def _save_post(post_data, fetch_index):
+def _make_post_row(post_data, fetch_index):
 
     # Dates are returned by the Stack Exchange API in Unix epoch time.
     # This inline method converts the timestamps to datetime objects that
@@ -32,68 +39,335 @@ def _save_post(post_data, fetch_index):
     # UTC times.  I chose to do this as the date of creation of these records
     # will also be in local time.
     timestamp_to_datetime = datetime.datetime.fromtimestamp
+    last_activity_date = None
+    if post_data.get('last_activity_date') is not None:
+        last_activity_date = timestamp_to_datetime(post_data['last_activity_date'])
 
-    # Create a snapshot of this post
-    post = Post.create(
+    # Make a snapshot of this post
+    return dict(
         fetch_index=fetch_index,
         creation_date=timestamp_to_datetime(post_data['creation_date']),
+        last_activity_date=last_activity_date,
         post_id=post_data['answer_id'],
         title=post_data['title'],
-        body_text=post_data['body'],
         score=post_data['score'],
         is_accepted=post_data['is_accepted'],
+        **make_body_fields(body_text=post_data['body'])
     )
 
-    # Link this snapshot to all tags related to it
-    for tag_name in post_data['tags']:
-        PostTag.create(post=post, tag_name=tag_name)
 
+def _save_posts(posts_data, fetch_index):
+    '''
+    Save a page of posts and their tags, with one multi-row INSERT for the posts and one
+    for the tags.  Call this within a transaction.  Returns the number of posts saved.
+    '''
+    post_rows = [_make_post_row(post_data, fetch_index) for post_data in posts_data]
+    post_ids = insert_rows(Post, post_rows)
 
-def fetch_posts(fetch_index):
+    # Link each snapshot to all tags related to it
+    insert_rows(PostTag, [
+        {'post': post_id, 'tag_name': tag_name}
+        for post_id, post_data in zip(post_ids, posts_data)
+        for tag_name in post_data['tags']
+    ])
+    return len(post_ids)
 
-    # Prepare initial API query parameters
-    params = DEFAULT_PARAMS.copy()
-    params['page'] = 1  # paging for Stack Exchange API starts at 1
 
-    # We intentionally choose to iterate until the results tell us there are 'no more'.
-    # The Stack Exchange API documents tell us that requesting a 'total' from the API
-    # will double the request time, so we don't fetch the total.
+def _upsert_posts(posts_data, fetch_index):
+    '''
+    Save a page of posts and their tags to a snapshot that may already have some of them.
+    Posts already in the snapshot are updated, with one UPDATE for each field and one
+    DELETE and INSERT for their tags.  If a post was edited or has new activity, its HTML
+    body is cleared, so that it is fetched again.  The rest are inserted.  Call this within
+    a transaction.  Returns the number of posts inserted.
+    '''
+    if not posts_data:
+        return 0
+
+    post_rows = [_make_post_row(post_data, fetch_index) for post_data in posts_data]
+    existing_posts = dict(
+        (post.post_id, post) for post in
+        _select_posts_by_id(fetch_index, [row['post_id'] for row in post_rows]))
+
+    new_posts_data = []
+    updated_posts = []  # (ID, row, post data) for each post already in the snapshot
+    edited_post_ids = []
+    for post_data, row in zip(posts_data, post_rows):
+        existing_post = existing_posts.get(row['post_id'])
+        if existing_post is None:
+            new_posts_data.append(post_data)
+            continue
+        updated_posts.append((existing_post.id, row, post_data))
+        if (_get_text_hash(existing_post) != row['body_text_hash'] or
+                existing_post.last_activity_date != row['last_activity_date']):
+            edited_post_ids.append(existing_post.id)
+
+    if updated_posts:
+        for field_name in UPDATED_FIELD_NAMES:
+            update_field(Post, getattr(Post, field_name), dict(
+                (post_id, row[field_name]) for post_id, row, _ in updated_posts))
+        if edited_post_ids:
+            (Post
+             .update(body_html=None, body_html_hash=None)
+             .where(Post.id << edited_post_ids)
+             .execute())
+        updated_post_ids = [post_id for post_id, _, _ in updated_posts]
+        PostTag.delete().where(PostTag.post << updated_post_ids).execute()
+        insert_rows(PostTag, [
+            {'post': post_id, 'tag_name': tag_name}
+            for post_id, _, post_data in updated_posts
+            for tag_name in post_data['tags']
+        ])
+
+    return _save_posts(new_posts_data, fetch_index)
+
+
+def _get_text_hash(post):
+    # Posts saved before body hashes were saved with them only have their text.
+    if post.body_text_hash is None and post.body_text is not None:
+        return hash_content(post.body_text)
+    return post.body_text_hash
+
+
+def _select_posts_by_id(fetch_index, post_ids):
+    return (
+        Post
+        .select(Post.id, Post.post_id, Post.body_text, Post.body_text_hash,
+                Post.last_activity_date)
+        .where(
+            (Post.fetch_index == fetch_index) &
+            (Post.post_id << post_ids))
+        )
+
+
+def _select_latest_post(fetch_index):
+    return (
+        Post
+        .select(Post.creation_date)
+        .where(Post.fetch_index == fetch_index)
+        .order_by(Post.creation_date.desc())
+        .limit(1)
+        )
+
+
+def _select_latest_activity(fetch_index):
+    return (
+        Post
+        .select(Post.last_activity_date)
+        .where(
+            (Post.fetch_index == fetch_index) &
+            Post.last_activity_date.is_null(False))
+        .order_by(Post.last_activity_date.desc())
+        .limit(1)
+        )
+
+
+def _get_latest_activity(fetch_index):
+    '''
+    Get the time of the newest activity on a post in a snapshot, as a Unix timestamp, or None
+    if the snapshot is empty.  Snapshots saved before posts' last activity dates were saved
+    only have creation dates, so the newest creation date is used for them.
+    '''
+    latest_post = _select_latest_activity(fetch_index).first()
+    if latest_post is not None:
+        latest_date = latest_post.last_activity_date
+    else:
+        latest_post = _select_latest_post(fetch_index).first()
+        if latest_post is None:
+            return None
+        latest_date = latest_post.creation_date
+    # Dates are saved in local time (see `_make_post_row`).
+    return int(time.mktime(latest_date.timetuple()))
+
+
+def _get_page_params(params, page):
+    page_params = params.copy()
+    page_params['page'] = page
+    return page_params
+
+
+def _fetch_pages(params, concurrency, first_page=1):
+    '''
+    Fetch pages of search results, starting with `first_page`.
+    Yields the number and response data of each page, in order.
+    '''
+    # The first page of results tells us how many results there are in total, and so how
+    # many pages to fetch.  The rest of the pages are fetched `concurrency` at a time.
+    # Pages are yielded in order, so posts are saved in the same order as a one-by-one fetch.
+    # We keep going until the results tell us there are 'no more', in case the number of
+    # results has changed since the first page was fetched.
+    page_count = None
+    next_page = first_page
     more_results = True
 
+    with AsyncRequester(concurrency) as requester:
+        while more_results:
+
+            if page_count is None:
+                last_page = next_page
+            else:
+                last_page = max(next_page, min(next_page + concurrency - 1, page_count))
+            pages = list(range(next_page, last_page + 1))
+            responses = requester.get_all([
+                (API_URL, {'params': _get_page_params(params, page)}) for page in pages])
+
+            for page, response in zip(pages, responses):
+
+                if response is None:
+                    raise FetchError("Could not fetch page %d of posts." % page)
+                response_data = get_response_data(response)
+
+                # Find out how many pages there are
+                if page_count is None and response_data.get('total') is not None:
+                    page_size = max(len(response_data['items']), 1)
+                    page_count = int(math.ceil(float(response_data['total']) / page_size))
+
+                yield page, response_data
+
+                # Stop if there are no more results coming
+                more_results = response_data['has_more']
+                if not more_results:
+                    break
+
+            next_page = last_page + 1
+
+
+def fetch_posts(run, concurrency=DEFAULT_CONCURRENCY):
+    '''
+    Fetch posts into the fetch index of a run, returning the number of posts saved.
+    If the run was stopped before, fetching continues from the page after the last one saved.
+    '''
+    next_page = 1  # paging for Stack Exchange API starts at 1
+    post_count = 0
+
+    cursor = run.get_cursor()
+    if cursor is not None:
+        next_page = cursor['page']
+        post_count = run.row_count
+
     progress_bar = None
-    while more_results:
+    for page, response_data in _fetch_pages(DEFAULT_PARAMS, concurrency, next_page):
+
+        if progress_bar is None:
+            progress_bar = tqdm(total=response_data.get('total'), initial=post_count)
 
-        response = make_request(default_requests_session.get, API_URL, params=params)
+        # Save the page's posts with a checkpoint, so an interrupted fetch can
+        # be resumed from the next page.
+        with db_proxy.atomic():
+            post_count += _save_posts(response_data['items'], run.fetch_index)
+            run.checkpoint({'page': page + 1}, post_count)
 
-        if response is not None:
-            response_data = response.json()
+        progress_bar.update(len(response_data['items']))
 
-            # Create the progress bar
-            if progress_bar is None and response_data['total'] is not None:
-                progress_bar = tqdm(total=response_data['total'])
+    if progress_bar is not None:
+        progress_bar.close()
 
-            for post in response_data['items']:
-                _save_post(post, fetch_index)
+    return post_count
 
-                if progress_bar is not None:
-                    progress_bar.update()
 
-            # Advance the page if there are more results coming
-            more_results = response_data['has_more'] if response is not None else True
-            time.sleep(REQUEST_DELAY)
-            params['page'] += 1
+def update_posts(run, concurrency=DEFAULT_CONCURRENCY):
+    '''
+    Fetch posts with activity (they were created, edited, answered, or voted on) since the
+    newest activity in a run's snapshot, and save them to that snapshot.  Posts that are
+    already in the snapshot are updated, and the rest are added.  Each page is saved with a
+    checkpoint in the run's cursor, so if an update stops early, the next one continues from
+    the page after the last one saved.  Call this within `sync_run` for the run.  Returns
+    the number of posts added.
+    '''
+    # Pages are fetched oldest activity first, so posts whose activity changes during the
+    # update move to later pages, and are still fetched.
+    sync_cursor = (run.get_cursor() or {}).get('sync')
+    if sync_cursor is not None:
+        since, next_page = sync_cursor['since'], sync_cursor['page']
+        logger.info(
+            "Continuing the last update of fetch %d from page %d.", run.fetch_index, next_page)
+    else:
+        since, next_page = _get_latest_activity(run.fetch_index), 1
+
+    params = DEFAULT_PARAMS.copy()
+    params['sort'] = 'activity'
+    params['order'] = 'asc'
+    if since is not None:
+        # The API's "min" includes posts from that second, so the newest post is fetched again.
+        params['min'] = since
+        logger.info(
+            "Fetching posts with activity since %s.", datetime.datetime.fromtimestamp(since))
+
+    sync_started = datetime.datetime.now()
+    post_count = 0
+    progress_bar = None
+    for page, response_data in _fetch_pages(params, concurrency, next_page):
+
+        if progress_bar is None:
+            progress_bar = tqdm(total=response_data.get('total'))
+
+        with db_proxy.atomic():
+            added_count = _upsert_posts(response_data['items'], run.fetch_index)
+            post_count += added_count
+            run.checkpoint(
+                {'sync': {'since': since, 'page': page + 1}}, run.row_count + added_count)
+
+        progress_bar.update(len(response_data['items']))
 
     if progress_bar is not None:
         progress_bar.close()
 
+    # The update is complete, so the next one starts from the newest activity again.
+    run.cursor = None
+    run.synced = sync_started
+    run.save()
+
+    logger.info(
+        "Added %d new posts to fetch %d, and updated the rest.", post_count, run.fetch_index)
+    return post_count
+
+
+def explain_queries():
+    ''' The main queries of this module, for checking their query plans. '''
+    return [
+        ("posts in a fetch index by ID", _select_posts_by_id(1, [1, 2])),
+        ("newest post in a fetch index", _select_latest_post(1)),
+        ("newest activity in a fetch index", _select_latest_activity(1)),
+    ]
+
+
+@configure_requests
+def main(concurrency, resume, incremental, *args, **kwargs):  # pylint: disable=unused-argument
 
-def main(*args, **kwargs):  # pylint: disable=unused-argument
+    # Add new posts to the latest snapshot if updating it incrementally.
+    if incremental:
+        latest_run = FetchRun.get_latest_run(Post)
+        if latest_run is not None:
+            with sync_run(latest_run) as run:
+                update_posts(run, concurrency)
+            return
+        logger.warning("No finished fetch of posts to update. Fetching all posts.")
 
-    # Create a new fetch index.
-    last_fetch_index = Post.select(fn.Max(Post.fetch_index)).scalar() or 0
-    fetch_index = last_fetch_index + 1
-    fetch_posts(fetch_index)
+    # Create a new fetch index, or continue the last one if resuming.
+    with fetch_run(Post, __name__, resume=resume) as run:
+        run.row_count = fetch_posts(run, concurrency)
 
 
 def configure_parser(parser):
     parser.description = "Fetch Stack Overflow posts that reference tutorials."
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help="Number of pages of posts to request at once (default: %(default)s)."
+        )
+    mode_group = parser.add_mutually_exclusive_group()
+    mode_group.add_argument(
+        "--resume",
+        action='store_true',
+        help="Continue the last fetch from where it stopped, if it didn't finish."
+        )
+    mode_group.add_argument(
+        "--incremental",
+        action='store_true',
+        help=(
+            "Instead of fetching all posts to a new fetch index, fetch posts with activity " +
+            "(new posts, edits, and votes) since the newest activity in the last fetch.  " +
+            "Posts it already has are updated, and the rest are added to it."
+            ))
+    add_request_arguments(parser)
@@ -1,46 +1,260 @@
+import concurrent.futures
+import hashlib
 import json
 import logging
+import os
 import os.path
+import signal
+import subprocess
+import threading
+import time
 from tqdm import tqdm
 import pdfkit
 
 
 logger = logging.getLogger('data')
+OUTPUT_DIRECTORY = os.path.join('data', 'pdfs')
+MANIFEST_FILENAME = os.path.join(OUTPUT_DIRECTORY, 'manifest.json')
+PDF_OPTIONS = {
+    'quiet': None,
+    'page-width': 200,
+    'page-height': 2000,
+}
+DEFAULT_JOBS = os.cpu_count() or 1
+DEFAULT_TIMEOUT = 120  # seconds to wait for a tutorial to render before giving up on it
+MANIFEST_SAVE_INTERVAL = 100  # number of renders between saves of the manifest
 
 
-def _fetch_pdf(urls, tutorial_id):
-    OUTPUT_DIRECTORY = os.path.join('data', 'pdfs')
-    if not os.path.exists(OUTPUT_DIRECTORY):
-        os.makedirs(OUTPUT_DIRECTORY)
+def _hash_links(urls):
+    return hashlib.sha1(' '.join(urls).encode('utf-8')).hexdigest()
+
+
+def load_manifest(filename=MANIFEST_FILENAME):
+    '''
+    Load the manifest of rendered tutorials, a dictionary from tutorial IDs to the hash of
+    the links they were rendered from, their output path and size, and their render time.
+    '''
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as manifest_file:
+        return json.load(manifest_file)
+
+
+def save_manifest(manifest, filename=MANIFEST_FILENAME):
+    # Write the manifest to a temporary file first, so that it is never left half-written.
+    temporary_filename = filename + '.tmp'
+    with open(temporary_filename, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    os.replace(temporary_filename, filename)
 
-    OUTPUT_FILENAME = os.path.join(OUTPUT_DIRECTORY, str(tutorial_id) + '.pdf')
+
+def is_fresh(manifest_entry, urls):
+    ''' Check whether a tutorial's PDF was rendered from the same links and is still there. '''
+    return (
+        manifest_entry is not None and
+        manifest_entry['links_hash'] == _hash_links(urls) and
+        os.path.exists(manifest_entry['path']) and
+        os.path.getsize(manifest_entry['path']) == manifest_entry['size'])
+
+
+class RenderProcesses(object):
+    '''
+    The wkhtmltopdf processes that are running, so that they can all be killed if rendering
+    is stopped.  Each process runs in its own session, so it doesn't see a Ctrl-C sent to
+    this one, and has to be killed explicitly.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.processes = set()
+        self.stopped = False
+
+    def start(self, command, env):
+        ''' Start a process, or return None if rendering has been stopped. '''
+        with self.lock:
+            if self.stopped:
+                return None
+            process = subprocess.Popen(
+                command,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                env=env,
+                start_new_session=True,
+            )
+            self.processes.add(process)
+            return process
+
+    def finish(self, process):
+        with self.lock:
+            self.processes.discard(process)
+
+    def stop(self):
+        ''' Kill all running processes, and don't start any more. '''
+        with self.lock:
+            self.stopped = True
+            for process in self.processes:
+                _kill_process_group(process)
+
+
+def _kill_process_group(process):
+    ''' Kill a process and its helper processes, if they are still running. '''
     try:
-        pdfkit.from_url(
-            urls,
-            OUTPUT_FILENAME,
-            {
-                'quiet': None,
-                'page-width': 200,
-                'page-height': 2000,
-                'title': tutorial_id,
-            })
-    except OSError as e:
-        print(e)
-        logger.warning("Could not download PDF: %s", e)
-
-
-def fetch_tutorials(tutorials):
-    for tutorial in tqdm(tutorials):
-        urls = tutorial['links'].split(' ')
-        _fetch_pdf(urls, tutorial['tutorial_id'])
-
-
-def main(tutorials_filename, *args, **kwargs):  # pylint: disable=unused-argument
-    tutorials = []
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def _fetch_pdf(urls, tutorial_id, timeout, configuration=None, processes=None):
+    '''
+    Render a tutorial to a PDF with wkhtmltopdf.  If it takes longer than `timeout` seconds,
+    wkhtmltopdf is killed.  Returns a manifest entry for the PDF, or None if it couldn't
+    be rendered.
+    '''
+    output_filename = os.path.join(OUTPUT_DIRECTORY, str(tutorial_id) + '.pdf')
+    options = PDF_OPTIONS.copy()
+    options['title'] = tutorial_id
+    renderer = pdfkit.PDFKit(urls, 'url', options=options, configuration=configuration)
+    processes = processes or RenderProcesses()
+
+    # Render to a temporary file, so that a PDF that fails part-way through doesn't
+    # replace one that was rendered before.  Each job has its own temporary file, so jobs
+    # for the same tutorial can't write over each other's.
+    temporary_filename = '%s.%d-%d.part' % (output_filename, os.getpid(), threading.get_ident())
+    start_time = time.time()
+    process = processes.start(renderer.command(temporary_filename), renderer.environ)
+    if process is None:
+        return None
+    try:
+        _, stderr = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        # Kill the whole process group, so that no helper processes are left running.
+        _kill_process_group(process)
+        _, stderr = process.communicate()
+        logger.warning("Timed out after %d s rendering PDF for tutorial %s.", timeout, tutorial_id)
+        timed_out = True
+    else:
+        timed_out = False
+    finally:
+        processes.finish(process)
+    render_time = time.time() - start_time
+
+    # wkhtmltopdf exits with an error if any of the pages failed to load, but still writes
+    # the pages that did, so a PDF from a process that exited by itself is kept.  Processes
+    # that were killed (exit code < 0) leave partial files, which are thrown away.
+    has_output = (
+        os.path.exists(temporary_filename) and os.path.getsize(temporary_filename) > 0)
+    is_complete = not timed_out and process.returncode >= 0 and has_output
+    if not timed_out and not processes.stopped and process.returncode != 0:
+        if is_complete:
+            message = "Some pages of the PDF for tutorial %s could not be downloaded"
+        else:
+            message = "Could not download PDF for tutorial %s"
+        logger.warning(
+            message + " (exit code %d): %s", tutorial_id, process.returncode,
+            stderr.decode('utf-8', 'replace').strip())
+    if not is_complete:
+        if os.path.exists(temporary_filename):
+            os.remove(temporary_filename)
+        return None
+
+    os.replace(temporary_filename, output_filename)
+    return {
+        'links_hash': _hash_links(urls),
+        'path': output_filename,
+        'size': os.path.getsize(output_filename),
+        'render_time': round(render_time, 3),
+    }
+
+
+def read_tutorials(tutorials_filename):
+    ''' Read tutorials from a data file, one line at a time. '''
     with open(tutorials_filename) as tutorials_file:
         for line in tutorials_file:
-            tutorials.append(json.loads(line))
-    fetch_tutorials(tutorials)
+            if line.strip():
+                yield json.loads(line)
+
+
+def fetch_tutorials(tutorials, jobs=DEFAULT_JOBS, timeout=DEFAULT_TIMEOUT, force=False):
+    '''
+    Render PDFs for tutorials, with up to `jobs` copies of wkhtmltopdf running at once.
+    Tutorials whose PDFs were already rendered from the same links are skipped, unless
+    `force` is true.  Returns the number of PDFs rendered.
+    '''
+    if not os.path.exists(OUTPUT_DIRECTORY):
+        os.makedirs(OUTPUT_DIRECTORY)
+
+    # Look for wkhtmltopdf once, rather than once per tutorial.
+    configuration = pdfkit.configuration()
+    manifest = load_manifest()
+    counts = {'rendered': 0, 'skipped': 0, 'failed': 0}
+    progress_bar = tqdm()
+    futures = {}
+
+    def finish_job(future):
+        entry = future.result()
+        tutorial_id = futures.pop(future)
+        if entry is None:
+            counts['failed'] += 1
+        else:
+            manifest[tutorial_id] = entry
+            counts['rendered'] += 1
+            if counts['rendered'] % MANIFEST_SAVE_INTERVAL == 0:
+                save_manifest(manifest)
+        progress_bar.update()
+
+    # Each job waits on a wkhtmltopdf process, so threads are enough to run them in
+    # parallel.  Tutorials are read as jobs finish, so that only a few are held at once.
+    processes = RenderProcesses()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        try:
+            for tutorial in tutorials:
+                tutorial_id = str(tutorial['tutorial_id'])
+                urls = tutorial['links'].split(' ')
+                if not force and is_fresh(manifest.get(tutorial_id), urls):
+                    counts['skipped'] += 1
+                    progress_bar.update()
+                    continue
+                if tutorial_id in futures.values():
+                    logger.warning("Tutorial %s is listed more than once. Skipping.", tutorial_id)
+                    progress_bar.update()
+                    continue
+
+                if len(futures) >= jobs * 2:
+                    done, _ = concurrent.futures.wait(
+                        futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        finish_job(future)
+
+                future = executor.submit(
+                    _fetch_pdf, urls, tutorial_id, timeout, configuration, processes)
+                futures[future] = tutorial_id
+
+            for future in concurrent.futures.as_completed(list(futures)):
+                finish_job(future)
+
+        except BaseException:
+            # The executor waits for its jobs before exiting, so if rendering stops early
+            # (with Ctrl-C or an error), stop the jobs that haven't started, and kill the
+            # renders that are running, instead of finishing them.
+            logger.warning("Stopping rendering. Killing %d renders.", len(processes.processes))
+            for future in futures:
+                future.cancel()
+            processes.stop()
+            raise
+
+        finally:
+            # Save what has been rendered, even if rendering stopped early.
+            save_manifest(manifest)
+            progress_bar.close()
+
+    logger.info(
+        "Rendered %d PDFs, skipped %d that were up to date, and failed to render %d.",
+        counts['rendered'], counts['skipped'], counts['failed'])
+    return counts['rendered']
+
+
+def main(tutorials_filename, jobs, timeout, force, *_, **__):
+    fetch_tutorials(read_tutorials(tutorials_filename), jobs, timeout, force)
 
 
 def configure_parser(parser):
@@ -54,3 +268,20 @@ def configure_parser(parser):
             "string containing URLs where the tutorial is hosted, with each URL delimited by ' '"
             )
         )
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        default=DEFAULT_JOBS,
+        help="Number of PDFs to render at once (default: %(default)s)."
+        )
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        default=DEFAULT_TIMEOUT,
+        help="Seconds to wait for a PDF to render before giving up on it (default: %(default)s)."
+        )
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help="Render PDFs again even if they are up to date with the tutorials' links."
+        )
@@ -0,0 +1,34 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+from playhouse.migrate import migrate
+
+
+logger = logging.getLogger('data')
+
+# Indexes for the columns that posts, tags, links, and annotations are looked up by.
+# Tables created by newer versions of the models already have these indexes.
+INDEXES = [
+    ('post', ('fetch_index', 'post_id')),
+    ('posttag', ('post_id',)),
+    ('postlink', ('post_id',)),
+    ('mendeleyannotation', ('document_id',)),
+]
+
+
+def forward(migrator):
+
+    database = migrator.database
+    compiler = database.compiler()
+
+    operations = []
+    for table, columns in INDEXES:
+        existing_index_names = [index.name for index in database.get_indexes(table)]
+        if compiler.index_name(table, columns) in existing_index_names:
+            logger.info("Index on %s %s already exists. Skipping.", table, columns)
+            continue
+        operations.append(migrator.add_index(table, columns, False))
+
+    migrate(*operations)
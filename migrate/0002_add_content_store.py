@@ -0,0 +1,33 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+from playhouse.migrate import migrate
+from peewee import TextField
+
+from models import Content
+
+
+logger = logging.getLogger('data')
+
+
+def forward(migrator):
+    '''
+    Add the columns that refer to post bodies in the content store, and let bodies be NULL.
+    Posts are read with these columns whether or not the content store is enabled, so every
+    database created before them needs this migration.  Bodies aren't moved into the
+    content store (see `0006_fold_bodies_into_content_store`).
+    '''
+    database = migrator.database
+    Content.create_table(fail_silently=True)
+
+    operations = []
+    post_column_names = [column.name for column in database.get_columns('post')]
+    for column_name in ['body_html_hash', 'body_text_hash']:
+        if column_name in post_column_names:
+            logger.info("Column post.%s already exists. Skipping.", column_name)
+        else:
+            operations.append(migrator.add_column('post', column_name, TextField(null=True)))
+    operations.append(migrator.drop_not_null('post', 'body_text'))
+    migrate(*operations)
@@ -0,0 +1,21 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+from playhouse.migrate import migrate
+from peewee import TextField
+
+
+logger = logging.getLogger('data')
+
+
+def forward(migrator):
+
+    database = migrator.database
+    fetch_run_column_names = [column.name for column in database.get_columns('fetchrun')]
+    if 'cursor' in fetch_run_column_names:
+        logger.info("Column fetchrun.cursor already exists. Skipping.")
+        return
+
+    migrate(migrator.add_column('fetchrun', 'cursor', TextField(null=True)))
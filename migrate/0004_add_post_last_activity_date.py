@@ -0,0 +1,33 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+from playhouse.migrate import migrate
+from peewee import DateTimeField
+
+
+logger = logging.getLogger('data')
+
+
+def forward(migrator):
+
+    database = migrator.database
+    compiler = database.compiler()
+
+    operations = []
+    post_column_names = [column.name for column in database.get_columns('post')]
+    if 'last_activity_date' in post_column_names:
+        logger.info("Column post.last_activity_date already exists. Skipping.")
+    else:
+        operations.append(
+            migrator.add_column('post', 'last_activity_date', DateTimeField(null=True)))
+
+    # Bodies are copied between snapshots by looking up posts by their IDs in earlier snapshots.
+    existing_index_names = [index.name for index in database.get_indexes('post')]
+    if compiler.index_name('post', ('post_id', 'fetch_index')) in existing_index_names:
+        logger.info("Index on post (post_id, fetch_index) already exists. Skipping.")
+    else:
+        operations.append(migrator.add_index('post', ('post_id', 'fetch_index'), False))
+
+    migrate(*operations)
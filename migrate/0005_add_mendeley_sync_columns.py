@@ -0,0 +1,41 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+from playhouse.migrate import migrate
+from peewee import DateTimeField
+
+
+logger = logging.getLogger('data')
+
+# Columns for syncing changes into fetches of Mendeley documents and annotations
+COLUMNS = [
+    ('fetchrun', 'synced'),
+    ('mendeleydocument', 'deletion_date'),
+    ('mendeleyannotation', 'deletion_date'),
+]
+
+
+def forward(migrator):
+
+    database = migrator.database
+    compiler = database.compiler()
+
+    operations = []
+    for table, column in COLUMNS:
+        existing_column_names = [existing.name for existing in database.get_columns(table)]
+        if column in existing_column_names:
+            logger.info("Column %s.%s already exists. Skipping.", table, column)
+            continue
+        operations.append(migrator.add_column(table, column, DateTimeField(null=True)))
+
+    # Syncs look up annotations by their IDs within a fetch.
+    index_columns = ('fetch_index', 'annotation_id')
+    existing_index_names = [index.name for index in database.get_indexes('mendeleyannotation')]
+    if compiler.index_name('mendeleyannotation', index_columns) in existing_index_names:
+        logger.info("Index on mendeleyannotation %s already exists. Skipping.", index_columns)
+    else:
+        operations.append(migrator.add_index('mendeleyannotation', index_columns, False))
+
+    migrate(*operations)
@@ -0,0 +1,56 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+from tqdm import tqdm
+
+from models import Post, content_store_settings, db_proxy, iterate_batches, store_contents,\
+    update_field
+
+
+logger = logging.getLogger('data')
+BATCH_SIZE = 1000
+
+
+def _fold_bodies(posts):
+    ''' Move the bodies of a batch of posts into the content store. '''
+    post_ids = [post.id for post in posts]
+    body_hashes = {}
+    for field_name in ['body_text', 'body_html']:
+        posts_with_body = [post for post in posts if getattr(post, field_name) is not None]
+        content_hashes = store_contents([getattr(post, field_name) for post in posts_with_body])
+        body_hashes[field_name + '_hash'] = dict(
+            (post.id, content_hash) for post, content_hash in zip(posts_with_body, content_hashes))
+
+    with db_proxy.atomic():
+        for hash_field_name, hashes_by_id in body_hashes.items():
+            update_field(Post, getattr(Post, hash_field_name), hashes_by_id)
+        Post.update(body_text=None, body_html=None).where(Post.id << post_ids).execute()
+
+
+def forward(migrator):  # pylint: disable=unused-argument
+    '''
+    Move the bodies saved with each post into the content store, so that each distinct
+    body is saved only once.  Bodies are compressed if the content store is configured
+    to compress them.  This can't be undone, so it only runs if the content store is
+    enabled in the database configuration.  Run `0002_add_content_store` first.
+    '''
+    if not content_store_settings['enabled']:
+        logger.error(
+            "The content store isn't enabled, so bodies were left with their posts. " +
+            "Set \"content_store\" in the --db-config file to move them.")
+        return
+
+    posts_with_bodies = (
+        Post
+        .select(Post.id, Post.body_text, Post.body_html)
+        .where(Post.body_text.is_null(False) | Post.body_html.is_null(False))
+        )
+    progress_bar = tqdm(total=posts_with_bodies.count())
+
+    for posts in iterate_batches(posts_with_bodies, BATCH_SIZE):
+        _fold_bodies(posts)
+        progress_bar.update(len(posts))
+
+    progress_bar.close()
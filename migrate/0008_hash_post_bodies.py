@@ -0,0 +1,44 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+from tqdm import tqdm
+
+from models import Post, db_proxy, hash_content, iterate_batches, update_field
+
+
+logger = logging.getLogger('data')
+BATCH_SIZE = 1000
+
+
+def _hash_bodies(posts):
+    ''' Save the hashes of the bodies saved with a batch of posts. '''
+    with db_proxy.atomic():
+        for field_name in ['body_text', 'body_html']:
+            update_field(Post, getattr(Post, field_name + '_hash'), dict(
+                (post.id, hash_content(getattr(post, field_name))) for post in posts
+                if getattr(post, field_name) is not None))
+
+
+def forward(migrator):  # pylint: disable=unused-argument
+    '''
+    Save the hashes of bodies that are saved with their posts, rather than in the content
+    store.  Computations look for posts with changed bodies by their hashes, so without
+    them, posts saved before hashes were saved are computed again every time.
+    Run `0002_add_content_store` first.
+    '''
+    posts_without_hashes = (
+        Post
+        .select(Post.id, Post.body_text, Post.body_html)
+        .where(
+            (Post.body_text.is_null(False) & Post.body_text_hash.is_null()) |
+            (Post.body_html.is_null(False) & Post.body_html_hash.is_null()))
+        )
+    progress_bar = tqdm(total=posts_without_hashes.count())
+
+    for posts in iterate_batches(posts_without_hashes, BATCH_SIZE):
+        _hash_bodies(posts)
+        progress_bar.update(len(posts))
+
+    progress_bar.close()
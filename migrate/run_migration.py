@@ -44,7 +44,7 @@ def configure_parser(parser):
                 inspect.currentframe()
             )))
     migration_files = [f for f in local_files if re.match('^\d{4}.*\.py$', f)]
-    migration_names = [m.rstrip('.py') for m in migration_files]
+    migration_names = sorted(os.path.splitext(m)[0] for m in migration_files)
 
     parser.add_argument(
         'migration_name',
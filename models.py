@@ -1,9 +1,23 @@
 import logging
+import collections
+import contextlib
 import datetime
+import functools
+import hashlib
+import io
 import json
-import copy
-from peewee import Model, SqliteDatabase, Proxy, PostgresqlDatabase,\
-    BooleanField, IntegerField, DateTimeField, TextField, ForeignKeyField
+import os
+import queue
+import random
+import socket
+import sqlite3
+import threading
+import time
+import zlib
+from peewee import Model, SqliteDatabase, Proxy, PostgresqlDatabase, IntegrityError,\
+    OperationalError, fn, BlobField, BooleanField, IntegerField, DateTimeField, TextField,\
+    ForeignKeyField
+from playhouse.shortcuts import case
 
 
 logger = logging.getLogger('data')
@@ -12,27 +26,113 @@ POSTGRES_CONFIG_NAME = 'postgres-credentials.json'
 DATABASE_NAME = 'data'
 db_proxy = Proxy()
 
+# Limits on the number of bound parameters in a single query.  SQLite's default limit
+# was raised from 999 to 32766 in version 3.32.0.
+SQLITE_MAX_QUERY_PARAMETERS = 32766 if sqlite3.sqlite_version_info >= (3, 32, 0) else 999
+POSTGRES_MAX_QUERY_PARAMETERS = 32767
+DEFAULT_BATCH_SIZE = 10000
+DEFAULT_BATCH_BYTES = 16 * 1024 * 1024
+DEFAULT_WRITER_QUEUE_SIZE = 4
+DEFAULT_READ_BATCH_SIZE = 1000
+
+_insert_fields_cache = {}
+
+# Settings for the content store, and the hashes of content known to be saved in it.
+content_store_settings = {
+    'enabled': False,
+    'compress': False,
+}
+CONTENT_CACHE_SIZE = 1024
+STORED_CONTENT_CACHE_SIZE = 100000
+_stored_content_hashes = collections.OrderedDict()
+_stored_content_lock = threading.Lock()
+
+# Named sets of SQLite settings that trade off speed and durability.  `pragmas` are set on
+# every connection, and if `optimize` is true, the query planner's statistics are updated
+# at the end of a run (see `optimize_database`).
+SQLITE_PROFILES = {
+    # Commits wait until the rollback journal and database have been synced to disk.
+    'safe': {
+        'pragmas': [
+            ('journal_mode', 'delete'),
+            ('synchronous', 'full'),
+        ],
+        'optimize': False,
+    },
+    # Fast writes for large fetches and computations.  In WAL mode with synchronous=NORMAL
+    # the database can't be corrupted by a crash, though the last commits may be lost
+    # after a power failure.
+    'bulk-load': {
+        'pragmas': [
+            ('journal_mode', 'wal'),
+            ('synchronous', 'normal'),
+            ('cache_size', -256 * 1024),  # negative sizes are in KiB
+            ('mmap_size', 1024 * 1024 * 1024),
+            ('temp_store', 'memory'),
+        ],
+        'optimize': True,
+    },
+}
+
 
 class BatchInserter:
     '''
     A class for saving database records in batches.
     Save rows to the batch inserter, and it will save the rows to
-    the database after it has been given a batch size of rows.
+    the database after it has been given a batch size of rows, or after the rows
+    it is holding take up more than `batch_bytes` bytes.
     Make sure to call the `flush` method when you're finished using it
     to save any rows that haven't yet been saved.
     Assumes all models have been initialized to connect to db_proxy.
     '''
-    def __init__(self, ModelType, batch_size, fill_missing_fields=False):
+    def __init__(self, ModelType, batch_size=DEFAULT_BATCH_SIZE, fill_missing_fields=False,
+                 batch_bytes=DEFAULT_BATCH_BYTES, asynchronous=False,
+                 queue_size=DEFAULT_WRITER_QUEUE_SIZE, use_copy=None):
         '''
         ModelType is the Peewee model to which you want to save the data.
-        If the rows you save will have fields missing for some of the records,
-        set `fill_missing_fields` to true so that all rows will be augmented
-        with all fields to prevent Peewee from crashing.
+        `batch_size` is the number of rows saved in each transaction. Rows are split into
+        as many INSERT statements as are needed to stay within the database's limit on the
+        number of parameters in a query, so this can be much larger than that limit.
+        Fields that aren't given for a row are set to the field's default.  If the rows you
+        save will be missing fields that have no default, set `fill_missing_fields` to true
+        so that those fields will be set to NULL instead of raising an error.
+        Batches are saved with COPY when using Postgres, and with INSERT statements otherwise.
+        Set `use_copy` to true or false to override this choice (see `load_tuples`).
+
+        If `asynchronous` is true, batches are handed off to a writer thread that saves them
+        using its own database connection, so that the caller can keep producing rows while
+        they are saved.  At most `queue_size` batches wait to be saved before `insert` blocks.
+        Errors from the writer are raised from the next call to `insert`, `flush` or `close`.
+        As the writer uses a separate connection, this mode can't be used with an in-memory
+        SQLite database, and with SQLite it works best in WAL mode, where reading from the
+        database doesn't block the writer's commits.
         '''
         self.rows = []
         self.ModelType = ModelType
         self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
         self.pad_data = fill_missing_fields
+        self.fields = get_insert_fields(ModelType)
+        self.rows_bytes = 0
+        self.use_copy = use_copy
+
+        self.queue = None
+        self.writer = None
+        self.writer_error = None
+        if asynchronous:
+            self.queue = queue.Queue(maxsize=queue_size)
+            self.writer = threading.Thread(
+                target=self._write_batches,
+                name='BatchInserter-' + ModelType.__name__,
+            )
+            self.writer.daemon = True
+            self.writer.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
 
     def insert(self, row):
         '''
@@ -40,37 +140,306 @@ class BatchInserter:
         Each row is a dictionary of key-value pairs, where each key is the name of a field
         and each value is the value of the row for that column.
         '''
-        self.rows.append(row)
-        if len(self.rows) >= self.batch_size:
-            self.flush()
+        self._raise_writer_error()
+        values = self._make_values(row)
+        self.rows.append(values)
+        self.rows_bytes += _estimate_size(values)
+        if len(self.rows) >= self.batch_size or self.rows_bytes >= self.batch_bytes:
+            self._send_batch()
 
     def flush(self):
-        if self.pad_data:
-            self._pad_data(self.rows)
-        with db_proxy.atomic():
-            self.ModelType.insert_many(self.rows).execute()
+        '''
+        Save all rows that haven't yet been saved.  In asynchronous mode, this waits until
+        the writer has saved all of the batches it has been given.
+        '''
+        self._send_batch()
+        if self.queue is not None:
+            self.queue.join()
+            self._raise_writer_error()
+
+    def close(self):
+        ''' Save all remaining rows, and stop the writer thread if there is one. '''
+        try:
+            self.flush()
+        finally:
+            if self.writer is not None:
+                self.queue.put(None)
+                self.writer.join()
+                self.writer = None
+
+    def _send_batch(self):
+        if self.rows:
+            if self.queue is None:
+                self._write(self.rows)
+            else:
+                self._raise_writer_error()
+                self.queue.put(self.rows)
         self.rows = []
+        self.rows_bytes = 0
+
+    def _write(self, rows):
+        with db_proxy.atomic():
+            load_tuples(self.ModelType, self.fields, rows, use_copy=self.use_copy)
 
-    def _pad_data(self, rows):
+    def _write_batches(self):
         '''
-        Before we can bulk insert rows using Peewee, they all need to have the same
-        fields.  This method adds the missing fields to all rows to make
-        sure they all describe the same fields.  It does this destructively
-        to the rows provided as input.
+        The loop run by the writer thread. The writer saves batches until it is given `None`.
+        After an error, it discards the batches it receives so that producers don't block.
         '''
-        # Collect the union of all field names
-        field_names = set()
-        for row in rows:
-            field_names = field_names.union(row.keys())
+        try:
+            while True:
+                rows = self.queue.get()
+                try:
+                    if rows is None:
+                        return
+                    if self.writer_error is None:
+                        self._write(rows)
+                except Exception as e:  # pylint: disable=broad-except
+                    logger.error("Error saving batch of %s records: %s", self.ModelType.__name__, e)
+                    self.writer_error = e
+                finally:
+                    self.queue.task_done()
+        finally:
+            # Connections are opened for each thread, so close the one this thread opened.
+            if not db_proxy.is_closed():
+                db_proxy.close()
+
+    def _raise_writer_error(self):
+        if self.writer_error is not None:
+            raise self.writer_error
+
+    def _make_values(self, row):
+        return make_values(self.fields, row, self.pad_data)
+
+
+def make_values(fields, row, fill_missing_fields=False):
+    '''
+    Convert a row dictionary into a tuple of values, ordered like `fields`.
+    Missing values are replaced with each field's default, or with NULL if the field
+    is nullable or `fill_missing_fields` is true.
+    '''
+    values = []
+    found_count = 0
+    for field in fields:
+        name = field.name
+        if name in row:
+            values.append(row[name])
+            found_count += 1
+        elif field.default is not None:
+            values.append(field.default() if callable(field.default) else field.default)
+        elif fill_missing_fields or field.null:
+            values.append(None)
+        else:
+            raise KeyError('Row is missing a value for field "%s".' % name)
+
+    if found_count != len(row):
+        unknown_names = set(row.keys()).difference([field.name for field in fields])
+        raise KeyError('"%s" is not a recognized field.' % ', '.join(sorted(unknown_names)))
+
+    return tuple(values)
 
-        # We'll enforce that default for all unspecified fields is NULL
-        default_data = {field_name: None for field_name in field_names}
 
-        # Pad each row with the missing fields
-        for i, _ in enumerate(rows):
-            updated_data = copy.copy(default_data)
-            updated_data.update(rows[i])
-            rows[i] = updated_data
+def _estimate_size(values):
+    ''' A rough estimate of the number of bytes a row of values will take up. '''
+    size = 0
+    for value in values:
+        if isinstance(value, (str, bytes)):
+            size += len(value)
+        else:
+            size += 8
+    return size
+
+
+def get_max_query_parameters(database):
+    ''' Get the maximum number of bound parameters allowed in one query to a database. '''
+    if isinstance(database, PostgresqlDatabase):
+        return POSTGRES_MAX_QUERY_PARAMETERS
+    return SQLITE_MAX_QUERY_PARAMETERS
+
+
+def get_insert_fields(ModelType):
+    '''
+    Get the fields of a model that values should be supplied for when inserting rows
+    (that is, all fields except for an auto-incrementing primary key), in the order
+    they were declared.  These are computed once for each model.
+    '''
+    if ModelType not in _insert_fields_cache:
+        _insert_fields_cache[ModelType] = [
+            field for field in ModelType._meta.sorted_fields
+            if not (field.primary_key and ModelType._meta.auto_increment)
+        ]
+    return _insert_fields_cache[ModelType]
+
+
+def load_tuples(ModelType, fields, rows, use_copy=None):
+    '''
+    Save rows to the table for a model as quickly as the database allows.
+    Each row is a tuple of Python values in the same order as `fields`.
+    With Postgres, rows are loaded with COPY. Otherwise they are saved with INSERT statements.
+    `use_copy` can be set to true or false to choose a method instead, though COPY
+    only works with Postgres.  Call this within a transaction to save all of the rows at once.
+    '''
+    if use_copy is None:
+        use_copy = isinstance(db_proxy.obj, PostgresqlDatabase)
+    if use_copy:
+        copy_tuples(ModelType, fields, rows)
+    else:
+        insert_tuples(ModelType, fields, rows)
+
+
+def copy_tuples(ModelType, fields, rows):
+    '''
+    Load rows into the table for a model with Postgres' `COPY ... FROM STDIN`.
+    Rows are encoded as CSV into an in-memory buffer, which is then streamed to the server.
+    Each row is a tuple of Python values in the same order as `fields`.
+    '''
+    buffer = io.StringIO()
+    converters = [field.db_value for field in fields]
+    for row in rows:
+        buffer.write(','.join([
+            _format_copy_value(convert(value))
+            for convert, value in zip(converters, row)
+        ]))
+        buffer.write('\n')
+    buffer.seek(0)
+
+    columns = ', '.join('"' + field.db_column + '"' for field in fields)
+    sql = 'COPY "%s" (%s) FROM STDIN WITH CSV' % (ModelType._meta.db_table, columns)
+    cursor = db_proxy.get_cursor()
+    try:
+        cursor.copy_expert(sql, buffer)
+    finally:
+        cursor.close()
+
+
+def _format_copy_value(value):
+    '''
+    Format a database value as a field for Postgres' CSV COPY format.
+    NULLs are unquoted empty fields, so all strings are quoted to keep empty strings distinct.
+    '''
+    if value is None:
+        return ''
+    elif isinstance(value, bool):
+        return 't' if value else 'f'
+    elif isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    elif isinstance(value, (int, float)):
+        return repr(value)
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        return '\\x' + bytes(value).hex()
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+def insert_rows(ModelType, rows):
+    '''
+    Insert rows into the table for a model with multi-row INSERT statements, returning the
+    primary keys of the new rows in the same order as the rows.  Each row is a dictionary
+    from field names to values, like those given to `BatchInserter.insert`.  This is for
+    saving a group of records that other records will refer to, like a page of posts and
+    then their tags.  Call this within a transaction to save all of the rows at once.
+    '''
+    fields = get_insert_fields(ModelType)
+    return insert_tuples(
+        ModelType, fields, [make_values(fields, row) for row in rows], return_ids=True)
+
+
+def insert_tuples(ModelType, fields, rows, return_ids=False):
+    '''
+    Insert rows into the table for a model with multi-row INSERT statements.
+    Each row is a tuple of Python values in the same order as `fields`.
+    Each statement holds as many rows as fit within the database's parameter limit.
+    Call this within a transaction to save all of the rows at once.
+    If `return_ids` is true, the primary keys of the new rows are returned, in order.
+    Postgres returns them with `RETURNING`.  SQLite gives each row of a statement the next
+    rowid while it holds the write lock, so they are counted back from the last rowid.
+    '''
+    database = db_proxy.obj
+    rows_per_statement = max(1, get_max_query_parameters(database) // len(fields))
+
+    quote_char = database.quote_char
+    columns = ', '.join(quote_char + field.db_column + quote_char for field in fields)
+    row_placeholder = '(' + ', '.join([database.interpolation] * len(fields)) + ')'
+    statement_prefix = 'INSERT INTO %s%s%s (%s) VALUES ' % (
+        quote_char, ModelType._meta.db_table, quote_char, columns)
+    converters = [field.db_value for field in fields]
+    use_returning = return_ids and isinstance(database, PostgresqlDatabase)
+    primary_key_column = quote_char + ModelType._meta.primary_key.db_column + quote_char
+
+    ids = []
+    for start in range(0, len(rows), rows_per_statement):
+        statement_rows = rows[start:start + rows_per_statement]
+        params = [
+            convert(value)
+            for row in statement_rows
+            for convert, value in zip(converters, row)
+        ]
+        sql = statement_prefix + ', '.join([row_placeholder] * len(statement_rows))
+        if use_returning:
+            sql += ' RETURNING ' + primary_key_column
+        cursor = db_proxy.execute_sql(sql, params)
+
+        if use_returning:
+            ids.extend(row[0] for row in cursor.fetchall())
+        elif return_ids:
+            last_id = cursor.lastrowid
+            ids.extend(range(last_id - len(statement_rows) + 1, last_id + 1))
+
+    return ids if return_ids else None
+
+
+def iterate_batches(query, batch_size=DEFAULT_READ_BATCH_SIZE):
+    '''
+    Iterate over the records a query selects in batches, yielding each batch as a list.
+    Records are read in order of their primary key, and each batch is selected as the
+    records after the last key of the batch before it, rather than with OFFSET.  This
+    makes reading a batch take the same time however far into the results it is.
+    The query shouldn't have its own order or limit.
+    '''
+    primary_key = query.model_class._meta.primary_key
+    last_key = None
+    while True:
+        batch = list(get_batch_query(query, batch_size, last_key))
+        if batch:
+            yield batch
+        if len(batch) < batch_size:
+            return
+        last_key = getattr(batch[-1], primary_key.name)
+
+
+def get_batch_query(query, batch_size, after_key=None):
+    ''' Get the query for a batch of `iterate_batches`, after the primary key `after_key`. '''
+    primary_key = query.model_class._meta.primary_key
+    batch_query = query.order_by(primary_key).limit(batch_size)
+    if after_key is not None:
+        batch_query = batch_query.where(primary_key > after_key)
+    return batch_query
+
+
+def update_field(ModelType, field, values_by_key):
+    '''
+    Set a field to a different value for each of many records, with UPDATE statements that
+    each update as many records as fit in the database's parameter limit.  `values_by_key`
+    is a dictionary from records' primary keys to their new values.  Only `field` is updated.
+    Call this within a transaction to save all of the values at once.
+    '''
+    primary_key = ModelType._meta.primary_key
+    keys = list(values_by_key.keys())
+
+    # Each record needs a parameter for its key and value in the CASE, and one for its key
+    # in the WHERE clause.
+    records_per_statement = max(1, get_max_query_parameters(db_proxy.obj) // 3)
+    for start in range(0, len(keys), records_per_statement):
+        statement_keys = keys[start:start + records_per_statement]
+        new_value = case(
+            primary_key,
+            [(key, field.db_value(values_by_key[key])) for key in statement_keys],
+            field)
+        (
+            ModelType
+            .update(**{field.name: new_value})
+            .where(primary_key << statement_keys)
+            .execute()
+        )
 
 
 class ProxyModel(Model):
@@ -94,6 +463,337 @@ class Command(ProxyModel):
     arguments = TextField()
 
 
+class FetchRun(ProxyModel):
+    '''
+    A run of a fetching module that saved records to a table under a new fetch index.
+    Fetch indexes are allocated from this table so that concurrent runs get different
+    indexes, and so that finding the latest index doesn't require scanning the fetched data.
+    '''
+
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    INTERRUPTED = 'interrupted'
+
+    # If two runs try to allocate the same index at once, one of them will try again.
+    ALLOCATION_ATTEMPTS = 10
+
+    class Meta:  # pylint: disable=no-init,too-few-public-methods
+        indexes = (
+            (('table_name', 'fetch_index'), True),
+        )
+
+    # The table the run saves records to, and the fetch index of those records
+    table_name = TextField()
+    fetch_index = IntegerField()
+
+    # The name of the module that performed the run
+    source = TextField()
+
+    started = DateTimeField(default=datetime.datetime.now)
+    finished = DateTimeField(null=True)
+    status = TextField(default=RUNNING)
+    row_count = IntegerField(default=0)
+
+    # How far the run has got, as JSON, so that it can be resumed if it stops early
+    cursor = TextField(null=True)
+
+    # The host and process ID of the process running the run, as "host:pid"
+    owner = TextField(null=True)
+
+    # When the last sync of changes into this run's records started, if there has been one.
+    # The next sync fetches the changes made since then.
+    synced = DateTimeField(null=True)
+
+    @classmethod
+    def start(cls, ModelType, source):
+        ''' Record the start of a run that saves records of ModelType with a new fetch index. '''
+        table_name = ModelType._meta.db_table
+        for attempt in range(1, cls.ALLOCATION_ATTEMPTS + 1):
+            try:
+                with db_proxy.atomic():
+                    last_fetch_index = (
+                        cls
+                        .select(fn.Max(cls.fetch_index))
+                        .where(cls.table_name == table_name)
+                        .scalar())
+
+                    # Before runs were recorded, fetch indexes were allocated from the data.
+                    if last_fetch_index is None:
+                        last_fetch_index = ModelType.select(fn.Max(ModelType.fetch_index)).scalar()
+
+                    return cls.create(
+                        table_name=table_name,
+                        fetch_index=(last_fetch_index or 0) + 1,
+                        source=source,
+                        owner=get_process_owner(),
+                    )
+            except (IntegrityError, OperationalError) as e:
+                if attempt == cls.ALLOCATION_ATTEMPTS:
+                    raise
+                logger.debug("Could not allocate fetch index for %s (%s). Retrying.", table_name, e)
+                time.sleep(random.random() * 0.1)
+
+    @classmethod
+    def get_latest_run(cls, ModelType):
+        '''
+        Get the latest run that fetched all of the records of ModelType, or None.  This is the
+        latest successful run, unless a later run's fetch succeeded and it is being synced, or
+        its last sync stopped early (see `sync_run`).
+        '''
+        runs = (
+            cls
+            .select()
+            .where(cls.table_name == ModelType._meta.db_table)
+            .order_by(cls.fetch_index.desc()))
+        for run in runs:
+            if run.status == cls.SUCCEEDED or run.is_syncing():
+                return run
+        return None
+
+    @classmethod
+    def get_latest_index(cls, ModelType):
+        '''
+        Get the fetch index of the latest successful run that saved records of ModelType.
+        If no runs have been recorded, this falls back to the highest fetch index in the data,
+        which was saved before runs were recorded.  If runs have been recorded but none of
+        them succeeded, this returns None, rather than the index of a partial fetch.
+        '''
+        latest_run = cls.get_latest_run(ModelType)
+        if latest_run is not None:
+            return latest_run.fetch_index
+        table_name = ModelType._meta.db_table
+        if cls.select().where(cls.table_name == table_name).exists():
+            logger.warning(
+                "No fetch of %s has succeeded. Choose a fetch index to use a partial fetch.",
+                table_name)
+            return None
+        return ModelType.select(fn.Max(ModelType.fetch_index)).scalar()
+
+    @classmethod
+    def get_unfinished_run(cls, ModelType):
+        '''
+        Get the latest run that saved records of ModelType, if it hasn't succeeded.  The run
+        may still be running in another process (see `can_resume`).  Returns None if the
+        latest run succeeded, or if its fetch succeeded and only a sync of it hasn't, or if
+        there have been no runs.
+        '''
+        latest_run = (
+            cls
+            .select()
+            .where(cls.table_name == ModelType._meta.db_table)
+            .order_by(cls.fetch_index.desc())
+            .first())
+        if latest_run is None or latest_run.status == cls.SUCCEEDED or latest_run.is_syncing():
+            return None
+        return latest_run
+
+    def is_owner_gone(self):
+        '''
+        Check whether the process that was running this run has exited.  Only processes on
+        this host can be checked, so this is false for runs owned by other hosts.
+        '''
+        if self.owner is None:
+            return False
+        host, _, pid = self.owner.rpartition(':')
+        if host != socket.gethostname():
+            return False
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except (PermissionError, ValueError):
+            return False
+        return False
+
+    def can_resume(self):
+        '''
+        Check whether the run can be resumed: it failed or was interrupted, or it is marked as
+        running but the process that was running it has exited (for instance, it was killed).
+        '''
+        return self.status in [self.FAILED, self.INTERRUPTED] or (
+            self.status == self.RUNNING and self.is_owner_gone())
+
+    def get_cursor(self):
+        ''' Get the cursor saved by the last checkpoint, or None if there hasn't been one. '''
+        return json.loads(self.cursor) if self.cursor is not None else None
+
+    def is_syncing(self):
+        ''' Check whether a sync of this run has started and not yet finished (see `sync_run`). '''
+        cursor = self.get_cursor()
+        return isinstance(cursor, dict) and 'sync' in cursor
+
+    def start_sync(self):
+        '''
+        Take ownership of this run for syncing changes into its records.  Its cursor's "sync"
+        entry is kept if a sync stopped early, so that it can be continued, and set to None
+        otherwise.  Raises SystemExit if another process is fetching or syncing the run.
+        '''
+        if self.status == self.RUNNING and not self.is_owner_gone():
+            raise SystemExit(
+                "Fetch %d of %s is being fetched or synced (in process %s). " % (
+                    self.fetch_index, self.table_name, self.owner or "unknown") +
+                "Wait for it to finish or stop it before syncing it.  If it was stopped on " +
+                "another machine, set its status in the fetchrun table to \"" + self.FAILED +
+                "\" to sync it."
+            )
+        cursor = self.get_cursor() if self.is_syncing() else {'sync': None}
+        owner = get_process_owner()
+
+        # Only take the run if no other process has taken it since it was read.
+        owner_condition = (
+            FetchRun.owner.is_null() if self.owner is None else FetchRun.owner == self.owner)
+        taken_count = (
+            FetchRun
+            .update(status=self.RUNNING, owner=owner, finished=None, cursor=json.dumps(cursor))
+            .where(
+                (FetchRun.id == self.id) &
+                (FetchRun.status == self.status) &
+                owner_condition)
+            .execute())
+        if not taken_count:
+            raise SystemExit(
+                "Fetch %d of %s was taken by another process. Not syncing it." % (
+                    self.fetch_index, self.table_name))
+        self.status = self.RUNNING
+        self.owner = owner
+        self.finished = None
+        self.cursor = json.dumps(cursor)
+
+    def checkpoint(self, cursor, row_count):
+        '''
+        Save how far the run has got.  `cursor` can be any JSON-serializable value that tells
+        the fetcher where to continue from.  Call this in the same transaction that saves
+        the records it accounts for, so the records and the cursor are saved together.
+        '''
+        self.cursor = json.dumps(cursor)
+        self.row_count = row_count
+        self.save()
+
+    def finish(self, status=SUCCEEDED):
+        self.status = status
+        self.finished = datetime.datetime.now()
+        self.save()
+
+
+@contextlib.contextmanager
+def fetch_run(ModelType, source, resume=False):
+    '''
+    Record a run that saves records of ModelType to a new fetch index, which is
+    available as `fetch_index` on the run this yields.  Add to the run's `row_count` as
+    records are saved.  The run is marked as failed if an exception is raised.
+    If `resume` is true, and the latest run for ModelType didn't succeed, that run is
+    continued instead, with the same fetch index.  Its cursor is available from `get_cursor`.
+    A run that may still be running in another process isn't resumed.  The run is marked
+    as interrupted if it is stopped with Ctrl-C, and as failed if any other exception is raised.
+    '''
+    run = None
+    if resume:
+        run = FetchRun.get_unfinished_run(ModelType)
+        if run is None:
+            logger.warning("No unfinished fetch to resume. Starting a new fetch.")
+        elif not run.can_resume():
+            raise SystemExit(
+                "Fetch %d of %s is still running (in process %s). Wait for it to finish or " % (
+                    run.fetch_index, run.table_name, run.owner or "unknown") +
+                "stop it before resuming it.  If it was stopped on another machine, set its " +
+                "status in the fetchrun table to \"" + FetchRun.FAILED + "\" to resume it."
+            )
+        else:
+            logger.info(
+                "Resuming fetch %d of %s from %s.", run.fetch_index, run.table_name, run.cursor)
+            run.status = FetchRun.RUNNING
+            run.finished = None
+            run.owner = get_process_owner()
+            run.save()
+    if run is None:
+        run = FetchRun.start(ModelType, source)
+    try:
+        yield run
+    except (KeyboardInterrupt, SystemExit):
+        run.finish(FetchRun.INTERRUPTED)
+        raise
+    except BaseException:
+        run.finish(FetchRun.FAILED)
+        raise
+    run.finish()
+
+
+@contextlib.contextmanager
+def sync_run(run):
+    '''
+    Record a sync of changes into the records of a run whose fetch succeeded, yielding the
+    run.  The run is marked as running by this process while it is synced, so that no other
+    process fetches or syncs it at the same time, and it is marked as succeeded afterwards.
+    If the sync is stopped with Ctrl-C, the run is marked as interrupted, and as failed if
+    any other exception is raised.  Either way its records are still used as the latest
+    records (see `FetchRun.get_latest_run`), and the next sync continues from its cursor.
+    Clear the cursor when the sync is complete.
+    '''
+    run.start_sync()
+    try:
+        yield run
+    except (KeyboardInterrupt, SystemExit):
+        run.finish(FetchRun.INTERRUPTED)
+        raise
+    except BaseException:
+        run.finish(FetchRun.FAILED)
+        raise
+    run.finish()
+
+
+def get_process_owner():
+    ''' Describe this process as the owner of a run, as "host:pid". '''
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+class ComputeRun(ProxyModel):
+    '''
+    A run of a computing module over the records of a fetch.  The run records the version
+    of the module's code, so that results from other versions can be told apart.
+    '''
+
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+
+    class Meta:  # pylint: disable=no-init,too-few-public-methods
+        indexes = (
+            (('module', 'fetch_index'), False),
+        )
+
+    # The name of the module that performed the run, and the fetch index of the records it read
+    module = TextField()
+    fetch_index = IntegerField()
+    version = TextField()
+
+    started = DateTimeField(default=datetime.datetime.now)
+    finished = DateTimeField(null=True)
+    status = TextField(default=RUNNING)
+    row_count = IntegerField(default=0)
+
+    def finish(self, status=SUCCEEDED):
+        self.status = status
+        self.finished = datetime.datetime.now()
+        self.save()
+
+
+@contextlib.contextmanager
+def compute_run(module, fetch_index, version):
+    '''
+    Record a run of a computing module over the records of a fetch, yielding the run.
+    Add to the run's `row_count` as results are saved.  The run is marked as failed if an
+    exception is raised.
+    '''
+    run = ComputeRun.create(module=module, fetch_index=fetch_index, version=version)
+    try:
+        yield run
+    except BaseException:
+        run.finish(ComputeRun.FAILED)
+        raise
+    run.finish()
+
+
 class ExampleData(ProxyModel):
     ''' An interaction event. '''
 
@@ -106,8 +806,34 @@ class ExampleData(ProxyModel):
     example_text = TextField(index=True)
 
 
+class Content(ProxyModel):
+    '''
+    A body of text that is stored only once, no matter how many records refer to it.
+    Records refer to content by the hash of its text (see `store_content`).
+    '''
+
+    hash = TextField(primary_key=True)
+    compressed = BooleanField(default=False)
+    data = BlobField()
+
+
 class Post(ProxyModel):
-    ''' A Stack Overflow post. '''
+    '''
+    A Stack Overflow post.
+    The `body_*_hash` fields hold the hashes of the post's bodies (see `hash_content`), so
+    that changes to the bodies can be found without reading them.  If the content store is
+    enabled, the bodies are saved as `Content`, which the hashes refer to, instead of being
+    saved in `body_*`.  Read the bodies with the `text` and `html` properties, which work
+    either way.
+    '''
+
+    class Meta:  # pylint: disable=no-init,too-few-public-methods
+        indexes = (
+            # Posts are usually looked up by their ID within a snapshot, and sometimes
+            # across snapshots.
+            (('fetch_index', 'post_id'), False),
+            (('post_id', 'fetch_index'), False),
+        )
 
     fetch_index = IntegerField(index=True)
     date = DateTimeField(default=datetime.datetime.now)
@@ -116,9 +842,25 @@ class Post(ProxyModel):
     post_id = IntegerField()
     title = TextField()
     body_html = TextField(null=True)  # backfilled
-    body_text = TextField()
+    body_text = TextField(null=True)
+    body_html_hash = TextField(null=True)
+    body_text_hash = TextField(null=True)
     is_accepted = BooleanField()
     score = IntegerField()
+    last_activity_date = DateTimeField(null=True)
+
+    @property
+    def html(self):
+        return _load_body(self.body_html, self.body_html_hash)
+
+    @property
+    def text(self):
+        return _load_body(self.body_text, self.body_text_hash)
+
+    def set_bodies(self, **bodies):
+        ''' Set the bodies of this post, e.g., `post.set_bodies(body_html=html)`. '''
+        for field_name, value in make_body_fields(**bodies).items():
+            setattr(self, field_name, value)
 
 
 class PostTag(ProxyModel):
@@ -136,6 +878,25 @@ class PostLink(ProxyModel):
     anchor_text = TextField()
 
 
+class ComputedPost(ProxyModel):
+    '''
+    A mark that a computing module has saved its results for a post.  The results are up to
+    date if they were computed by the module's current version, from a body with the same
+    hash as the post's body has now (see `hash_content`).
+    '''
+
+    class Meta:  # pylint: disable=no-init,too-few-public-methods
+        indexes = (
+            (('module', 'post'), True),
+        )
+
+    module = TextField()
+    post = ForeignKeyField(Post)
+    compute_run = ForeignKeyField(ComputeRun)
+    version = TextField()
+    body_hash = TextField(null=True)
+
+
 class MendeleyDocument(ProxyModel):
     ''' An identifier for a Mendeley document. '''
 
@@ -144,10 +905,19 @@ class MendeleyDocument(ProxyModel):
 
     document_id = TextField(index=True)
 
+    # When a sync found that the document was deleted, or None if it hasn't been
+    deletion_date = DateTimeField(null=True)
+
 
 class MendeleyAnnotation(ProxyModel):
     ''' An annotation on a Mendeley document. '''
 
+    class Meta:  # pylint: disable=no-init,too-few-public-methods
+        indexes = (
+            # Syncs look up annotations by their ID within a snapshot.
+            (('fetch_index', 'annotation_id'), False),
+        )
+
     fetch_index = IntegerField(index=True)
     date = DateTimeField(default=datetime.datetime.now)
 
@@ -161,8 +931,141 @@ class MendeleyAnnotation(ProxyModel):
     bottom = IntegerField()
     page = IntegerField()
 
+    # When a sync found that the annotation was deleted, or None if it hasn't been
+    deletion_date = DateTimeField(null=True)
+
+
+def hash_content(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def _is_known_stored(content_hash):
+    with _stored_content_lock:
+        return content_hash in _stored_content_hashes
+
+
+def _remember_stored(content_hashes):
+    '''
+    Remember that content is saved in the content store, so it needn't be looked up again.
+    Only the most recently used `STORED_CONTENT_CACHE_SIZE` hashes are remembered.
+    '''
+    with _stored_content_lock:
+        for content_hash in content_hashes:
+            _stored_content_hashes[content_hash] = True
+            _stored_content_hashes.move_to_end(content_hash)
+        while len(_stored_content_hashes) > STORED_CONTENT_CACHE_SIZE:
+            _stored_content_hashes.popitem(last=False)
+
+
+def _make_content_row(content_hash, text):
+    data = text.encode('utf-8')
+    compress = content_store_settings['compress']
+    if compress:
+        data = zlib.compress(data)
+    return {'hash': content_hash, 'compressed': compress, 'data': data}
+
+
+def store_contents(texts):
+    '''
+    Save texts to the content store if they aren't there already, and return their hashes,
+    in the same order as the texts (with None for texts that are None).  The texts are
+    looked up and saved with a few queries for all of them.  Text is compressed if the
+    content store was configured to compress it.
+    '''
+    content_hashes = [hash_content(text) if text is not None else None for text in texts]
+    unsaved_texts = collections.OrderedDict(
+        (content_hash, text) for content_hash, text in zip(content_hashes, texts)
+        if content_hash is not None and not _is_known_stored(content_hash))
+
+    unsaved_hashes = list(unsaved_texts.keys())
+    hashes_per_query = get_max_query_parameters(db_proxy.obj)
+    for start in range(0, len(unsaved_hashes), hashes_per_query):
+        saved_contents = (
+            Content
+            .select(Content.hash)
+            .where(Content.hash << unsaved_hashes[start:start + hashes_per_query]))
+        for content in saved_contents:
+            del unsaved_texts[content.hash]
+
+    if unsaved_texts:
+        fields = get_insert_fields(Content)
+        rows = [
+            make_values(fields, _make_content_row(content_hash, text))
+            for content_hash, text in unsaved_texts.items()]
+        try:
+            with db_proxy.atomic():
+                insert_tuples(Content, fields, rows)
+        except IntegrityError:
+            # Another process saved some of the same content first.  Save the rest one by one.
+            for content_hash, text in unsaved_texts.items():
+                try:
+                    with db_proxy.atomic():
+                        Content.create(**_make_content_row(content_hash, text))
+                except IntegrityError:
+                    pass
+
+    _remember_stored([content_hash for content_hash in content_hashes if content_hash is not None])
+    return content_hashes
+
 
-def init_database(db_type, config_filename=None):
+def store_content(text):
+    ''' Save text to the content store if it isn't there already, and return its hash. '''
+    return store_contents([text])[0]
+
+
+@functools.lru_cache(maxsize=CONTENT_CACHE_SIZE)
+def load_content(content_hash):
+    ''' Get the text saved in the content store with a hash. '''
+    content = Content.get(Content.hash == content_hash)
+    data = bytes(content.data)
+    if content.compressed:
+        data = zlib.decompress(data)
+    return data.decode('utf-8')
+
+
+def make_body_fields(**bodies):
+    '''
+    Make the field values for saving the bodies of a post, where each keyword argument
+    is the name of a body field (e.g., `body_html`) and its text.  Each body's hash is
+    saved in its `_hash` field.  If the content store is enabled, the text is saved there
+    instead of in the body field.
+    '''
+    fields = {}
+    for field_name, text in bodies.items():
+        if content_store_settings['enabled']:
+            fields[field_name] = None
+            fields[field_name + '_hash'] = store_content(text)
+        else:
+            fields[field_name] = text
+            fields[field_name + '_hash'] = hash_content(text) if text is not None else None
+    return fields
+
+
+def _load_body(text, content_hash):
+    ''' Get a body of a post from its field, or from the content store if only its hash is. '''
+    if text is not None or content_hash is None:
+        return text
+    return load_content(content_hash)
+
+
+def configure_content_store(setting):
+    '''
+    Choose whether post bodies are saved in the content store.
+    `setting` is false to save bodies with their posts, true to save them in the content
+    store, and "zlib" to save them in the content store compressed.
+    '''
+    content_store_settings['enabled'] = bool(setting)
+    content_store_settings['compress'] = setting == 'zlib'
+
+
+def init_database(db_type, config_filename=None, profile=None):
+    '''
+    Connect `db_proxy` to a database.  For SQLite, `profile` names one of the
+    `SQLITE_PROFILES`.  It can also be set with the "profile" key of a JSON config
+    file, though the `profile` argument takes precedence.  Returns the profile used.
+    The "content_store" key of the config file sets up the content store for post bodies
+    (see `configure_content_store`).
+    '''
 
     if db_type == 'postgres':
 
@@ -182,21 +1085,60 @@ def init_database(db_type, config_filename=None):
             config['port'] = pg_config['port']
 
         db = PostgresqlDatabase(DATABASE_NAME, **config)
+        configure_content_store(pg_config.get('content_store', False))
+
+        if profile is not None:
+            logger.warning("Database profiles only apply to SQLite. Ignoring %s.", profile)
+            profile = None
 
     # Sqlite is the default type of database.
     elif db_type == 'sqlite' or not db_type:
-        db = SqliteDatabase(DATABASE_NAME + '.sqlite')
+
+        sqlite_config = {}
+        if config_filename is not None:
+            with open(config_filename) as sqlite_config_file:
+                sqlite_config = json.load(sqlite_config_file)
+            profile = profile or sqlite_config.get('profile')
+        configure_content_store(sqlite_config.get('content_store', False))
+
+        pragmas = []
+        if profile is not None:
+            if profile not in SQLITE_PROFILES:
+                raise ValueError("Unknown SQLite profile %s. Choose one of: %s." % (
+                    profile, ', '.join(sorted(SQLITE_PROFILES.keys()))))
+            pragmas = list(SQLITE_PROFILES[profile]['pragmas'])
+
+        db = SqliteDatabase(DATABASE_NAME + '.sqlite', pragmas=pragmas)
 
     db_proxy.initialize(db)
+    return profile
+
+
+def optimize_database():
+    '''
+    Update the statistics that the query planner uses, after a run has changed a lot of data.
+    SQLite's `PRAGMA optimize` only analyzes tables whose statistics might be out of date.
+    '''
+    if isinstance(db_proxy.obj, SqliteDatabase):
+        if sqlite3.sqlite_version_info >= (3, 18, 0):
+            db_proxy.execute_sql('PRAGMA optimize')
+        else:
+            db_proxy.execute_sql('ANALYZE')
+    else:
+        db_proxy.execute_sql('ANALYZE')
 
 
 def create_tables():
     db_proxy.create_tables([
         Command,
+        FetchRun,
         ExampleData,
+        Content,
         Post,
         PostTag,
         PostLink,
+        ComputeRun,
+        ComputedPost,
         MendeleyDocument,
         MendeleyAnnotation,
     ], safe=True)
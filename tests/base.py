@@ -8,6 +8,8 @@ import unittest
 from peewee import SqliteDatabase
 from playhouse.test_utils import test_database
 
+from models import db_proxy
+
 
 logger = logging.getLogger('data')
 test_db = SqliteDatabase(':memory:')
@@ -27,5 +29,7 @@ class TestCase(unittest.TestCase):
         self.models = models
 
     def run(self, result=None):
+        # Some code uses the database through the proxy rather than through its models.
+        db_proxy.initialize(test_db)
         with test_database(test_db, self.models):
             super(TestCase, self).run(result)
@@ -0,0 +1,245 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+
+from tests.base import TestCase
+from fetch.api import AsyncRequester, RateLimiter, RetryPolicy, get_response_data, \
+    make_request, make_requests_session
+
+
+logger = logging.getLogger('data')
+
+
+class StubServer(ThreadingHTTPServer):
+    '''
+    A local server for testing requests.  Each path makes the server respond differently:
+    /slow waits before responding, /flaky/<n>/<status code> fails with the status code the
+    first n times it is requested, and /status/<status code> always responds with that code.
+    The server counts the requests for each path, and the most requests it handled at once.
+    '''
+
+    daemon_threads = True
+    SLOW_RESPONSE_TIME = 0.2
+    RETRY_AFTER = 0.3
+
+    def __init__(self):
+        super(StubServer, self).__init__(('127.0.0.1', 0), StubRequestHandler)
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    @property
+    def base_url(self):
+        return 'http://%s:%d' % self.server_address[:2]
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        server = self.server
+        path = self.path.split('?')[0]
+        with server.lock:
+            server.counts[path] = server.counts.get(path, 0) + 1
+            count = server.counts[path]
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+
+        try:
+            parts = path.strip('/').split('/')
+            if parts[0] == 'slow':
+                time.sleep(server.SLOW_RESPONSE_TIME)
+                self._send(200, self.path)
+            elif parts[0] == 'flaky' and count <= int(parts[1]):
+                self._send(int(parts[2]), '', {'Retry-After': str(server.RETRY_AFTER)})
+            elif parts[0] == 'status':
+                self._send(int(parts[1]), '')
+            elif parts[0] == 'json':
+                self._send(200, '{"items": [], "quota_remaining": 100}')
+            else:
+                self._send(200, self.path)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def _send(self, status_code, body, headers=None):
+        data = body.encode('utf-8')
+        self.send_response(status_code)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def start_stub_server():
+    ''' Start a stub server on a background thread, returning the server. '''
+    server = StubServer()
+    thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05})
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class RecordingRateLimiter(RateLimiter):
+    ''' A rate limiter that records the response data it observes, from any host. '''
+
+    def __init__(self):
+        super(RecordingRateLimiter, self).__init__(rates={})
+        self.observed_data = []
+
+    def observes(self, url):
+        return True
+
+    def observe(self, url, response_data):
+        self.observed_data.append(response_data)
+
+
+class RateLimiterTest(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(RateLimiterTest, self).__init__([], *args, **kwargs)
+
+    def test_wait_for_backoff(self):
+        rate_limiter = RateLimiter()
+        rate_limiter.observe('https://api.stackexchange.com/2.2/posts', {'backoff': 10})
+        bucket = rate_limiter.buckets['api.stackexchange.com']
+        self.assertGreater(bucket['blocked_until'], time.time() + 9)
+
+    def test_slow_down_when_quota_is_low(self):
+        rate_limiter = RateLimiter()
+        rate_limiter.observe('https://api.stackexchange.com/2.2/posts', {'quota_remaining': 100})
+        self.assertAlmostEqual(rate_limiter.buckets['api.stackexchange.com']['rate_scale'], 0.1)
+
+    def test_ignore_other_hosts(self):
+        rate_limiter = RateLimiter()
+        self.assertFalse(rate_limiter.observes('https://api.mendeley.com/documents'))
+        rate_limiter.observe('https://api.mendeley.com/documents', {'backoff': 10})
+        self.assertEqual(rate_limiter.buckets, {})
+
+    def test_parse_response_data_once(self):
+        response = requests.Response()
+        response._content = b'{"items": []}'  # pylint: disable=protected-access
+        self.assertIs(get_response_data(response), get_response_data(response))
+
+    def test_make_request_shares_parsed_data_with_caller(self):
+        server = start_stub_server()
+        try:
+            rate_limiter = RecordingRateLimiter()
+            response = make_request(
+                make_requests_session().get, server.base_url + '/json',
+                rate_limiter=rate_limiter)
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(len(rate_limiter.observed_data), 1)
+        self.assertIs(get_response_data(response), rate_limiter.observed_data[0])
+
+
+class AsyncRequesterTest(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncRequesterTest, self).__init__([], *args, **kwargs)
+
+    def setUp(self):
+        self.server = start_stub_server()
+        self.retry_policy = RetryPolicy(max_attempts=3, base_delay=0, timeout=5)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _url(self, path):
+        return self.server.base_url + path
+
+    def _get_with_requester(self, path, concurrency=2):
+        with AsyncRequester(concurrency) as requester:
+            return requester.run(requester.get(self._url(path), retry_policy=self.retry_policy))
+
+    def _get_with_make_request(self, path):
+        session = make_requests_session()
+        return make_request(session.get, self._url(path), retry_policy=self.retry_policy)
+
+    def test_limit_requests_in_flight_to_concurrency(self):
+        request_list = [(self._url('/slow'), {'params': {'page': page}}) for page in range(9)]
+        with AsyncRequester(3) as requester:
+            start_time = time.time()
+            responses = requester.get_all(request_list)
+            elapsed = time.time() - start_time
+
+        self.assertEqual(self.server.max_in_flight, 3)
+        self.assertGreaterEqual(elapsed, 3 * StubServer.SLOW_RESPONSE_TIME)
+        self.assertEqual(
+            [response.text for response in responses],
+            ['/slow?page=%d' % page for page in range(9)])
+
+    def test_retry_server_errors_like_make_request(self):
+        for get in [self._get_with_make_request, self._get_with_requester]:
+            self.retry_policy.reset_stats()
+            path = '/flaky/2/503/' + get.__name__
+            response = get(path)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(self.server.counts[path], 3)
+            self.assertEqual(self.retry_policy.retries, 2)
+
+    def test_wait_as_long_as_retry_after_header_asks(self):
+        for get in [self._get_with_make_request, self._get_with_requester]:
+            self.retry_policy.reset_stats()
+            path = '/flaky/1/429/' + get.__name__
+            start_time = time.time()
+            response = get(path)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(self.server.counts[path], 2)
+            self.assertAlmostEqual(self.retry_policy.wait_time, StubServer.RETRY_AFTER)
+            self.assertGreaterEqual(time.time() - start_time, StubServer.RETRY_AFTER)
+
+    def test_wait_longer_than_max_delay_if_retry_after_header_asks(self):
+        self.retry_policy.max_delay = StubServer.RETRY_AFTER / 10
+        for get in [self._get_with_make_request, self._get_with_requester]:
+            self.retry_policy.reset_stats()
+            response = get('/flaky/1/429/long/' + get.__name__)
+            self.assertEqual(response.status_code, 200)
+            self.assertAlmostEqual(self.retry_policy.wait_time, StubServer.RETRY_AFTER)
+
+    def test_give_up_if_retry_after_header_passes_deadline(self):
+        self.retry_policy.deadline = StubServer.RETRY_AFTER / 2
+        for get in [self._get_with_make_request, self._get_with_requester]:
+            self.retry_policy.reset_stats()
+            path = '/flaky/1/429/deadline/' + get.__name__
+            self.assertIsNone(get(path))
+            self.assertEqual(self.server.counts[path], 1)
+            self.assertEqual(self.retry_policy.wait_time, 0)
+            self.assertEqual(self.retry_policy.failures, 1)
+
+    def test_return_none_after_last_attempt_fails(self):
+        for get in [self._get_with_make_request, self._get_with_requester]:
+            self.retry_policy.reset_stats()
+            response = get('/status/500')
+            self.assertIsNone(response)
+            self.assertEqual(self.retry_policy.failures, 1)
+        self.assertEqual(self.server.counts['/status/500'], 6)
+
+    def test_return_none_without_retrying_client_errors(self):
+        for get in [self._get_with_make_request, self._get_with_requester]:
+            self.assertIsNone(get('/status/404'))
+        self.assertEqual(self.server.counts['/status/404'], 2)
+        self.assertEqual(self.retry_policy.retries, 0)
+
+    def test_return_none_if_server_is_unreachable(self):
+        self.retry_policy.max_attempts = 2
+        self.server.shutdown()
+        self.server.server_close()
+        with AsyncRequester(2) as requester:
+            responses = requester.get_all([
+                (self._url('/slow'), {'retry_policy': self.retry_policy}) for _ in range(2)])
+        self.assertEqual(responses, [None, None])
+        self.assertEqual(self.retry_policy.failures, 2)
@@ -0,0 +1,79 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import glob
+import logging
+import os.path
+from bs4 import FeatureNotFound
+
+from tests.base import TestCase
+from compute._html import HTML_PARSERS, _has_self_contained_tags, find_links, parse_html
+
+
+logger = logging.getLogger('data')
+CORPUS_DIRECTORY = os.path.join(os.path.dirname(__file__), 'data', 'broken_html')
+CODE_TAGS = ['pre', 'code']
+
+
+def _load_corpus():
+    ''' Load the bodies of broken HTML to parse, as a list of (file name, HTML) pairs. '''
+    corpus = []
+    for filename in sorted(glob.glob(os.path.join(CORPUS_DIRECTORY, '*.html'))):
+        with open(filename, encoding='utf-8') as html_file:
+            corpus.append((os.path.basename(filename), html_file.read()))
+    return corpus
+
+
+def _find_code(html, html_parser, tags_only):
+    document = parse_html(html, html_parser, CODE_TAGS if tags_only else None)
+    return [node.text for node in document.find_all(CODE_TAGS)]
+
+
+class ParseOnlySomeTagsTest(TestCase):
+    '''
+    Parsing only the tags of interest should find the same links and code as parsing the
+    whole body, on HTML that is broken in the ways that post bodies can be.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super(ParseOnlySomeTagsTest, self).__init__([], *args, **kwargs)
+
+    def setUp(self):
+        self.corpus = _load_corpus()
+
+    def _assert_same_as_whole_parse(self, get_results, html_parser):
+        for filename, html in self.corpus:
+            with self.subTest(filename=filename):
+                try:
+                    whole_results = get_results(html, html_parser, False)
+                except FeatureNotFound:
+                    self.skipTest("%s is not installed." % html_parser)
+                self.assertEqual(get_results(html, html_parser, True), whole_results)
+
+    def test_corpus_needs_whole_parse(self):
+        # Some of the corpus has to fall back to parsing the whole body, for the tests to
+        # check that the fallback is used where it is needed.
+        for tag_names in [['a'], CODE_TAGS]:
+            self.assertTrue(any(
+                not _has_self_contained_tags(html, tag_names) for _, html in self.corpus))
+
+    def test_find_links_with_only_anchors(self):
+        for html_parser in HTML_PARSERS:
+            with self.subTest(html_parser=html_parser):
+                self._assert_same_as_whole_parse(find_links, html_parser)
+
+    def test_find_code_with_only_code_tags(self):
+        for html_parser in HTML_PARSERS:
+            with self.subTest(html_parser=html_parser):
+                self._assert_same_as_whole_parse(_find_code, html_parser)
+
+    def test_find_links_in_entities(self):
+        links = dict(find_links(dict(self.corpus)['entities.html']))
+        self.assertEqual(
+            links['http://example.com/search?q=a&b=c'], "Tom & Jerry\xa0— <tags> \xa9 ☺")
+
+    def test_skip_anchors_in_scripts_and_comments(self):
+        html = dict(self.corpus)['anchors_in_script_and_comments.html']
+        urls = [url for url, _ in find_links(html)]
+        self.assertEqual(urls, ['http://example.com/real', 'http://example.com/after'])
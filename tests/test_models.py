@@ -0,0 +1,433 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import csv
+import datetime
+import io
+import logging
+import os.path
+import shutil
+import socket
+import subprocess
+import tempfile
+from peewee import IntegrityError, SqliteDatabase
+
+from tests.base import TestCase, test_db
+from models import BatchInserter, ExampleData, FetchRun, MendeleyDocument, Post, PostTag,\
+    SQLITE_MAX_QUERY_PARAMETERS, db_proxy, fetch_run, get_insert_fields, get_process_owner,\
+    insert_rows, iterate_batches, make_values, sync_run, update_field, _format_copy_value
+
+
+logger = logging.getLogger('data')
+
+
+def _make_post_row(post_id, fetch_index=1):
+    return {
+        'fetch_index': fetch_index,
+        'creation_date': datetime.datetime(2017, 1, 1),
+        'post_id': post_id,
+        'title': "Post %d" % post_id,
+        'body_html': "<p>Body of post %d</p>" % post_id,
+        'is_accepted': False,
+        'score': 0,
+    }
+
+
+def _make_example_row(index, text='text'):
+    return {
+        'import_index': 1,
+        'example_int': index,
+        'example_text': text,
+    }
+
+
+class BatchInserterTest(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(BatchInserterTest, self).__init__([ExampleData], *args, **kwargs)
+
+    def test_make_values_orders_values_like_fields(self):
+        fields = get_insert_fields(ExampleData)
+        values = make_values(fields, {'example_text': "a", 'example_int': 2, 'import_index': 3})
+        values_by_name = dict(zip([field.name for field in fields], values))
+        self.assertEqual(values_by_name['example_text'], "a")
+        self.assertEqual(values_by_name['example_int'], 2)
+        self.assertEqual(values_by_name['import_index'], 3)
+
+    def test_make_values_rejects_unknown_fields(self):
+        fields = get_insert_fields(ExampleData)
+        with self.assertRaises(KeyError):
+            make_values(fields, dict(_make_example_row(1), unknown_field=1))
+
+    def test_save_batch_when_batch_size_reached(self):
+        batch_inserter = BatchInserter(ExampleData, batch_size=3)
+        for index in range(5):
+            batch_inserter.insert(_make_example_row(index))
+        self.assertEqual(ExampleData.select().count(), 3)
+        batch_inserter.flush()
+        self.assertEqual(ExampleData.select().count(), 5)
+
+    def test_save_batch_when_byte_budget_reached(self):
+        # Each row has three numbers (an estimated 8 bytes each) and 40 characters of text,
+        # so the batch is saved once a second row is added.
+        batch_inserter = BatchInserter(ExampleData, batch_size=1000, batch_bytes=100)
+        batch_inserter.insert(_make_example_row(0, 'x' * 40))
+        self.assertEqual(ExampleData.select().count(), 0)
+        batch_inserter.insert(_make_example_row(1, 'x' * 40))
+        self.assertEqual(ExampleData.select().count(), 2)
+        batch_inserter.insert(_make_example_row(2, 'x' * 40))
+        self.assertEqual(ExampleData.select().count(), 2)
+        batch_inserter.flush()
+        self.assertEqual(ExampleData.select().count(), 3)
+
+    def test_split_batch_into_statements_within_parameter_limit(self):
+        # This batch holds more values than fit in one INSERT statement.
+        row_count = SQLITE_MAX_QUERY_PARAMETERS // len(get_insert_fields(ExampleData)) * 2 + 1
+        with BatchInserter(ExampleData, batch_size=row_count) as batch_inserter:
+            for index in range(row_count):
+                batch_inserter.insert(_make_example_row(index))
+        self.assertEqual(ExampleData.select().count(), row_count)
+        example_ints = [record.example_int for record in ExampleData.select().order_by(
+            ExampleData.id)]
+        self.assertEqual(example_ints, list(range(row_count)))
+
+
+class AsynchronousBatchInserterTest(TestCase):
+    '''
+    The writer thread opens its own connection, so these tests use a database file in
+    WAL mode rather than the in-memory test database.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super(AsynchronousBatchInserterTest, self).__init__([], *args, **kwargs)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database = SqliteDatabase(
+            os.path.join(self.directory, 'test.sqlite'), pragmas=[('journal_mode', 'wal')])
+        db_proxy.initialize(self.database)
+        ExampleData.create_table()
+
+    def tearDown(self):
+        self.database.close()
+        db_proxy.initialize(test_db)
+        shutil.rmtree(self.directory)
+
+    def test_save_rows_from_writer_thread(self):
+        with BatchInserter(ExampleData, batch_size=10, asynchronous=True) as batch_inserter:
+            for index in range(95):
+                batch_inserter.insert(_make_example_row(index))
+            batch_inserter.flush()
+            self.assertEqual(ExampleData.select().count(), 95)
+            self.assertTrue(batch_inserter.writer.is_alive())
+        self.assertIsNone(batch_inserter.writer)
+
+    def test_raise_writer_error_from_next_insert(self):
+        batch_inserter = BatchInserter(
+            ExampleData, batch_size=1, fill_missing_fields=True, asynchronous=True)
+        batch_inserter.insert({'import_index': 1, 'example_int': 1})  # no text, which is NOT NULL
+        batch_inserter.queue.join()  # wait for the writer to try to save the row
+        with self.assertRaises(IntegrityError):
+            batch_inserter.insert(_make_example_row(2))
+        with self.assertRaises(IntegrityError):
+            batch_inserter.close()
+
+    def test_raise_writer_error_from_flush(self):
+        batch_inserter = BatchInserter(
+            ExampleData, batch_size=1, fill_missing_fields=True, asynchronous=True)
+        batch_inserter.insert({'import_index': 1, 'example_int': 1})  # no text, which is NOT NULL
+        with self.assertRaises(IntegrityError):
+            batch_inserter.flush()
+
+        # The error is raised again from later calls, and closing stops the writer.
+        with self.assertRaises(IntegrityError):
+            batch_inserter.insert(_make_example_row(2))
+        with self.assertRaises(IntegrityError):
+            batch_inserter.close()
+        self.assertIsNone(batch_inserter.writer)
+        self.assertEqual(ExampleData.select().count(), 0)
+
+    def test_raise_writer_error_from_close(self):
+        batch_inserter = BatchInserter(
+            ExampleData, batch_size=100, fill_missing_fields=True, asynchronous=True)
+        batch_inserter.insert(_make_example_row(1))
+        batch_inserter.insert({'import_index': 1, 'example_int': 2})
+        with self.assertRaises(IntegrityError):
+            batch_inserter.close()
+        self.assertIsNone(batch_inserter.writer)
+
+        # The batch with the bad row was saved in one transaction, so none of it was saved.
+        self.assertEqual(ExampleData.select().count(), 0)
+
+
+class FormatCopyValueTest(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(FormatCopyValueTest, self).__init__([], *args, **kwargs)
+
+    def test_null_is_unquoted_empty_field(self):
+        self.assertEqual(_format_copy_value(None), '')
+
+    def test_empty_string_is_quoted(self):
+        self.assertEqual(_format_copy_value(''), '""')
+
+    def test_quote_special_characters(self):
+        # In CSV format, tabs, newlines and backslashes are kept as they are inside quotes,
+        # and quotes are doubled.
+        self.assertEqual(
+            _format_copy_value('a\tb\nc\r\nd\\e"f,g'),
+            '"a\tb\nc\r\nd\\e""f,g"')
+
+    def test_strings_that_look_like_null_or_numbers_are_quoted(self):
+        self.assertEqual(_format_copy_value('\\N'), '"\\N"')
+        self.assertEqual(_format_copy_value('NULL'), '"NULL"')
+        self.assertEqual(_format_copy_value('12'), '"12"')
+
+    def test_format_non_string_values(self):
+        self.assertEqual(_format_copy_value(True), 't')
+        self.assertEqual(_format_copy_value(False), 'f')
+        self.assertEqual(_format_copy_value(12), '12')
+        self.assertEqual(_format_copy_value(0.5), '0.5')
+        self.assertEqual(
+            _format_copy_value(datetime.datetime(2017, 1, 2, 3, 4, 5)), '2017-01-02T03:04:05')
+        self.assertEqual(_format_copy_value(b'\x00\\\n'), '\\x005c0a')
+
+    def test_row_reads_back_as_csv(self):
+        values = ['tab\there', 'line\nbreak', 'back\\slash', 'say "hi"', '', 'a,b']
+        line = ','.join(_format_copy_value(value) for value in values) + '\n'
+        self.assertEqual(next(csv.reader(io.StringIO(line))), values)
+
+
+class FetchRunTest(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(FetchRunTest, self).__init__([FetchRun, MendeleyDocument], *args, **kwargs)
+
+    def _create_run(self, fetch_index, status, owner=None):
+        return FetchRun.create(
+            table_name=MendeleyDocument._meta.db_table, fetch_index=fetch_index, source='test',
+            status=status, owner=owner)
+
+    def test_latest_index_is_latest_successful_run(self):
+        self._create_run(1, FetchRun.SUCCEEDED)
+        self._create_run(2, FetchRun.SUCCEEDED)
+        self._create_run(3, FetchRun.FAILED)
+        self.assertEqual(FetchRun.get_latest_index(MendeleyDocument), 2)
+
+    def test_latest_index_is_none_if_no_run_succeeded(self):
+        MendeleyDocument.create(fetch_index=1, document_id='document-1')
+        self._create_run(1, FetchRun.FAILED)
+        self.assertIsNone(FetchRun.get_latest_index(MendeleyDocument))
+
+    def test_latest_index_falls_back_to_data_if_no_runs_recorded(self):
+        MendeleyDocument.create(fetch_index=1, document_id='document-1')
+        MendeleyDocument.create(fetch_index=2, document_id='document-1')
+        self.assertEqual(FetchRun.get_latest_index(MendeleyDocument), 2)
+
+    def _get_exited_process_owner(self):
+        process = subprocess.Popen(['true'])
+        process.wait()
+        return '%s:%d' % (socket.gethostname(), process.pid)
+
+    def test_resume_failed_and_interrupted_runs(self):
+        for fetch_index, status in enumerate([FetchRun.FAILED, FetchRun.INTERRUPTED], start=1):
+            self._create_run(fetch_index, status, owner=get_process_owner())
+            with fetch_run(MendeleyDocument, 'test', resume=True) as run:
+                self.assertEqual(run.fetch_index, fetch_index)
+                self.assertEqual(run.status, FetchRun.RUNNING)
+            self.assertEqual(FetchRun.get(FetchRun.id == run.id).status, FetchRun.SUCCEEDED)
+
+    def test_resume_running_run_whose_process_exited(self):
+        self._create_run(1, FetchRun.RUNNING, owner=self._get_exited_process_owner())
+        with fetch_run(MendeleyDocument, 'test', resume=True) as run:
+            self.assertEqual(run.fetch_index, 1)
+            self.assertEqual(run.owner, get_process_owner())
+
+    def test_refuse_to_resume_run_that_is_still_running(self):
+        for owner in [get_process_owner(), 'other-host:1', None]:
+            FetchRun.delete().execute()
+            self._create_run(1, FetchRun.RUNNING, owner=owner)
+            with self.assertRaises(SystemExit):
+                with fetch_run(MendeleyDocument, 'test', resume=True):
+                    pass
+            self.assertEqual(FetchRun.get().status, FetchRun.RUNNING)
+
+    def test_mark_run_interrupted_or_failed(self):
+        with self.assertRaises(KeyboardInterrupt):
+            with fetch_run(MendeleyDocument, 'test') as run:
+                raise KeyboardInterrupt()
+        self.assertEqual(FetchRun.get(FetchRun.id == run.id).status, FetchRun.INTERRUPTED)
+        with self.assertRaises(ValueError):
+            with fetch_run(MendeleyDocument, 'test') as run:
+                raise ValueError()
+        self.assertEqual(FetchRun.get(FetchRun.id == run.id).status, FetchRun.FAILED)
+
+    def test_mark_interrupted_sync_and_continue_it(self):
+        self._create_run(1, FetchRun.SUCCEEDED)
+        with self.assertRaises(KeyboardInterrupt):
+            with sync_run(FetchRun.get_latest_run(MendeleyDocument)) as run:
+                self.assertEqual(run.get_cursor(), {'sync': None})
+                run.checkpoint({'sync': {'page': 2}}, 10)
+                raise KeyboardInterrupt()
+
+        # The fetch is still the latest one, and isn't resumed as an unfinished fetch.
+        run = FetchRun.get_latest_run(MendeleyDocument)
+        self.assertEqual(run.status, FetchRun.INTERRUPTED)
+        self.assertEqual(FetchRun.get_latest_index(MendeleyDocument), 1)
+        self.assertIsNone(FetchRun.get_unfinished_run(MendeleyDocument))
+
+        with sync_run(run):
+            self.assertEqual(run.get_cursor(), {'sync': {'page': 2}})
+            run.cursor = None
+        self.assertEqual(FetchRun.get(FetchRun.id == run.id).status, FetchRun.SUCCEEDED)
+
+    def test_mark_failed_sync(self):
+        run = self._create_run(1, FetchRun.SUCCEEDED)
+        with self.assertRaises(ValueError):
+            with sync_run(run):
+                raise ValueError()
+        self.assertEqual(FetchRun.get(FetchRun.id == run.id).status, FetchRun.FAILED)
+        self.assertEqual(FetchRun.get_latest_index(MendeleyDocument), 1)
+
+    def test_refuse_to_sync_run_that_is_running(self):
+        self._create_run(1, FetchRun.SUCCEEDED)
+        run = FetchRun.get_latest_run(MendeleyDocument)
+        with sync_run(run):
+            with self.assertRaises(SystemExit):
+                with sync_run(FetchRun.get_latest_run(MendeleyDocument)):
+                    pass
+            self.assertEqual(FetchRun.get(FetchRun.id == run.id).owner, get_process_owner())
+
+    def test_refuse_to_sync_run_taken_since_it_was_read(self):
+        run = self._create_run(1, FetchRun.SUCCEEDED)
+        FetchRun.update(owner='other-host:1').where(FetchRun.id == run.id).execute()
+        with self.assertRaises(SystemExit):
+            with sync_run(run):
+                pass
+        self.assertEqual(FetchRun.get(FetchRun.id == run.id).status, FetchRun.SUCCEEDED)
+
+    def test_sync_run_whose_process_exited(self):
+        self._create_run(
+            1, FetchRun.RUNNING, owner=self._get_exited_process_owner()).checkpoint(
+                {'sync': {'page': 3}}, 0)
+        with sync_run(FetchRun.get_latest_run(MendeleyDocument)) as run:
+            self.assertEqual(run.get_cursor(), {'sync': {'page': 3}})
+            self.assertEqual(run.owner, get_process_owner())
+
+
+class InsertRowsTest(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(InsertRowsTest, self).__init__([Post, PostTag], *args, **kwargs)
+
+    def _assert_ids_match_rows(self, ids, post_ids):
+        self.assertEqual(len(ids), len(post_ids))
+        post_ids_by_id = dict(Post.select(Post.id, Post.post_id).tuples())
+        self.assertEqual([post_ids_by_id[id_] for id_ in ids], post_ids)
+
+    def test_return_ids_in_order_of_rows(self):
+        post_ids = [5, 3, 9, 1]
+        with db_proxy.atomic():
+            ids = insert_rows(Post, [_make_post_row(post_id) for post_id in post_ids])
+        self._assert_ids_match_rows(ids, post_ids)
+
+    def test_return_ids_after_gaps_in_table(self):
+        with db_proxy.atomic():
+            first_ids = insert_rows(Post, [_make_post_row(post_id) for post_id in range(10)])
+        Post.delete().where(Post.id << [first_ids[2], first_ids[5], first_ids[-1]]).execute()
+        with db_proxy.atomic():
+            ids = insert_rows(Post, [_make_post_row(post_id) for post_id in range(100, 110)])
+        self._assert_ids_match_rows(ids, list(range(100, 110)))
+
+    def test_return_ids_across_statements(self):
+        # More rows than fit in one INSERT statement, so they are split across several.
+        row_count = SQLITE_MAX_QUERY_PARAMETERS // len(get_insert_fields(Post)) * 2 + 7
+        post_ids = list(range(row_count, 0, -1))
+        with db_proxy.atomic():
+            ids = insert_rows(Post, [_make_post_row(post_id) for post_id in post_ids])
+        self._assert_ids_match_rows(ids, post_ids)
+
+    def test_save_records_referring_to_returned_ids(self):
+        with db_proxy.atomic():
+            ids = insert_rows(Post, [_make_post_row(post_id) for post_id in [1, 2]])
+            insert_rows(PostTag, [
+                {'post': ids[0], 'tag_name': 'python'},
+                {'post': ids[1], 'tag_name': 'javascript'},
+            ])
+        tags = dict((tag.post.post_id, tag.tag_name) for tag in PostTag.select())
+        self.assertEqual(tags, {1: 'python', 2: 'javascript'})
+
+    def test_return_no_ids_for_no_rows(self):
+        self.assertEqual(insert_rows(Post, []), [])
+
+
+class IterateBatchesTest(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(IterateBatchesTest, self).__init__([ExampleData], *args, **kwargs)
+
+    def _create_records(self, count):
+        with db_proxy.atomic():
+            insert_rows(ExampleData, [_make_example_row(index) for index in range(count)])
+
+    def test_no_batches_for_empty_query(self):
+        self.assertEqual(list(iterate_batches(ExampleData.select(), 10)), [])
+
+    def test_read_every_record_once_in_key_order(self):
+        self._create_records(25)
+        batches = list(iterate_batches(ExampleData.select(), 10))
+        self.assertEqual([len(batch) for batch in batches], [10, 10, 5])
+        self.assertEqual(
+            [record.example_int for batch in batches for record in batch], list(range(25)))
+
+    def test_read_exact_multiple_of_batch_size(self):
+        self._create_records(20)
+        batches = list(iterate_batches(ExampleData.select(), 10))
+        self.assertEqual([len(batch) for batch in batches], [10, 10])
+
+    def test_read_records_with_gaps_in_keys(self):
+        self._create_records(40)
+        expected_ints = [
+            index for index in range(40) if index % 3 != 0 and not 10 <= index <= 24]
+        ExampleData.delete().where(~(ExampleData.example_int << expected_ints)).execute()
+        batches = list(iterate_batches(ExampleData.select(), 4))
+        self.assertTrue(all(len(batch) == 4 for batch in batches[:-1]))
+        self.assertEqual(
+            [record.example_int for batch in batches for record in batch], expected_ints)
+
+    def test_read_only_records_selected_by_query(self):
+        self._create_records(30)
+        query = ExampleData.select().where(ExampleData.example_int << list(range(1, 30, 2)))
+        batches = list(iterate_batches(query, 4))
+        self.assertEqual(
+            [record.example_int for batch in batches for record in batch], list(range(1, 30, 2)))
+
+
+class UpdateFieldTest(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(UpdateFieldTest, self).__init__([ExampleData], *args, **kwargs)
+
+    def test_update_each_record_to_its_own_value(self):
+        with db_proxy.atomic():
+            ids = insert_rows(ExampleData, [_make_example_row(index) for index in range(10)])
+            update_field(ExampleData, ExampleData.example_text, dict(
+                (id_, "text %d" % id_) for id_ in ids[::2]))
+        texts = dict(ExampleData.select(ExampleData.id, ExampleData.example_text).tuples())
+        for index, id_ in enumerate(ids):
+            self.assertEqual(texts[id_], "text %d" % id_ if index % 2 == 0 else 'text')
+
+    def test_update_more_records_than_parameter_limit(self):
+        record_count = SQLITE_MAX_QUERY_PARAMETERS + 1
+        with db_proxy.atomic():
+            ids = insert_rows(ExampleData, [
+                _make_example_row(index) for index in range(record_count)])
+            update_field(ExampleData, ExampleData.example_int, dict(
+                (id_, -index) for index, id_ in enumerate(ids)))
+        example_ints = dict(ExampleData.select(ExampleData.id, ExampleData.example_int).tuples())
+        self.assertEqual(
+            [example_ints[id_] for id_ in ids], [-index for index in range(record_count)])
+
+    def test_update_nothing_for_no_keys(self):
+        update_field(ExampleData, ExampleData.example_int, {})
@@ -0,0 +1,56 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import datetime
+import logging
+
+from tests.base import TestCase
+from fetch.stack_overflow_post_bodies import copy_previous_bodies
+from models import Post
+
+
+logger = logging.getLogger('data')
+
+
+def _create_post(fetch_index, post_id, body_html=None, last_activity_date=None):
+    return Post.create(
+        fetch_index=fetch_index, creation_date=datetime.datetime(2017, 1, 1), post_id=post_id,
+        title="Post", body_html=body_html, is_accepted=False, score=0,
+        last_activity_date=last_activity_date)
+
+
+class CopyPreviousBodiesTest(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(CopyPreviousBodiesTest, self).__init__([Post], *args, **kwargs)
+
+    def _get_body(self, fetch_index, post_id):
+        return Post.get((Post.fetch_index == fetch_index) & (Post.post_id == post_id)).body_html
+
+    def test_copy_body_from_newest_earlier_fetch(self):
+        _create_post(1, 10, "<p>old</p>")
+        _create_post(2, 10, "<p>newer</p>")
+        _create_post(3, 10)
+        _create_post(3, 11)
+        self.assertEqual(copy_previous_bodies(3), 1)
+        self.assertEqual(self._get_body(3, 10), "<p>newer</p>")
+        self.assertIsNone(self._get_body(3, 11))
+
+    def test_skip_posts_with_newer_activity(self):
+        _create_post(1, 10, "<p>old</p>", datetime.datetime(2017, 1, 1))
+        _create_post(1, 11, "<p>old</p>", datetime.datetime(2017, 1, 1))
+        _create_post(2, 10, None, datetime.datetime(2017, 1, 1))
+        _create_post(2, 11, None, datetime.datetime(2017, 2, 1))
+        self.assertEqual(copy_previous_bodies(2, match_activity=True), 1)
+        self.assertEqual(self._get_body(2, 10), "<p>old</p>")
+        self.assertIsNone(self._get_body(2, 11))
+
+    def test_treat_posts_without_activity_dates_as_unchanged(self):
+        _create_post(1, 10, "<p>old</p>", None)
+        _create_post(1, 11, "<p>old</p>", datetime.datetime(2017, 1, 1))
+        _create_post(2, 10, None, datetime.datetime(2017, 1, 1))
+        _create_post(2, 11, None, None)
+        self.assertEqual(copy_previous_bodies(2, match_activity=True), 2)
+        self.assertEqual(self._get_body(2, 10), "<p>old</p>")
+        self.assertEqual(self._get_body(2, 11), "<p>old</p>")
@@ -0,0 +1,106 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import datetime
+import logging
+
+from tests.base import TestCase
+from compute._html import DEFAULT_HTML_PARSER
+from compute.stack_overflow_post_links import _select_posts, extract_links, \
+    extract_links_in_range, get_post_ranges, get_version
+from models import ComputeRun, ComputedPost, Content, Post, PostLink, configure_content_store, \
+    make_body_fields
+
+
+logger = logging.getLogger('data')
+
+
+def _create_post(fetch_index, post_id, body_html):
+    return Post.create(
+        fetch_index=fetch_index, creation_date=datetime.datetime(2017, 1, 1), post_id=post_id,
+        title="Post", is_accepted=False, score=0, **make_body_fields(body_html=body_html))
+
+
+def _make_body(post_id):
+    return '<p>See <a href="http://example.com/%d">tutorial %d</a></p>' % (post_id, post_id)
+
+
+class ExtractLinksTest(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(ExtractLinksTest, self).__init__(
+            [Post, PostLink, ComputeRun, ComputedPost, Content], *args, **kwargs)
+
+    def tearDown(self):
+        configure_content_store(False)
+
+    def _create_posts(self):
+        for post_id in range(5):
+            _create_post(1, post_id, _make_body(post_id))
+        _create_post(1, 5, None)
+
+    def _extract_links_in_ranges(self, fetch_index):
+        ''' Extract links from all ranges of a fetch without saving them, as a list of posts. '''
+        extracted_posts = []
+        for post_range in get_post_ranges(fetch_index):
+            extracted_posts.extend(extract_links_in_range(fetch_index, post_range)[0])
+        return extracted_posts
+
+    def _get_links(self):
+        return sorted(
+            (link.post.post_id, link.url, link.anchor_text) for link in PostLink.select())
+
+    def _assert_second_run_does_nothing(self):
+        self._create_posts()
+        extract_links(1)
+        links = self._get_links()
+        self.assertEqual(len(links), 5)
+
+        # No post is read again, not even to check whether its body has changed.
+        version = get_version(DEFAULT_HTML_PARSER)
+        for post_range in get_post_ranges(1):
+            self.assertEqual(_select_posts(1, post_range[0], post_range[1], version).count(), 0)
+        self.assertEqual(self._extract_links_in_ranges(1), [])
+        extract_links(1)
+        self.assertEqual(self._get_links(), links)
+        self.assertEqual(ComputedPost.select().count(), 6)
+        last_run = ComputeRun.select().order_by(ComputeRun.id.desc()).get()
+        self.assertEqual(last_run.row_count, 0)
+
+    def test_second_run_does_nothing(self):
+        self._assert_second_run_does_nothing()
+
+    def test_second_run_does_nothing_with_content_store(self):
+        configure_content_store(True)
+        self._assert_second_run_does_nothing()
+
+    def test_extract_links_from_changed_posts(self):
+        self._create_posts()
+        extract_links(1)
+
+        post = Post.get(Post.post_id == 2)
+        post.set_bodies(body_html=_make_body(20))
+        post.save()
+        new_post = _create_post(1, 6, _make_body(6))
+        self.assertEqual(
+            [post_id for post_id, _ in self._extract_links_in_ranges(1)], [post.id, new_post.id])
+
+        extract_links(1)
+        links = self._get_links()
+        self.assertEqual(len(links), 6)
+        self.assertIn((2, 'http://example.com/20', 'tutorial 20'), links)
+
+    def test_extract_links_from_posts_without_body_hashes(self):
+        self._create_posts()
+        extract_links(1)
+        # Posts saved before body hashes were saved can't be checked without their bodies.
+        Post.update(body_html_hash=None).where(Post.post_id == 3).execute()
+        self.assertEqual(len(self._extract_links_in_ranges(1)), 1)
+
+    def test_extract_links_from_all_posts_with_force(self):
+        self._create_posts()
+        extract_links(1)
+        extract_links(1, force=True)
+        self.assertEqual(len(self._get_links()), 5)
+        self.assertEqual(ComputedPost.select().count(), 6)
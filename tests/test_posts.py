@@ -0,0 +1,92 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+
+from tests.base import TestCase
+from compute.stack_overflow_post_links import extract_links
+from fetch.stack_overflow_post_bodies import _select_posts as _select_posts_for_bodies
+from fetch.stack_overflow_posts import _save_posts, _upsert_posts
+from models import ComputeRun, ComputedPost, Content, Post, PostLink, PostTag, db_proxy, \
+    make_body_fields, update_field
+
+
+logger = logging.getLogger('data')
+
+
+def _make_post_data(answer_id, body, last_activity_date=1483228800, score=1, tags=None):
+    return {
+        'answer_id': answer_id,
+        'title': "Post %d" % answer_id,
+        'body': body,
+        'score': score,
+        'is_accepted': False,
+        'creation_date': 1483228800,
+        'last_activity_date': last_activity_date,
+        'tags': tags or ['python'],
+    }
+
+
+class UpsertPostsTest(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(UpsertPostsTest, self).__init__(
+            [Post, PostTag, PostLink, ComputeRun, ComputedPost, Content], *args, **kwargs)
+
+    def setUp(self):
+        with db_proxy.atomic():
+            _save_posts([_make_post_data(1, "old"), _make_post_data(2, "unchanged")], 1)
+
+        # Give the posts HTML bodies, as fetching their bodies would, and extract their links.
+        bodies = dict(
+            (post.id, '<a href="http://example.com/%s">%s</a>' % (post.body_text, post.body_text))
+            for post in Post.select())
+        with db_proxy.atomic():
+            for field_name in ['body_html', 'body_html_hash']:
+                update_field(Post, getattr(Post, field_name), dict(
+                    (post_id, make_body_fields(body_html=html)[field_name])
+                    for post_id, html in bodies.items()))
+        extract_links(1)
+
+    def _upsert_posts(self, posts_data):
+        with db_proxy.atomic():
+            return _upsert_posts(posts_data, 1)
+
+    def _get_post(self, post_id):
+        return Post.get((Post.fetch_index == 1) & (Post.post_id == post_id))
+
+    def test_fetch_edited_posts_again(self):
+        added_count = self._upsert_posts([
+            _make_post_data(1, "edited", last_activity_date=1483315200),
+            _make_post_data(2, "unchanged"),
+            _make_post_data(3, "new"),
+        ])
+        self.assertEqual(added_count, 1)
+
+        edited_post = self._get_post(1)
+        self.assertEqual(edited_post.text, "edited")
+        self.assertIsNone(edited_post.html)
+        self.assertEqual(
+            [post.post_id for post in _select_posts_for_bodies(1, missing_bodies_only=True)],
+            [1, 3])
+
+        extract_links(1)
+        urls = sorted(link.url for link in PostLink.select())
+        self.assertEqual(urls, ['http://example.com/unchanged'])
+
+    def test_fetch_posts_with_new_activity_again(self):
+        self._upsert_posts([_make_post_data(2, "unchanged", last_activity_date=1483315200)])
+        self.assertIsNone(self._get_post(2).html)
+        self.assertEqual(self._get_post(1).html, '<a href="http://example.com/old">old</a>')
+
+    def test_update_fields_and_tags(self):
+        self._upsert_posts([
+            _make_post_data(1, "old", score=5, tags=['java', 'spring']),
+            _make_post_data(2, "unchanged", score=7),
+        ])
+        self.assertEqual([self._get_post(1).score, self._get_post(2).score], [5, 7])
+        self.assertIsNotNone(self._get_post(1).html)
+        tags = sorted((tag.post.post_id, tag.tag_name) for tag in PostTag.select())
+        self.assertEqual(tags, [(1, 'java'), (1, 'spring'), (2, 'python')])
+        self.assertEqual(Post.select().count(), 2)
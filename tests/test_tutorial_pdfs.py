@@ -0,0 +1,129 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import logging
+import os
+import os.path
+import shutil
+import stat
+import tempfile
+import threading
+import time
+import pdfkit
+
+from tests.base import TestCase
+from fetch.tutorial_pdfs import OUTPUT_DIRECTORY, RenderProcesses, _fetch_pdf, \
+    fetch_tutorials
+
+
+logger = logging.getLogger('data')
+
+# A stand-in for wkhtmltopdf, that writes the PDF named by its last argument if $PDF_TEXT is
+# set, sleeps for $SLEEP seconds, and exits with $EXIT_CODE.
+FAKE_WKHTMLTOPDF = '''#!/bin/sh
+for output; do :; done
+if [ -n "$PDF_TEXT" ]; then printf '%s' "$PDF_TEXT" > "$output"; fi
+sleep "${SLEEP:-0}"
+echo "Exit with code $EXIT_CODE" >&2
+exit "$EXIT_CODE"
+'''
+
+
+class FetchPdfTest(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(FetchPdfTest, self).__init__([], *args, **kwargs)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.old_directory = os.getcwd()
+        os.chdir(self.directory)
+        os.makedirs(OUTPUT_DIRECTORY)
+        wkhtmltopdf = os.path.join(self.directory, 'wkhtmltopdf')
+        with open(wkhtmltopdf, 'w') as script_file:
+            script_file.write(FAKE_WKHTMLTOPDF)
+        os.chmod(wkhtmltopdf, stat.S_IRWXU)
+        self.configuration = pdfkit.configuration(wkhtmltopdf=wkhtmltopdf)
+        self.old_environ = os.environ.copy()
+        os.environ['PATH'] = self.directory + os.pathsep + os.environ.get('PATH', '')
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.old_environ)
+        os.chdir(self.old_directory)
+        shutil.rmtree(self.directory)
+
+    def _fetch_pdf(self, exit_code, pdf_text='', sleep=0, processes=None, timeout=10):
+        os.environ.update({'EXIT_CODE': str(exit_code), 'PDF_TEXT': pdf_text, 'SLEEP': str(sleep)})
+        return _fetch_pdf(
+            ['http://example.com'], 'tutorial', timeout, self.configuration, processes)
+
+    def _get_pdf_filenames(self):
+        return sorted(os.listdir(OUTPUT_DIRECTORY))
+
+    def test_save_pdf(self):
+        entry = self._fetch_pdf(0, "pdf")
+        self.assertEqual(entry['size'], 3)
+        self.assertEqual(self._get_pdf_filenames(), ['tutorial.pdf'])
+
+    def test_keep_pdf_when_some_pages_failed(self):
+        entry = self._fetch_pdf(1, "pdf")
+        self.assertEqual(entry['size'], 3)
+        self.assertEqual(self._get_pdf_filenames(), ['tutorial.pdf'])
+
+    def test_discard_empty_pdf_after_error(self):
+        self.assertIsNone(self._fetch_pdf(1))
+        self.assertEqual(self._get_pdf_filenames(), [])
+
+    def test_discard_pdf_after_timeout(self):
+        self.assertIsNone(self._fetch_pdf(0, "pdf", sleep=5, timeout=0.2))
+        self.assertEqual(self._get_pdf_filenames(), [])
+
+    def test_kill_running_renders_when_stopped(self):
+        processes = RenderProcesses()
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(self._fetch_pdf(0, "pdf", 5, processes)))
+        start_time = time.time()
+        thread.start()
+        while not processes.processes and thread.is_alive():
+            time.sleep(0.01)
+        processes.stop()
+        thread.join()
+
+        self.assertLess(time.time() - start_time, 5)
+        self.assertEqual(results, [None])
+        self.assertEqual(self._get_pdf_filenames(), [])
+        # Renders that start after rendering stopped are skipped.
+        self.assertIsNone(self._fetch_pdf(0, "pdf", processes=processes))
+
+    def test_render_same_tutorial_twice_at_once(self):
+        os.environ.update({'EXIT_CODE': '0', 'PDF_TEXT': 'pdf', 'SLEEP': '0.3'})
+        results = []
+
+        def fetch_pdf():
+            results.append(_fetch_pdf(
+                ['http://example.com'], 'tutorial', 10, self.configuration))
+
+        threads = [threading.Thread(target=fetch_pdf) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([entry['size'] for entry in results], [3, 3])
+        self.assertEqual(self._get_pdf_filenames(), ['tutorial.pdf'])
+
+    def test_stop_renders_after_error(self):
+        os.environ.update({'EXIT_CODE': '0', 'PDF_TEXT': 'pdf', 'SLEEP': '5'})
+
+        def read_tutorials():
+            yield {'tutorial_id': 1, 'links': 'http://example.com/1'}
+            time.sleep(0.2)  # Let the first render start
+            raise ValueError("Bad tutorial")
+
+        start_time = time.time()
+        with self.assertRaises(ValueError):
+            fetch_tutorials(read_tutorials(), jobs=2)
+        self.assertLess(time.time() - start_time, 5)
+        self.assertEqual(self._get_pdf_filenames(), ['manifest.json'])